@@ -0,0 +1,294 @@
+import asyncio
+import json
+import math
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+from app.db.connection import DB_POOL_MAX_SIZE
+from app.db.instrumentation import DB_LATENCY_BUCKETS, METRICS_ENABLED
+
+## Admission control for the settings API.
+##
+## Every /api request takes a slot of the read budget (GET, HEAD) or the write budget (everything
+## else) before it is handled, and gives it back once its response has been sent. A request that
+## finds its budget full waits in that budget's queue for at most ADMISSION_QUEUE_TIMEOUT; when the
+## queue is full or the wait times out it is answered right away with ADMISSION_SHED_STATUS and a
+## Retry-After header, without touching the database. Reads and writes never wait for each other's
+## slots, so a burst of writes can't hold up reads. Routes listed in ADMISSION_ROUTE_LIMITS also
+## take a slot of their own limit first, to keep heavy routes (batches, imports) to a few at a time.
+## A route's limit covers it in every namespace, /api/namespaces/{namespace}/settings:import takes a
+## slot of the "POST /api/settings:import" limit.
+##
+## Change feed long polls and streams mostly wait for notifications, they aren't limited.
+## The limits apply per worker.
+
+# Limit concurrent API requests, off by default
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "false").lower() == "true"
+
+# Reads handled at once by a worker, the rest wait in the queue
+ADMISSION_READ_CONCURRENCY = int(os.getenv("ADMISSION_READ_CONCURRENCY", str(2 * DB_POOL_MAX_SIZE)))
+ADMISSION_READ_QUEUE = int(os.getenv("ADMISSION_READ_QUEUE", "100"))
+
+# Writes handled at once by a worker, the rest wait in the queue
+ADMISSION_WRITE_CONCURRENCY = int(os.getenv("ADMISSION_WRITE_CONCURRENCY", str(DB_POOL_MAX_SIZE)))
+ADMISSION_WRITE_QUEUE = int(os.getenv("ADMISSION_WRITE_QUEUE", "50"))
+
+# Seconds a request waits for a slot before it is shed, bounds the time added to any response
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1"))
+
+# Seconds clients are asked to wait before retrying a shed request
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+
+# Status of shed requests, 503 (Service Unavailable) or 429 (Too Many Requests)
+ADMISSION_SHED_STATUS = int(os.getenv("ADMISSION_SHED_STATUS", "503"))
+
+# Extra limits for single routes as "METHOD PATH=CONCURRENCY" separated by commas, e.g.
+# "POST /api/settings:import=1,POST /api/settings:batch=4", paths match exactly
+ADMISSION_ROUTE_LIMITS = os.getenv("ADMISSION_ROUTE_LIMITS", "")
+
+API_PREFIX = "/api/"
+NAMESPACES_PREFIX = "/api/namespaces/"
+
+# Long polls and streams, they hold no connection while waiting for changes
+UNLIMITED_SUFFIXES = (":changes", ":stream")
+
+READ_METHODS = frozenset(("GET", "HEAD"))
+
+READ = "read"
+WRITE = "write"
+
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight", "Requests holding a slot of a budget", ["budget"], multiprocess_mode="livesum"
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth", "Requests waiting for a slot of a budget", ["budget"], multiprocess_mode="livesum"
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "admission_queue_wait_seconds", "Time requests waited for a slot before they were admitted",
+    ["budget"], buckets=DB_LATENCY_BUCKETS
+)
+ADMISSION_SHED = Counter(
+    "admission_shed_total", "Requests answered without being handled because their budget was exhausted",
+    ["budget", "reason"]
+)
+
+
+class Shed(Exception):
+    ## Raised when a request can't get a slot
+    def __init__(self, budget: str, reason: str):
+        super().__init__(f"{budget} {reason}")
+        self.budget = budget
+        self.reason = reason
+
+
+class ConcurrencyLimit:
+    ## A number of slots with a bounded FIFO queue of waiters, a freed slot goes straight to the oldest
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, queue_timeout: float):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.shed: Dict[str, int] = {QUEUE_FULL: 0, QUEUE_TIMEOUT: 0}
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        ## Takes a slot, waiting in the queue when none is free, raises Shed when it can't get one
+        if self.active < self.concurrency and not self._waiters:
+            self._admit(0.0)
+            return
+        if len(self._waiters) >= self.queue_size:
+            self._shed(QUEUE_FULL)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append(future)
+        if METRICS_ENABLED:
+            ADMISSION_QUEUE_DEPTH.labels(self.name).inc()
+        started = loop.time()
+        try:
+            # Shielded so a slot handed over just as the wait times out isn't lost
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not self._handed_over(future):
+                self._shed(QUEUE_TIMEOUT)
+        except asyncio.CancelledError:
+            # The client went away, a slot handed over meanwhile goes to the next waiter
+            if self._handed_over(future):
+                self.release()
+            raise
+        finally:
+            if METRICS_ENABLED:
+                ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+        # Handed a slot by release(), active already counts it
+        self._admit(loop.time() - started, handed_over=True)
+
+    def _handed_over(self, future: asyncio.Future) -> bool:
+        ## Whether release() gave a waiter a slot, otherwise the waiter leaves the queue
+        if future.done() and not future.cancelled():
+            return True
+        future.cancel()
+        self._waiters.remove(future)
+        return False
+
+    def release(self):
+        ## Gives a slot back, to the oldest waiter if there is one
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+        if METRICS_ENABLED:
+            ADMISSION_IN_FLIGHT.labels(self.name).dec()
+
+    def _admit(self, waited: float, handed_over: bool = False):
+        self.admitted += 1
+        if not handed_over:
+            self.active += 1
+            if METRICS_ENABLED:
+                ADMISSION_IN_FLIGHT.labels(self.name).inc()
+        if METRICS_ENABLED:
+            ADMISSION_QUEUE_WAIT.labels(self.name).observe(waited)
+
+    def _shed(self, reason: str):
+        self.shed[reason] += 1
+        if METRICS_ENABLED:
+            ADMISSION_SHED.labels(self.name, reason).inc()
+        raise Shed(self.name, reason)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": self.queued,
+            "queue_size": self.queue_size,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
+
+
+def parse_route_limits(value: str) -> Dict[Tuple[str, str], int]:
+    ## Parses ADMISSION_ROUTE_LIMITS into {(method, path): concurrency}
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        try:
+            route, concurrency = item.rsplit("=", 1)
+            method, path = route.split()
+            limits[(method.upper(), path)] = int(concurrency)
+        except ValueError:
+            raise ValueError(f"Invalid ADMISSION_ROUTE_LIMITS entry {item.strip()!r}, expected 'METHOD PATH=CONCURRENCY'")
+    return limits
+
+
+class AdmissionController:
+    ## The read and write budgets and the per-route limits of a worker
+
+    def __init__(
+        self,
+        read_concurrency: int,
+        read_queue: int,
+        write_concurrency: int,
+        write_queue: int,
+        queue_timeout: float,
+        route_limits: Optional[Dict[Tuple[str, str], int]] = None,
+    ):
+        self.budgets = {
+            READ: ConcurrencyLimit(READ, read_concurrency, read_queue, queue_timeout),
+            WRITE: ConcurrencyLimit(WRITE, write_concurrency, write_queue, queue_timeout),
+        }
+        # A route's queue is as long as its budget's, the budget's own queue still applies after it
+        self.routes = {
+            (method, path): ConcurrencyLimit(
+                f"{method} {path}", concurrency,
+                self.budgets[READ if method in READ_METHODS else WRITE].queue_size, queue_timeout
+            )
+            for (method, path), concurrency in (route_limits or {}).items()
+        }
+
+    def limits_for(self, method: str, path: str) -> List[ConcurrencyLimit]:
+        ## The limits a request takes a slot of, in order, none for requests that aren't limited
+        if not path.startswith(API_PREFIX) or path.endswith(UNLIMITED_SUFFIXES) or method == "OPTIONS":
+            return []
+        budget = self.budgets[READ if method in READ_METHODS else WRITE]
+        if path.startswith(NAMESPACES_PREFIX):
+            path = "/api/" + path[len(NAMESPACES_PREFIX):].partition("/")[2]
+        route = self.routes.get((method, path))
+        return [route, budget] if route is not None else [budget]
+
+    def stats(self) -> dict:
+        return {
+            **{name: budget.stats() for name, budget in self.budgets.items()},
+            "routes": {limit.name: limit.stats() for limit in self.routes.values()},
+        }
+
+
+admission_controller = AdmissionController(
+    ADMISSION_READ_CONCURRENCY,
+    ADMISSION_READ_QUEUE,
+    ADMISSION_WRITE_CONCURRENCY,
+    ADMISSION_WRITE_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT,
+    parse_route_limits(ADMISSION_ROUTE_LIMITS),
+)
+
+
+class AdmissionMiddleware:
+    ## ASGI middleware holding a slot of each of a request's limits until its response is sent
+
+    def __init__(self, app, controller: AdmissionController, retry_after: float = 1.0, shed_status: int = 503):
+        self.app = app
+        self.controller = controller
+        self.retry_after = retry_after
+        self.shed_status = shed_status
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limits = self.controller.limits_for(scope["method"], scope["path"])
+
+        held = []
+        try:
+            for limit in limits:
+                await limit.acquire()
+                held.append(limit)
+        except Shed as e:
+            for limit in reversed(held):
+                limit.release()
+            await self._reject(send, e)
+            return
+        except BaseException:
+            for limit in reversed(held):
+                limit.release()
+            raise
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for limit in reversed(held):
+                limit.release()
+
+    async def _reject(self, send, shed: Shed):
+        body = json.dumps({"detail": f"Too many concurrent {shed.budget} requests, retry later"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": self.shed_status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(math.ceil(self.retry_after)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,59 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, List, Optional
+
+## Helpers for conditional requests (ETag / If-None-Match / If-Modified-Since).
+## Timestamps in the settings table are stored without a time zone and are treated as UTC.
+
+def make_etag(parts: Iterable[str]) -> str:
+    ## Builds a strong ETag from the parts that identify a representation
+    digest = hashlib.sha1("|".join(parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+def setting_etag(setting_id, updated_at: datetime, fields: Optional[List[str]] = None) -> str:
+    ## ETag for a single setting, changes whenever the setting is written
+    ## A selection of fields is a different representation with its own ETag
+    return make_etag([str(setting_id), updated_at.isoformat()] + (["fields"] + fields if fields is not None else []))
+
+def http_date(value: datetime) -> str:
+    ## Formats a timestamp for the Last-Modified header
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    ## Checks If-None-Match against an ETag using the weak comparison RFC 9110 requires for it
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def not_modified_since(if_modified_since: Optional[str], last_modified: datetime) -> bool:
+    ## Checks If-Modified-Since, HTTP dates only have second precision
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+def is_not_modified(
+    etag: str,
+    last_modified: Optional[datetime],
+    if_none_match: Optional[str],
+    if_modified_since: Optional[str]
+) -> bool:
+    ## Evaluates conditional headers, If-None-Match takes precedence over If-Modified-Since
+    if if_none_match:
+        return etag_matches(if_none_match, etag)
+    if last_modified is not None:
+        return not_modified_since(if_modified_since, last_modified)
+    return False
@@ -1,63 +1,411 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Header, Response, Request, Body, Depends, Path
+from fastapi.responses import StreamingResponse
 from app.models.setting import (
     SettingCreate,
     SettingUpdate,
     Setting,
     SettingListResponse,
-    PaginationInfo
+    PaginationInfo,
+    SettingBatchRequest,
+    SettingBatchResponse,
+    JsonPatchOperation,
+    SettingChangesResponse,
+    SettingSyncResponse,
+    SettingRevision
 )
-from app.db import operations
+from app.db import async_operations
+from app.db.transfer import export_settings, SettingsImportError
+from app.db.patch import InvalidPatchError, PatchConflictError
+from app.db.history import RevisionNotRestorableError
+from app.db.pagination import encode_cursor, InvalidCursorError
+from app.db.filters import InvalidFilterError
+from app.db.projection import InvalidFieldsError
+from app.db.feed import (
+    FEED_BATCH_SIZE, SETTINGS_FEED_POLL_INTERVAL, InvalidPositionError, PositionExpiredError, change_hub
+)
+from app.db.counting import NONE, resolve_count_strategy
+from app.db.namespaces import DEFAULT_NAMESPACE, NAMESPACE_PATTERN
+from app.api.conditional import make_etag, setting_etag, http_date, is_not_modified
+from typing import Any, AsyncIterator, Dict, List, Optional, Literal, Union
+from uuid import UUID
+from datetime import datetime
+import asyncio
 import math
+import os
+import tempfile
 from psycopg2 import errors as pg_errors 
 
 router = APIRouter()
 
+# Clients may cache responses but must revalidate them with the ETag
+CACHE_CONTROL = "no-cache"
+
+# Maximum number of creates + updates + deletes in one batch request
+SETTINGS_BATCH_MAX_ITEMS = int(os.getenv("SETTINGS_BATCH_MAX_ITEMS", "100000"))
+
+# Bytes of an import body kept in memory before spooling to a temporary file
+IMPORT_SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+# Longest a long-poll request for changes may wait
+FEED_MAX_WAIT = 60
+
+# Revisions are stored as INTEGER
+REVISION_MAX = 2**31 - 1
+
+FIELDS_DESCRIPTION = (
+    "JSON pointers of the parts of the data to return, e.g. /theme, the data is then an object "
+    "keyed by the pointers with null for missing paths"
+)
+
+## The router is mounted twice: at /api for the default namespace and at /api/namespaces/{namespace}
+
+def namespace_path(namespace: str = Path(..., pattern=NAMESPACE_PATTERN, description="Namespace of the settings")):
+    ## Validates and documents the namespace of the namespaced mount
+    return namespace
+
+def setting_namespace(request: Request) -> str:
+    ## The namespace a request works in, the default one for routes without a namespace
+    return request.path_params.get("namespace", DEFAULT_NAMESPACE)
+
 @router.post("/settings", response_model=Setting, status_code=201)
-def create_setting(setting: SettingCreate):
+async def create_setting(setting: SettingCreate, request: Request, namespace: str = Depends(setting_namespace)):
     ## Create a new setting
+    ## The body may name the namespace on /api/settings, a namespaced route only accepts its own
+    if setting.namespace is not None and setting.namespace != namespace:
+        if "namespace" in request.path_params:
+            raise HTTPException(status_code=400, detail="Namespace in the body doesn't match the route's")
+        namespace = setting.namespace
     try:
-        return operations.create_setting(setting.data)
+        return await async_operations.create_setting(setting.data, namespace)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create setting: {str(e)}")
 
+@router.post("/settings:batch", response_model=SettingBatchResponse)
+async def batch_settings(batch: SettingBatchRequest, response: Response, namespace: str = Depends(setting_namespace)):
+    ## Creates, updates and deletes many settings of a namespace in a single transaction
+    ## Returns 409 when an atomic batch was rolled back because an item failed
+    item_count = len(batch.create) + len(batch.update) + len(batch.delete)
+    if item_count > SETTINGS_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch has {item_count} items, the maximum is {SETTINGS_BATCH_MAX_ITEMS}"
+        )
+    if any(item.namespace not in (None, namespace) for item in batch.create):
+        raise HTTPException(status_code=400, detail=f"A batch only writes to its route's namespace '{namespace}'")
+    try:
+        committed, results = await async_operations.apply_batch(
+            [item.data for item in batch.create],
+            [(item.id, item.data) for item in batch.update],
+            batch.delete,
+            atomic=batch.atomic,
+            return_settings=batch.return_settings,
+            namespace=namespace
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to apply batch: {str(e)}")
+
+    if batch.atomic and not committed and results:
+        response.status_code = 409
+    return SettingBatchResponse(committed=committed, results=results)
+
+@router.get(
+    "/settings:export",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}, "description": "One setting per line"}}
+)
+def export_all_settings(namespace: str = Depends(setting_namespace)):
+    ## Streams every setting of the namespace as NDJSON, memory use stays constant regardless of table size
+    return StreamingResponse(
+        export_settings(namespace=namespace),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="settings-{namespace}.ndjson"'}
+    )
+
+@router.post("/settings:import")
+async def import_all_settings(
+    request: Request,
+    upsert: bool = Query(False, description="Overwrite settings whose IDs already exist"),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Imports NDJSON settings (the export format) with COPY
+    ## The body is spooled to disk past a few MB rather than held in memory
+    with tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_MAX_MEMORY) as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        try:
+            return await async_operations.import_settings_file(spool, upsert, namespace)
+        except SettingsImportError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except pg_errors.UniqueViolation:
+            raise HTTPException(status_code=409, detail="A setting with an imported ID already exists, use upsert=true to overwrite")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to import settings: {str(e)}")
+
+@router.get("/settings:changes", response_model=SettingChangesResponse)
+async def get_setting_changes(
+    after: Optional[str] = Query(None, description="Position from a previous response, omit to start at the current end of the feed"),
+    ids: Optional[List[UUID]] = Query(None, description="Only report changes to these settings"),
+    wait: float = Query(30, ge=0, le=FEED_MAX_WAIT, description="Seconds to wait for a change before returning an empty list"),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Long-polls the change feed, returns as soon as there are changes after the position
+    ## Pass the returned position back as ?after= to continue without missing a change
+    deadline = asyncio.get_running_loop().time() + wait
+    try:
+        while True:
+            generation = change_hub.generation
+            changes, position = await async_operations.get_changes(after, ids, namespace=namespace)
+            remaining = deadline - asyncio.get_running_loop().time()
+            if changes or remaining <= 0:
+                return SettingChangesResponse(changes=changes, position=position)
+            after = position
+            await change_hub.wait(generation, min(remaining, SETTINGS_FEED_POLL_INTERVAL))
+    except InvalidPositionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PositionExpiredError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get changes: {str(e)}")
+
+async def change_stream(
+    after: Optional[str], ids: Optional[List[UUID]], namespace: str = DEFAULT_NAMESPACE
+) -> AsyncIterator[str]:
+    ## Server-sent events for every change after the position, resumable through Last-Event-ID
+    ## Idle periods send a comment that also carries the current position as the event ID
+    while True:
+        generation = change_hub.generation
+        changes, after = await async_operations.get_changes(after, ids, namespace=namespace)
+        for change in changes:
+            yield f"id: {change.position}\nevent: change\ndata: {change.model_dump_json()}\n\n"
+        if len(changes) == FEED_BATCH_SIZE:
+            continue
+        if not await change_hub.wait(generation, SETTINGS_FEED_POLL_INTERVAL):
+            yield f"id: {after}\n: keepalive\n\n"
+
+@router.get(
+    "/settings:stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}, "description": "One change event per setting write"}}
+)
+async def stream_setting_changes(
+    after: Optional[str] = Query(None, description="Position to resume after, omit to start at the current end of the feed"),
+    ids: Optional[List[UUID]] = Query(None, description="Only report changes to these settings"),
+    last_event_id: Optional[str] = Header(None),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Streams setting changes as server-sent events, reconnecting clients resume from Last-Event-ID
+    after = last_event_id or after
+    try:
+        # Resolve the start position up front so a bad one fails the request rather than the stream
+        if after is None:
+            _, after = await async_operations.get_changes(namespace=namespace)
+        else:
+            await async_operations.get_changes(after, ids, limit=0, namespace=namespace)
+    except InvalidPositionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PositionExpiredError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to stream changes: {str(e)}")
+    return StreamingResponse(
+        change_stream(after, ids, namespace),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/settings:sync", response_model=SettingSyncResponse)
+async def sync_settings(
+    since: Optional[str] = Query(None, description="Watermark from the previous sync, omit to get the current watermark"),
+    limit: int = Query(FEED_BATCH_SIZE, ge=1, le=10000, description="Maximum number of changes to read"),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Returns the settings changed and deleted since a watermark, for incremental replication
+    ## A first sync takes the watermark, then lists every setting, then syncs from the watermark.
+    ## 410 means the changes can't be reported anymore (pruned or truncated) and a full resync is needed
+    try:
+        settings, deleted, watermark, has_more = await async_operations.sync_settings(since, limit, namespace)
+    except InvalidPositionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PositionExpiredError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to sync settings: {str(e)}")
+    return SettingSyncResponse(settings=settings, deleted=deleted, watermark=watermark, has_more=has_more)
+
 @router.get("/settings", response_model=SettingListResponse)
-def get_all_settings(
+async def get_all_settings(
     page: int = Query(1, ge=1, description="Page number"),
-    limit: int = Query(10, ge=1, le=100, description="Items per page")
+    limit: int = Query(10, ge=1, le=100, description="Items per page"),
+    cursor: Optional[str] = Query(None, description="Cursor from pagination.next_cursor, replaces page"),
+    count: Optional[Literal["exact", "estimated", "cached"]] = Query(None, description="How to compute the total, defaults to SETTINGS_COUNT_STRATEGY"),
+    include_total: bool = Query(True, description="Set to false to skip computing the total"),
+    contains: Optional[str] = Query(None, description='JSON the data must contain, e.g. {"theme": "dark"}'),
+    has_key: Optional[str] = Query(None, description="Top level key the data must have"),
+    has_any: Optional[List[str]] = Query(None, description="Top level keys, the data must have at least one"),
+    has_all: Optional[List[str]] = Query(None, description="Top level keys, the data must have all of them"),
+    jsonpath: Optional[str] = Query(None, description='JSONPath that must match, e.g. $.limits.max ? (@ > 10)'),
+    fields: Optional[List[str]] = Query(None, description=FIELDS_DESCRIPTION),
+    include_data: bool = Query(True, description="Set to false to list the settings without their data"),
+    if_none_match: Optional[str] = Header(None),
+    namespace: str = Depends(setting_namespace)
 ):
-    ## Gets paginated list of settings
+    ## Gets paginated list of settings, optionally filtered on their data
+    ## The declared response_model documents the schema, the body is built without it
+    ## fields and include_data are applied by Postgres, only the selected data is read out of the rows
+    filters = {"contains": contains, "has_key": has_key, "has_any": has_any, "has_all": has_all, "jsonpath": jsonpath}
+    filters = {name: value for name, value in filters.items() if value is not None}
+    count_strategy = resolve_count_strategy(count if include_total else NONE, filtered=bool(filters))
     try:
-        settings, total = operations.get_all_settings(page, limit)
+        # The page body depends on the rows, their versions, the selected data and the pagination info
+        def page_etag(version: str, total: Optional[int]) -> str:
+            return make_etag(
+                [
+                    namespace, version, str(total), count_strategy, str(page), str(limit), cursor or "",
+                    str(sorted(filters.items())), str(fields), str(include_data)
+                ]
+            )
+
+        # A conditional request is checked against the page's version alone, read without the data,
+        # so a matching one is answered before the page is rendered
+        current = None
+        if if_none_match:
+            current = await async_operations.get_settings_page_version(
+                page, limit, cursor, count_strategy, filters, namespace
+            )
+            etag = page_etag(current.version, current.total)
+            if is_not_modified(etag, None, if_none_match, None):
+                return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+        # Rendered to JSON by Postgres and written out as is, the rows never become models
+        # The total counted for the check isn't counted again
+        result = await async_operations.get_all_settings_json(
+            page, limit, cursor, NONE if current else count_strategy, filters, fields, include_data, namespace
+        )
+        total = current.total if current else result.total
+        headers = {"ETag": page_etag(result.version, total), "Cache-Control": CACHE_CONTROL}
+        
+        total_pages = None
+        if total is not None:
+            total_pages = math.ceil(total / limit) if total > 0 else 0
         
         pagination = PaginationInfo(
             total=total,
             page=page,
             limit=limit,
-            total_pages=math.ceil(total / limit) if total > 0 else 0
+            total_pages=total_pages,
+            count_strategy=count_strategy,
+            next_cursor=encode_cursor(*result.last_key) if result.rows == limit else None
         )
         
-        return SettingListResponse(data=settings, pagination=pagination)
+        body = f'{{"data":{result.data},"pagination":{pagination.model_dump_json()}}}'
+        return Response(content=body, media_type="application/json", headers=headers)
+    except (InvalidCursorError, InvalidFilterError, InvalidFieldsError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch settings: {str(e)}")
 
 @router.get("/settings/{uid}", response_model=Setting)
-def get_setting(uid: str):
+async def get_setting(
+    uid: str,
+    as_of: Optional[datetime] = Query(None, description="Return the setting as it was at this time, from its history"),
+    fields: Optional[List[str]] = Query(None, description=FIELDS_DESCRIPTION),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    namespace: str = Depends(setting_namespace)
+):
     ## Gets a single setting by id
+    ## Conditional requests are validated against updated_at alone, without reading the data
+    ## With fields only the selected parts of the data are read, by Postgres
     try:
-        setting = operations.get_setting_by_id(uid)
+        if as_of is not None and fields is not None:
+            raise HTTPException(status_code=400, detail="fields can't be combined with as_of")
+        if as_of is not None:
+            setting = await async_operations.get_setting_as_of(uid, as_of, namespace)
+            if not setting:
+                raise HTTPException(status_code=404, detail="Setting not found at that time")
+            return setting
+
+        if if_none_match or if_modified_since:
+            updated_at = await async_operations.get_setting_version(uid, namespace)
+            if updated_at is None:
+                raise HTTPException(status_code=404, detail="Setting not found")
+            etag = setting_etag(UUID(uid), updated_at, fields)
+            if is_not_modified(etag, updated_at, if_none_match, if_modified_since):
+                return Response(status_code=304, headers={
+                    "ETag": etag,
+                    "Last-Modified": http_date(updated_at),
+                    "Cache-Control": CACHE_CONTROL
+                })
+
+        if fields is not None:
+            setting = await async_operations.get_setting_fields(uid, fields, namespace)
+        else:
+            setting = await async_operations.get_setting_by_id(uid, namespace)
         if not setting:
             raise HTTPException(status_code=404, detail="Setting not found")
-        return setting
+        # Serialized once here rather than validated again against response_model
+        return Response(content=setting.model_dump_json(), media_type="application/json", headers={
+            "ETag": setting_etag(setting.id, setting.updated_at, fields),
+            "Last-Modified": http_date(setting.updated_at),
+            "Cache-Control": CACHE_CONTROL
+        })
     except HTTPException:
         raise
+    except InvalidFieldsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch setting: {str(e)}")
 
+@router.get("/settings/{uid}/revisions", response_model=List[SettingRevision])
+async def list_setting_revisions(
+    uid: str,
+    limit: int = Query(50, ge=1, le=1000, description="Revisions per page"),
+    before: Optional[int] = Query(None, ge=1, le=REVISION_MAX, description="Only revisions older than this one, for paging"),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Lists the revisions of a setting newest first, without their data
+    try:
+        revisions = await async_operations.list_revisions(uid, limit, before, namespace)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to list revisions: {str(e)}")
+    if not revisions and before is None:
+        raise HTTPException(status_code=404, detail="Setting has no history")
+    return revisions
+
+@router.get("/settings/{uid}/revisions/{revision}", response_model=SettingRevision)
+async def get_setting_revision(
+    uid: str, revision: int = Path(..., le=REVISION_MAX), namespace: str = Depends(setting_namespace)
+):
+    ## Gets a revision of a setting with its data as of that revision
+    try:
+        found = await async_operations.get_revision(uid, revision, namespace)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch revision: {str(e)}")
+    if not found:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    return found
+
+@router.post("/settings/{uid}/revisions/{revision}:restore", response_model=Setting)
+async def restore_setting_revision(
+    uid: str, revision: int = Path(..., le=REVISION_MAX), namespace: str = Depends(setting_namespace)
+):
+    ## Restores a setting to the data of a revision, the restore is recorded as a new revision
+    try:
+        restored = await async_operations.restore_revision(uid, revision, namespace)
+    except RevisionNotRestorableError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to restore revision: {str(e)}")
+    if not restored:
+        raise HTTPException(status_code=404, detail="Revision not found")
+    return restored
+
 @router.put("/settings/{uid}", response_model=Setting)
-def update_setting(uid: str, setting: SettingUpdate):
+async def update_setting(uid: str, setting: SettingUpdate, namespace: str = Depends(setting_namespace)):
     ## Updates an existing setting by ID
     try:
-        updated_setting = operations.update_setting(uid, setting.data)
+        updated_setting = await async_operations.update_setting(uid, setting.data, namespace)
         if not updated_setting:
             raise HTTPException(status_code=404, detail="Setting not found")
         return updated_setting
@@ -66,11 +414,46 @@ def update_setting(uid: str, setting: SettingUpdate):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update setting: {str(e)}")
 
+@router.patch("/settings/{uid}", response_model=Setting)
+async def patch_setting(
+    uid: str,
+    request: Request,
+    patch: Union[List[JsonPatchOperation], Dict[str, Any]] = Body(
+        ...,
+        description="A JSON merge patch object (application/merge-patch+json) or an array of "
+                    "JSON patch operations (application/json-patch+json), applied to the setting's data"
+    ),
+    namespace: str = Depends(setting_namespace)
+):
+    ## Partially updates a setting, the patch is applied inside Postgres in a single statement
+    ## Plain application/json is dispatched on the body: an array is a JSON patch, an object a merge patch
+    content_type = request.headers.get("content-type", "")
+    if ("merge-patch" in content_type and isinstance(patch, list)) or \
+            ("json-patch" in content_type and not isinstance(patch, list)):
+        raise HTTPException(status_code=415, detail="Body doesn't match the patch content type")
+    try:
+        if isinstance(patch, list):
+            operations = [op.model_dump(by_alias=True, exclude_unset=True) for op in patch]
+            patched = await async_operations.patch_setting(uid, json_patch=operations, namespace=namespace)
+        else:
+            patched = await async_operations.patch_setting(uid, merge_patch=patch, namespace=namespace)
+        if not patched:
+            raise HTTPException(status_code=404, detail="Setting not found")
+        return patched
+    except HTTPException:
+        raise
+    except InvalidPatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except PatchConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to patch setting: {str(e)}")
+
 @router.delete("/settings/{uid}", status_code=204)
-def delete_setting(uid: str):
+async def delete_setting(uid: str, namespace: str = Depends(setting_namespace)):
     ## Delete setting by ID
     try:
-        operations.delete_setting(uid)
+        await async_operations.delete_setting(uid, namespace)
         return None
     except pg_errors.InvalidTextRepresentation:
         ## Invalid ID, still raises 204
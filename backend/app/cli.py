@@ -0,0 +1,121 @@
+import argparse
+import sys
+from app.db.transfer import export_settings, import_settings_file
+from app.db.operations import prune_changes
+from app.db.feed import SETTINGS_CHANGES_RETENTION
+from app.db.history import SETTINGS_HISTORY_RETENTION, compact_history
+from app.db.migrations import HEAD, migrate, migration_status
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.snapshot import SETTINGS_SNAPSHOT_PATH, build_snapshot, build_snapshot_periodically
+
+## Command line tools for the settings database
+##   python -m app.cli export [-o settings.ndjson] [--namespace NAME]
+##   python -m app.cli import settings.ndjson [--upsert] [--namespace NAME]
+##   python -m app.cli prune-changes [--retention SECONDS]
+##   python -m app.cli compact-history [--retention SECONDS]
+##   python -m app.cli migrate [--target VERSION] [--status]
+##   python -m app.cli build-snapshot [-o PATH] [--interval SECONDS]
+
+def export_command(args):
+    ## Streams every setting of a namespace as NDJSON to a file or stdout
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in export_settings(namespace=args.namespace):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+
+def import_command(args):
+    ## Loads settings from an NDJSON file or stdin with COPY
+    source = open(args.input, "rb") if args.input != "-" else sys.stdin.buffer
+    try:
+        counts = import_settings_file(source, upsert=args.upsert, namespace=args.namespace)
+    finally:
+        if args.input != "-":
+            source.close()
+    print(f"Imported {counts['lines']} lines: {counts['inserted']} inserted, {counts['updated']} updated")
+
+def prune_changes_command(args):
+    ## Deletes change log rows older than the retention
+    print(f"Pruned {prune_changes(args.retention)} changes")
+
+def compact_history_command(args):
+    ## Deletes revisions older than the retention, keeping every setting's history rebuildable
+    print(f"Deleted {compact_history(args.retention)} revisions")
+
+def migrate_command(args):
+    ## Applies pending schema migrations, run before a rollout when DB_MIGRATE_ON_STARTUP is off
+    if not args.status:
+        applied = migrate(args.target)
+        for migration in applied:
+            print(f"Applied {migration.version} {migration.name}")
+        if not applied:
+            print("Nothing to migrate")
+    for migration in migration_status():
+        state = migration["applied_at"].isoformat() if migration["applied_at"] else "pending"
+        print(f"{migration['version']:>4} {migration['name']:<32} {state}")
+
+def build_snapshot_command(args):
+    ## Writes the settings snapshot file read by the workers, once or again every interval while settings change
+    if not args.output:
+        sys.exit("No snapshot path, pass -o or set SETTINGS_SNAPSHOT_PATH")
+    if args.interval > 0:
+        build_snapshot_periodically(args.output, args.interval)
+        return
+    build = build_snapshot(args.output)
+    print(f"Wrote {build.rows} settings ({build.bytes} bytes) to {build.path} in {build.seconds:.3f}s")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Settings database tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Export all settings as NDJSON")
+    export_parser.add_argument("-o", "--output", help="Output file, defaults to stdout")
+    export_parser.add_argument("--namespace", default=DEFAULT_NAMESPACE, help="Namespace to export")
+    export_parser.set_defaults(func=export_command)
+
+    import_parser = commands.add_parser("import", help="Import settings from NDJSON")
+    import_parser.add_argument("input", help="NDJSON file, - for stdin")
+    import_parser.add_argument("--upsert", action="store_true", help="Overwrite settings with existing IDs")
+    import_parser.add_argument("--namespace", default=DEFAULT_NAMESPACE, help="Namespace to import into")
+    import_parser.set_defaults(func=import_command)
+
+    prune_parser = commands.add_parser("prune-changes", help="Delete old rows from the settings change log")
+    prune_parser.add_argument(
+        "--retention", type=float, default=SETTINGS_CHANGES_RETENTION,
+        help="Seconds of changes to keep, defaults to SETTINGS_CHANGES_RETENTION"
+    )
+    prune_parser.set_defaults(func=prune_changes_command)
+
+    compact_parser = commands.add_parser("compact-history", help="Delete old settings revisions")
+    compact_parser.add_argument(
+        "--retention", type=float, default=SETTINGS_HISTORY_RETENTION,
+        help="Seconds of history to keep, defaults to SETTINGS_HISTORY_RETENTION, 0 keeps everything"
+    )
+    compact_parser.set_defaults(func=compact_history_command)
+
+    migrate_parser = commands.add_parser("migrate", help="Apply pending schema migrations")
+    migrate_parser.add_argument(
+        "--target", type=int, default=None, help=f"Migrate up to this version, defaults to the latest ({HEAD})"
+    )
+    migrate_parser.add_argument("--status", action="store_true", help="Only list migrations and their state")
+    migrate_parser.set_defaults(func=migrate_command)
+
+    snapshot_parser = commands.add_parser("build-snapshot", help="Write the settings snapshot file workers read from")
+    snapshot_parser.add_argument(
+        "-o", "--output", default=SETTINGS_SNAPSHOT_PATH, help="Snapshot file, defaults to SETTINGS_SNAPSHOT_PATH"
+    )
+    snapshot_parser.add_argument(
+        "--interval", type=float, default=0, help="Keep rebuilding every this many seconds while settings change"
+    )
+    snapshot_parser.set_defaults(func=build_snapshot_command)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Optional
+from psycopg import conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from app.db.instrumentation import ASYNC_CURSOR_FACTORY, record_acquire
+from app.db.prepared import DB_PREPARED_STATEMENTS, DB_PREPARE_THRESHOLD
+from app.db.connection import (
+    get_db_params,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_MAX_LIFETIME,
+    DB_POOL_HEALTH_CHECK_INTERVAL,
+)
+
+# Use the native asyncio driver for route handlers, false falls back to the sync pool in a threadpool
+DB_ASYNC_ENABLED = os.getenv("DB_ASYNC_ENABLED", "true").lower() == "true"
+
+_pool: Optional[AsyncConnectionPool] = None
+_pool_loop: Optional[asyncio.AbstractEventLoop] = None
+_returned_at: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+async def _mark_returned(conn):
+    _returned_at[conn] = time.monotonic()
+
+async def _check_connection(conn):
+    ## Pings connections that have been idle longer than the health check interval
+    returned_at = _returned_at.get(conn)
+    if returned_at is None or time.monotonic() - returned_at > DB_POOL_HEALTH_CHECK_INTERVAL:
+        await AsyncConnectionPool.check_connection(conn)
+
+def new_async_pool(params: dict) -> AsyncConnectionPool:
+    ## An unopened pool sized by the DB_POOL_* settings, bound to the loop that opens it
+    return AsyncConnectionPool(
+        conninfo.make_conninfo(**params),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME if DB_POOL_MAX_LIFETIME > 0 else 3600 * 24 * 365,
+        # Text columns (e.g. JSON rendered by Postgres) are decoded as UTF-8 even on SQL_ASCII databases
+        kwargs={
+            "row_factory": dict_row,
+            "cursor_factory": ASYNC_CURSOR_FACTORY,
+            "client_encoding": "utf8",
+            # psycopg prepares a query once it ran this many times on a connection, None never does
+            "prepare_threshold": DB_PREPARE_THRESHOLD if DB_PREPARED_STATEMENTS else None,
+        },
+        check=_check_connection,
+        reset=_mark_returned,
+        open=False,
+    )
+
+async def init_async_pool() -> AsyncConnectionPool:
+    ## Creates and opens the async connection pool for the running event loop
+    global _pool, _pool_loop
+    loop = asyncio.get_running_loop()
+
+    if _pool is None or _pool.closed or _pool_loop is not loop:
+        ## A pool is bound to the loop that opened it, so a new loop gets a new pool
+        _pool = new_async_pool(get_db_params())
+        _pool_loop = loop
+
+    await _pool.open()
+    return _pool
+
+async def close_async_pool():
+    ## Closes the async connection pool, called on app shutdown
+    global _pool, _pool_loop
+    if _pool is not None and _pool_loop is asyncio.get_running_loop():
+        await _pool.close()
+    _pool = None
+    _pool_loop = None
+
+def get_async_pool_stats() -> dict:
+    ## Returns usage statistics for the async connection pool
+    if _pool is None:
+        return {}
+    return _pool.get_stats()
+
+@asynccontextmanager
+async def get_async_db_connection() -> AsyncGenerator:
+    ## Async context manager for database connections, commits on success or rolls back on error
+    pool = _pool
+    if pool is None or pool.closed or _pool_loop is not asyncio.get_running_loop():
+        pool = await init_async_pool()
+
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        record_acquire("async", time.perf_counter() - started)
+        yield conn
@@ -0,0 +1,524 @@
+import uuid
+from datetime import datetime
+from typing import BinaryIO, Dict, Optional, Tuple, List
+from psycopg import errors as pg_errors
+from psycopg.types.json import Jsonb
+from starlette.concurrency import run_in_threadpool
+from app.db import history, operations, transfer
+from app.db.async_connection import DB_ASYNC_ENABLED, get_async_db_connection
+from app.db.replicas import get_async_read_connection, is_replica_connection
+from app.db.operations import (
+    PAGE_VERSION_QUERY, RawSettingsPage, SettingsPageVersion, listing_conditions, page_query, raw_page_query,
+    raw_snapshot_page, setting_fields_query
+)
+from app.db.pagination import decode_cursor
+from app.db.cache import settings_cache, entry_key
+from app.db.snapshot import settings_snapshot
+from app.db.patch import compile_merge_patch, compile_json_patch, PatchConflictError
+from app.db.counting import CACHED, CACHED_COUNT_QUERY, EXACT, ESTIMATED, NONE, count_query, resolve_count_strategy
+from app.db.feed import (
+    FEED_BATCH_SIZE, SETTINGS_CHANGES_RETENTION, PositionExpiredError,
+    decode_position, encode_position, feed_query, next_position, read_feed
+)
+from app.db.filters import JSONPATH_CHECK_QUERY, plan_rows, InvalidFilterError
+from app.db.projection import NO_DATA, WHOLE_DOCUMENT, compile_projection
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.write_batching import (
+    SETTINGS_WRITE_BATCHING, SETTINGS_WRITE_BATCH_MAX_DELAY, SETTINGS_WRITE_BATCH_MAX_ITEMS, WriteBatcher
+)
+from app.models.setting import Setting, BatchItemResult, SettingChange, SettingRevision
+
+## Async versions of app.db.operations for the route handlers.
+## When DB_ASYNC_ENABLED is false each function runs its sync counterpart in the threadpool.
+
+def _parse_uuid(setting_id: str) -> Optional[uuid.UUID]:
+    ## Validates the ID client side, invalid IDs can never match a row
+    try:
+        return uuid.UUID(str(setting_id))
+    except ValueError:
+        return None
+
+async def create_setting(data: dict, namespace: str = DEFAULT_NAMESPACE) -> Setting:
+    ## Creates a new setting and uploads to db
+    ## With write batching on, the insert is committed together with other concurrent writes
+    if write_batcher.enabled:
+        return await write_batcher.create(data, namespace)
+    return await _create_setting(data, namespace)
+
+async def _create_setting(data: dict, namespace: str = DEFAULT_NAMESPACE) -> Setting:
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.create_setting, data, namespace)
+
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                INSERT INTO settings (namespace, id, data)
+                VALUES (%s, %s, %s)
+                RETURNING id, namespace, data, created_at, updated_at
+                """,
+                (namespace, uuid.uuid4(), Jsonb(data))
+            )
+            result = await cur.fetchone()
+
+    settings_snapshot.note_write(namespace=namespace)
+    return Setting(**result)
+
+async def _check_filters(cur, filters: Optional[dict]):
+    ## Raises InvalidFilterError for a jsonpath filter Postgres can't parse, e.g. a syntax error or a bad regex
+    jsonpath = (filters or {}).get("jsonpath")
+    if jsonpath is None:
+        return
+    try:
+        await cur.execute(JSONPATH_CHECK_QUERY, (jsonpath,))
+    except (pg_errors.SyntaxError, pg_errors.DataError) as e:
+        raise InvalidFilterError(str(e).strip()) from e
+
+async def _fetch_total(cur, count_strategy: str, namespace: str, where: str, params: list) -> Optional[int]:
+    ## Gets the total number of settings matching the listing's conditions using the given count strategy
+    if count_strategy == NONE:
+        return None
+    if count_strategy == CACHED:
+        await cur.execute(CACHED_COUNT_QUERY, (namespace,))
+        total = (await cur.fetchone())['count']
+        if total is not None:
+            return total
+        # No counter for the namespace yet, fall back to an exact count
+        count_strategy = EXACT
+    await cur.execute(count_query(count_strategy, where), params)
+    row = await cur.fetchone()
+    return plan_rows(row['QUERY PLAN']) if count_strategy == ESTIMATED else row['count']
+
+async def get_all_settings(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[Setting], Optional[int]]:
+    ## Gets paginated list of a namespace's settings, newest first
+    ## With a cursor the page is fetched by seeking past the cursor's row instead of using OFFSET
+    ## filters (see app.db.filters) restrict the listing and its total to matching settings
+    ## The total is None when count_strategy is "none"
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(
+            operations.get_all_settings, page, limit, cursor, count_strategy, filters, namespace
+        )
+
+    offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace) if not filtered else None
+    if snapshot_page is not None:
+        return [Setting.model_validate_json(row) for row in snapshot_page.rows], snapshot_page.total
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await _check_filters(cur, filters)
+            # Get total count
+            total = await _fetch_total(cur, count_strategy, namespace, where, filter_params)
+
+            # Get paginated data
+            await cur.execute(*page_query(where, filter_params, after, limit, offset))
+            results = await cur.fetchall()
+            settings = [Setting(**row) for row in results]
+
+            return settings, total
+
+async def get_all_settings_json(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    fields: Optional[List[str]] = None,
+    include_data: bool = True,
+    namespace: str = DEFAULT_NAMESPACE
+) -> RawSettingsPage:
+    ## Same as get_all_settings, but the page is returned as JSON text built by Postgres
+    ## fields (JSON pointers) select parts of each setting's data, include_data=False leaves it out
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(
+            operations.get_all_settings_json, page, limit, cursor, count_strategy, filters, fields, include_data,
+            namespace
+        )
+
+    offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    projection = compile_projection(fields, include_data)
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    # The snapshot holds whole documents, projections are always read from the database
+    snapshot_page = None
+    if not filtered and projection is WHOLE_DOCUMENT:
+        snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace)
+    if snapshot_page is not None:
+        return raw_snapshot_page(snapshot_page)
+    query, params = page_query(where, filter_params, after, limit, offset, projection)
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await _check_filters(cur, filters)
+            total = await _fetch_total(cur, count_strategy, namespace, where, filter_params)
+            await cur.execute(raw_page_query(query, projection), params)
+            row = await cur.fetchone()
+
+    last_key = (row['last_created_at'], row['last_id']) if row['rows'] else None
+    return RawSettingsPage(row['data'], total, row['rows'], last_key, row['version'])
+
+async def get_settings_page_version(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> SettingsPageVersion:
+    ## The total and version get_all_settings_json would return for the page, without reading the data
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(
+            operations.get_settings_page_version, page, limit, cursor, count_strategy, filters, namespace
+        )
+
+    offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace) if not filtered else None
+    if snapshot_page is not None:
+        return SettingsPageVersion(snapshot_page.total, snapshot_page.version)
+    query, params = page_query(where, filter_params, after, limit, offset, NO_DATA)
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await _check_filters(cur, filters)
+            total = await _fetch_total(cur, count_strategy, namespace, where, filter_params)
+            await cur.execute(PAGE_VERSION_QUERY.format(page=query), params)
+            row = await cur.fetchone()
+    return SettingsPageVersion(total, row['version'])
+
+async def get_setting_by_id(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Gets a specific setting using the ID, served from the cache when possible
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.get_setting_by_id, setting_id, namespace)
+
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        return None
+    key = str(parsed_id)
+    cached = settings_cache.get(entry_key(namespace, key))
+    if cached is not None:
+        return cached
+    token = settings_cache.fill_token()
+    setting = settings_snapshot.get(key, namespace)
+    if setting is not None:
+        settings_cache.put(entry_key(namespace, key), setting, len(setting.model_dump_json()), token)
+        return setting
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                SELECT id, namespace, data, created_at, updated_at
+                FROM settings
+                WHERE namespace = %s AND id = %s
+                """,
+                (namespace, parsed_id)
+            )
+            result = await cur.fetchone()
+        replica = is_replica_connection(conn)
+
+    if result:
+        setting = Setting(**result)
+        settings_cache.put(entry_key(namespace, key), setting, len(setting.model_dump_json()), token, replica)
+        return setting
+    return None
+
+async def get_setting_fields(
+    setting_id: str, fields: List[str], namespace: str = DEFAULT_NAMESPACE
+) -> Optional[Setting]:
+    ## Gets a setting with only the given JSON pointers of its data, selected by Postgres
+    ## Always read from the database, the cache and the snapshot hold whole documents
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.get_setting_fields, setting_id, fields, namespace)
+
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        return None
+    projection = compile_projection(fields)
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(setting_fields_query(projection), projection.params + [namespace, parsed_id])
+            result = await cur.fetchone()
+            return Setting(**result) if result else None
+
+async def get_setting_version(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[datetime]:
+    ## Gets only the updated_at of a setting, for cheap conditional request checks
+    ## Uses the cache when possible and never reads the data column
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.get_setting_version, setting_id, namespace)
+
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        return None
+    cached = settings_cache.get(entry_key(namespace, str(parsed_id)))
+    if cached is not None:
+        return cached.updated_at
+    version = settings_snapshot.get_version(str(parsed_id), namespace)
+    if version is not None:
+        return version
+
+    async with get_async_read_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "SELECT updated_at FROM settings WHERE namespace = %s AND id = %s",
+                (namespace, parsed_id)
+            )
+            result = await cur.fetchone()
+            return result['updated_at'] if result else None
+
+async def update_setting(setting_id: str, data: dict, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Updates an existing setting using the ID
+    ## With write batching on, the update is committed together with other concurrent writes
+    if write_batcher.enabled:
+        parsed_id = _parse_uuid(setting_id)
+        if parsed_id is None:
+            return None
+        return await write_batcher.update(str(parsed_id), data, namespace)
+    return await _update_setting(setting_id, data, namespace)
+
+async def _update_setting(setting_id: str, data: dict, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.update_setting, setting_id, data, namespace)
+
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        return None
+
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                """
+                UPDATE settings
+                SET data = %s, updated_at = CURRENT_TIMESTAMP
+                WHERE namespace = %s AND id = %s
+                RETURNING id, namespace, data, created_at, updated_at
+                """,
+                (Jsonb(data), namespace, parsed_id)
+            )
+            result = await cur.fetchone()
+
+    # Invalidate after commit so a concurrent read can't re-cache the old row
+    if result:
+        settings_snapshot.note_write(str(parsed_id), namespace)
+        settings_cache.invalidate(entry_key(namespace, str(parsed_id)))
+        return Setting(**result)
+    return None
+
+async def patch_setting(
+    setting_id: str,
+    merge_patch: Optional[dict] = None,
+    json_patch: Optional[list] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Optional[Setting]:
+    ## Applies a JSON merge patch or a list of JSON patch operations to a setting in one UPDATE
+    ## The document is modified inside Postgres, so only the patch is sent over the wire
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.patch_setting, setting_id, merge_patch, json_patch, namespace)
+
+    if json_patch is not None:
+        expression, params = compile_json_patch(json_patch)
+    else:
+        expression, params = compile_merge_patch(merge_patch)
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        return None
+
+    try:
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    f"""
+                    UPDATE settings
+                    SET data = {expression}, updated_at = CURRENT_TIMESTAMP
+                    WHERE namespace = %s AND id = %s
+                    RETURNING id, namespace, data, created_at, updated_at
+                    """,
+                    params + [namespace, parsed_id]
+                )
+                result = await cur.fetchone()
+    except pg_errors.RaiseException as e:
+        raise PatchConflictError(e.diag.message_primary) from e
+
+    # Invalidate after commit so a concurrent read can't re-cache the old row
+    if result:
+        settings_snapshot.note_write(str(parsed_id), namespace)
+        settings_cache.invalidate(entry_key(namespace, str(parsed_id)))
+        return Setting(**result)
+    return None
+
+async def delete_setting(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+    ## Deletes a setting using the ID
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.delete_setting, setting_id, namespace)
+
+    parsed_id = _parse_uuid(setting_id)
+    if parsed_id is None:
+        # Nothing can match an invalid ID, still idempotent
+        return True
+
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                "DELETE FROM settings WHERE namespace = %s AND id = %s",
+                (namespace, parsed_id)
+            )
+
+    settings_snapshot.note_write(str(parsed_id), namespace)
+    settings_cache.invalidate(entry_key(namespace, str(parsed_id)))
+    # Always return True for idempotency
+    return True
+
+async def apply_batch(
+    creates: List[dict],
+    updates: List[Tuple[str, dict]],
+    deletes: List[str],
+    atomic: bool = True,
+    return_settings: bool = True,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[bool, List[BatchItemResult]]:
+    ## Applies a batch of writes in one transaction, see operations.apply_batch
+    ## Batches are throughput bound, so the single threadpool hop per batch is not worth a second implementation
+    return await run_in_threadpool(
+        operations.apply_batch, creates, updates, deletes, atomic, return_settings, namespace
+    )
+
+async def _apply_write_batch(
+    creates: List[dict],
+    updates: List[Tuple[str, dict]],
+    namespace: str = DEFAULT_NAMESPACE
+) -> List[BatchItemResult]:
+    ## Best-effort, so a missing setting only fails its own update
+    _, results = await apply_batch(creates, updates, [], atomic=False, namespace=namespace)
+    return results
+
+# Group commit of concurrent creates and updates, see app.db.write_batching
+write_batcher = WriteBatcher(
+    _apply_write_batch, _create_setting, _update_setting,
+    enabled=SETTINGS_WRITE_BATCHING,
+    max_items=SETTINGS_WRITE_BATCH_MAX_ITEMS,
+    max_delay=SETTINGS_WRITE_BATCH_MAX_DELAY,
+)
+
+async def get_changes(
+    after: Optional[str] = None,
+    ids: Optional[List[str]] = None,
+    limit: int = FEED_BATCH_SIZE,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[SettingChange], str]:
+    ## Gets the settings changes after a feed position, oldest first, and the position to resume from
+    ## Without a position no changes are returned, only the position of the current end of the feed
+    ## ids restricts the changes to those settings
+    ## Raises PositionExpiredError when changes after the position have been pruned
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.get_changes, after, ids, limit, namespace)
+
+    position = decode_position(after) if after else None
+
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(*feed_query(position, ids, limit, namespace))
+            horizon, rows = read_feed(await cur.fetchall(), position)
+    if position is None:
+        return [], encode_position(horizon, 0)
+
+    changes = [
+        SettingChange(
+            position=encode_position(int(row['xid']), row['seq']),
+            op=row['op'],
+            id=row['setting_id'],
+            changed_at=row['changed_at']
+        )
+        for row in rows
+    ]
+    return changes, next_position(position, horizon, rows, limit)
+
+async def sync_settings(
+    since: Optional[str] = None,
+    limit: int = FEED_BATCH_SIZE,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[Setting], List[str], str, bool]:
+    ## Gets the settings created, updated or deleted after a watermark (a change feed position)
+    ## Returns the current state of the changed settings, the IDs of deleted ones, the next
+    ## watermark and whether more changes are waiting. Cost depends on the number of changes
+    ## read from the log, at most limit, not on the size of the table.
+    ## Without a watermark only the current one is returned, take it before a full listing.
+    if not DB_ASYNC_ENABLED:
+        return await run_in_threadpool(operations.sync_settings, since, limit, namespace)
+
+    position = decode_position(since) if since else None
+
+    async with get_async_db_connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(*feed_query(position, None, limit, namespace))
+            horizon, rows = read_feed(await cur.fetchall(), position)
+            if position is None:
+                return [], [], encode_position(horizon, 0), False
+            if any(row['op'] == 'truncate' for row in rows):
+                raise PositionExpiredError("All settings were deleted after this watermark, a full resync is needed")
+
+            # Latest state of every changed setting, settings that no longer exist are tombstones
+            ids = list(dict.fromkeys(str(row['setting_id']) for row in rows))
+            found = []
+            if ids:
+                await cur.execute(
+                    """
+                    SELECT id, namespace, data, created_at, updated_at
+                    FROM settings
+                    WHERE namespace = %s AND id = ANY(%s::uuid[])
+                    ORDER BY updated_at, id
+                    """,
+                    (namespace, ids)
+                )
+                found = await cur.fetchall()
+
+    settings = [Setting(**row) for row in found]
+    existing = {str(setting.id) for setting in settings}
+    deleted = [setting_id for setting_id in ids if setting_id not in existing]
+    return settings, deleted, next_position(position, horizon, rows, limit), len(rows) == limit
+
+async def prune_changes(retention: float = SETTINGS_CHANGES_RETENTION) -> int:
+    ## Deletes change log rows older than retention seconds, always runs in the threadpool
+    return await run_in_threadpool(operations.prune_changes, retention)
+
+async def import_settings_file(
+    file: BinaryIO, upsert: bool = False, namespace: str = DEFAULT_NAMESPACE
+) -> Dict[str, int]:
+    ## Imports settings from an NDJSON file with COPY, see transfer.import_settings
+    return await run_in_threadpool(transfer.import_settings_file, file, upsert, namespace)
+
+## History reads and restores are rare, they run the sync implementations in the threadpool
+
+async def list_revisions(
+    setting_id: str,
+    limit: int = 50,
+    before: Optional[int] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> List[SettingRevision]:
+    ## Lists the revisions of a setting newest first, see history.list_revisions
+    return await run_in_threadpool(history.list_revisions, setting_id, limit, before, namespace)
+
+async def get_revision(setting_id: str, revision: int, namespace: str = DEFAULT_NAMESPACE) -> Optional[SettingRevision]:
+    ## Gets one revision of a setting with its data, see history.get_revision
+    return await run_in_threadpool(history.get_revision, setting_id, revision, namespace)
+
+async def get_setting_as_of(setting_id: str, as_of: datetime, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Gets a setting as it was at a point in time, see history.get_setting_as_of
+    return await run_in_threadpool(history.get_setting_as_of, setting_id, as_of, namespace)
+
+async def restore_revision(setting_id: str, revision: int, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Makes a revision's data the current data of the setting, see history.restore_revision
+    return await run_in_threadpool(history.restore_revision, setting_id, revision, namespace)
@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.replicas import DATABASE_REPLICA_URLS, REPLICA_STALENESS
+
+# In-process read-through cache for single setting lookups
+SETTINGS_CACHE_ENABLED = os.getenv("SETTINGS_CACHE_ENABLED", "true").lower() == "true"
+SETTINGS_CACHE_MAX_ENTRIES = int(os.getenv("SETTINGS_CACHE_MAX_ENTRIES", "10000"))
+SETTINGS_CACHE_MAX_BYTES = int(os.getenv("SETTINGS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Seconds before an entry expires, bounds staleness if an invalidation is ever missed
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "60"))
+
+
+class SettingsCache:
+    ## Bounded LRU cache with a TTL, limited by entry count and by approximate size in bytes
+    ##
+    ## Fills race with invalidations: a reader that fetched a row before a concurrent write
+    ## committed must not cache it afterwards. Readers take a fill token before querying and
+    ## put() drops the value if any invalidation happened since the token was taken.
+    ##
+    ## A replica may not have replayed a write yet when its invalidation arrives, so values read
+    ## from a replica are also dropped if their key was invalidated (or the cache cleared) within
+    ## the last replica_window seconds, the most a replica read can lag behind.
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, enabled: bool = True,
+                 replica_window: float = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        self.replica_window = replica_window
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._epoch = 0
+        # Off until the change listener connects, nothing can be invalidated before that
+        self._available = False
+        self._invalidated_at: "OrderedDict[str, float]" = OrderedDict()  # key -> time, oldest first
+        self._cleared_at = float("-inf")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and self._available
+
+    def get(self, key: str) -> Optional[Any]:
+        ## Returns the cached value or None, counting hits and misses
+        if not self.active:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def fill_token(self) -> int:
+        ## Taken before reading from the database, passed back to put()
+        return self._epoch
+
+    def put(self, key: str, value: Any, size: int, token: int, replica: bool = False):
+        ## Caches a value unless an invalidation happened since token was taken
+        ## replica marks values read from a replica, see the class comment
+        if not self.active or size > self.max_bytes:
+            return
+        with self._lock:
+            if token != self._epoch:
+                return
+            if replica and self._recently_invalidated(key):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: str):
+        ## Drops a single entry, called after writes and on change notifications
+        with self._lock:
+            self._epoch += 1
+            if self.replica_window > 0:
+                self._track_invalidation(key)
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        ## Drops every entry
+        with self._lock:
+            self._epoch += 1
+            self._cleared_at = time.monotonic()
+            self._entries.clear()
+            self._bytes = 0
+
+    def suspend(self):
+        ## Stops serving from the cache, used while change notifications can't be received
+        self._available = False
+        self.clear()
+
+    def resume(self):
+        ## Starts serving again with an empty cache, anything cached before may have missed changes
+        self.clear()
+        self._available = True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "active": self.active,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+    def _track_invalidation(self, key: str):
+        now = time.monotonic()
+        self._invalidated_at[key] = now
+        self._invalidated_at.move_to_end(key)
+        while self._invalidated_at:
+            oldest, at = next(iter(self._invalidated_at.items()))
+            if now - at <= self.replica_window:
+                break
+            del self._invalidated_at[oldest]
+
+    def _recently_invalidated(self, key: str) -> bool:
+        now = time.monotonic()
+        if now - self._cleared_at <= self.replica_window:
+            return True
+        at = self._invalidated_at.get(key)
+        return at is not None and now - at <= self.replica_window
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+def cache_key(setting_id: Any) -> Optional[str]:
+    ## Canonical form of a setting ID, None when the ID is not a valid UUID
+    try:
+        return str(uuid.UUID(str(setting_id)))
+    except ValueError:
+        return None
+
+
+def entry_key(namespace: str, key: str) -> str:
+    ## Cache key of a setting, IDs are only unique within their namespace
+    return f"{namespace}/{key}"
+
+
+settings_cache = SettingsCache(
+    max_entries=SETTINGS_CACHE_MAX_ENTRIES,
+    max_bytes=SETTINGS_CACHE_MAX_BYTES,
+    ttl=SETTINGS_CACHE_TTL,
+    enabled=SETTINGS_CACHE_ENABLED,
+    replica_window=REPLICA_STALENESS if DATABASE_REPLICA_URLS else 0,
+)
+
+
+def invalidate_from_notification(event: dict):
+    ## Applies a change notification from the settings trigger to the cache
+    if event.get("op") == "INSERT":
+        # New settings can't be cached yet
+        return
+    key = cache_key(event.get("id"))
+    if key is None:
+        # TRUNCATE or an unknown payload, nothing cached can be trusted
+        settings_cache.clear()
+    else:
+        settings_cache.invalidate(entry_key(event.get("namespace", DEFAULT_NAMESPACE), key))
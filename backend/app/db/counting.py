@@ -0,0 +1,47 @@
+import os
+from typing import Optional
+
+## Strategies for the total row count returned with settings listings, counted within one namespace.
+## The namespace condition prunes every count to the namespace's partition of the settings table.
+##   exact      COUNT(*) of the namespace's rows (and filters)
+##   estimated  the planner's row estimate for the namespace (and filters), from the partition's
+##              statistics scaled to its current size
+##   cached     sum of the namespace's settings_row_count counters maintained by insert/delete triggers
+##   none       skip the total entirely
+
+EXACT = "exact"
+ESTIMATED = "estimated"
+CACHED = "cached"
+NONE = "none"
+
+COUNT_STRATEGIES = (EXACT, ESTIMATED, CACHED, NONE)
+
+def parse_count_strategy(value: str) -> str:
+    ## Returns the named strategy, an unknown name is a configuration error
+    strategy = value.lower()
+    if strategy not in COUNT_STRATEGIES:
+        raise ValueError(f"Unknown count strategy '{value}', expected one of {', '.join(COUNT_STRATEGIES)}")
+    return strategy
+
+# Strategy used when a listing doesn't ask for one, checked at startup
+SETTINGS_COUNT_STRATEGY = parse_count_strategy(os.getenv("SETTINGS_COUNT_STRATEGY", EXACT))
+
+# Number of counter rows per namespace, triggers spread updates across slots to avoid a single hot row
+COUNTER_SLOTS = 16
+
+CACHED_COUNT_QUERY = "SELECT SUM(row_count)::bigint AS count FROM settings_row_count WHERE namespace = %s"
+
+def count_query(strategy: str, where: str) -> str:
+    ## Exact or estimated count of the rows matching the listing's conditions
+    ## Estimates come from the planner's row estimate for the conditions
+    if strategy == ESTIMATED:
+        return f"EXPLAIN (FORMAT JSON) SELECT 1 FROM settings WHERE {where}"
+    return f"SELECT COUNT(*) AS count FROM settings WHERE {where}"
+
+def resolve_count_strategy(strategy: Optional[str], filtered: bool = False) -> str:
+    ## Returns the strategy to use, falling back to the configured default
+    ## The cached counter only knows the size of each namespace, so filtered listings count exactly instead
+    strategy = parse_count_strategy(strategy) if strategy else SETTINGS_COUNT_STRATEGY
+    if filtered and strategy == CACHED:
+        return EXACT
+    return strategy
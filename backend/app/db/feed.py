@@ -0,0 +1,183 @@
+import asyncio
+import os
+import threading
+from typing import List, Optional, Set, Tuple
+from app.db.namespaces import DEFAULT_NAMESPACE
+
+## Change feed over the settings_changes log written by the settings triggers.
+##
+## Log rows are ordered by (xid, seq), the writing transaction's ID and the log sequence. Only rows
+## of transactions older than the snapshot's xmin are read: every one of those has finished, so no
+## row can later appear before a position that was already handed out, and readers never skip a
+## change that committed out of order. A long-running transaction delays the feed until it ends.
+##
+## Positions are opaque "xid:seq" tokens, a client resumes by passing back the last one it saw.
+## Each namespace has its own feed, positions are shared: the log holds the changes of every namespace.
+
+# Maximum number of changes returned by one read
+FEED_BATCH_SIZE = 1000
+
+# Seconds between reads while waiting when no notification arrives, covers missed notifications
+# and changes held back by a long-running transaction
+SETTINGS_FEED_POLL_INTERVAL = float(os.getenv("SETTINGS_FEED_POLL_INTERVAL", "5"))
+
+# Seconds changes are kept in the log, positions older than the retained log are rejected
+SETTINGS_CHANGES_RETENTION = float(os.getenv("SETTINGS_CHANGES_RETENTION", str(7 * 24 * 3600)))
+
+# Seconds between prunes of the log by each worker, 0 leaves pruning to "python -m app.cli prune-changes"
+SETTINGS_CHANGES_PRUNE_INTERVAL = float(os.getenv("SETTINGS_CHANGES_PRUNE_INTERVAL", "3600"))
+
+# Reads the log rows after a position in one statement, so the horizon, the pruned boundary and
+# the rows all come from the same snapshot. Transactions older than the horizon (the snapshot's
+# xmin) have all finished, their rows are safe to read. Truncates apply to every setting of every
+# namespace, their rows have no namespace.
+# Always returns at least one row, change columns are null when there are no changes.
+FEED_QUERY = """
+    SELECT
+        horizon.xmin::text AS horizon,
+        pruned.xid::text AS pruned_xid,
+        pruned.seq AS pruned_seq,
+        changes.xid::text AS xid,
+        changes.seq,
+        changes.setting_id,
+        changes.op,
+        changes.changed_at
+    FROM (SELECT pg_snapshot_xmin(pg_current_snapshot()) AS xmin) AS horizon
+    LEFT JOIN settings_changes_pruned AS pruned ON true
+    LEFT JOIN LATERAL (
+        SELECT xid, seq, setting_id, op, changed_at
+        FROM settings_changes
+        WHERE (xid, seq) > (%s::xid8, %s) AND xid < horizon.xmin
+            AND (namespace = %s OR namespace IS NULL) {ids}
+        ORDER BY xid, seq
+        LIMIT %s
+    ) AS changes ON true
+    ORDER BY changes.xid, changes.seq
+"""
+FEED_IDS_FILTER = "AND (setting_id = ANY(%s::uuid[]) OR setting_id IS NULL)"
+
+# Deletes log rows past the retention and records the newest deleted position
+PRUNE_QUERY = """
+    WITH pruned AS (
+        DELETE FROM settings_changes
+        WHERE changed_at < LOCALTIMESTAMP - make_interval(secs => %s)
+        RETURNING xid, seq
+    ), boundary AS (
+        INSERT INTO settings_changes_pruned (id, xid, seq)
+        SELECT true, xid, seq FROM pruned ORDER BY xid DESC, seq DESC LIMIT 1
+        ON CONFLICT (id) DO UPDATE SET xid = EXCLUDED.xid, seq = EXCLUDED.seq
+        WHERE (settings_changes_pruned.xid, settings_changes_pruned.seq) < (EXCLUDED.xid, EXCLUDED.seq)
+    )
+    SELECT COUNT(*) AS pruned FROM pruned
+"""
+
+
+class InvalidPositionError(ValueError):
+    ## Raised when a feed position can't be parsed
+    pass
+
+
+class PositionExpiredError(ValueError):
+    ## Raised when the changes after a position can no longer be reported, the client must resync
+    pass
+
+
+def encode_position(xid: int, seq: int) -> str:
+    return f"{xid}:{seq}"
+
+
+def decode_position(position: str) -> Tuple[int, int]:
+    ## Decodes a position created by encode_position
+    try:
+        xid, seq = position.split(":")
+        xid, seq = int(xid), int(seq)
+    except (AttributeError, ValueError):
+        raise InvalidPositionError(f"Invalid feed position '{position}'")
+    if xid < 0 or seq < 0:
+        raise InvalidPositionError(f"Invalid feed position '{position}'")
+    return xid, seq
+
+
+def feed_query(
+    after: Optional[Tuple[int, int]],
+    ids: Optional[List[str]],
+    limit: int,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[str, list]:
+    ## Builds FEED_QUERY for a namespace's changes, without a position only the horizon is read
+    if after is None:
+        after, limit = (0, 0), 0
+    params = [str(after[0]), after[1], namespace]
+    if ids is not None:
+        params.append([str(setting_id) for setting_id in ids])
+    return FEED_QUERY.format(ids=FEED_IDS_FILTER if ids is not None else ""), params + [limit]
+
+
+def read_feed(rows: list, after: Optional[Tuple[int, int]]) -> Tuple[int, list]:
+    ## Splits FEED_QUERY results into the horizon and the change rows
+    ## Raises PositionExpiredError when changes after the position have been pruned
+    first = rows[0]
+    if after is not None and first["pruned_xid"] is not None \
+            and after < (int(first["pruned_xid"]), first["pruned_seq"]):
+        raise PositionExpiredError("Changes after this position have been pruned, a full resync is needed")
+    return int(first["horizon"]), [row for row in rows if row["seq"] is not None]
+
+
+def next_position(after: Tuple[int, int], horizon: int, rows: list, limit: int) -> str:
+    ## Position to resume from after reading rows
+    ## A partial read has seen every finished change, so it can skip ahead to the horizon
+    if rows and len(rows) == limit:
+        return encode_position(int(rows[-1]["xid"]), rows[-1]["seq"])
+    return encode_position(*max(after, (horizon, 0)))
+
+
+class ChangeHub:
+    ## Wakes this worker's feed readers when the settings triggers publish a notification
+    ##
+    ## ring() is called from the listener thread, waiters on any event loop are woken through it.
+    ## Readers take the generation before reading the log and wait for it to change, so a
+    ## notification that arrives between the read and the wait isn't missed.
+
+    def __init__(self):
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+
+    def ring(self):
+        with self._lock:
+            self.generation += 1
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The waiter's loop has been closed
+                pass
+
+    async def wait(self, generation: int, timeout: float) -> bool:
+        ## Waits until the generation moves past the given one, returns False on timeout
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if self.generation != generation:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"generation": self.generation, "waiters": len(self._waiters)}
+
+
+change_hub = ChangeHub()
+
+
+def wake_from_notification(event: dict):
+    ## Listener subscriber, any settings notification may mean new log rows
+    change_hub.ring()
@@ -0,0 +1,77 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+## Filters for settings listings, compiled to jsonb operators the GIN indexes on data can serve:
+##   contains   data @> value   (a JSON document the setting's data must contain)
+##   has_key    data ? key      (top level key exists)
+##   has_any    data ?| keys    (any of the top level keys exists)
+##   has_all    data ?& keys    (all of the top level keys exist)
+##   jsonpath   data @? path    (the JSONPath returns at least one item)
+
+FILTERS = ("contains", "has_key", "has_any", "has_all", "jsonpath")
+
+# Also build a jsonb_path_ops GIN index. It is smaller and faster than the default jsonb_ops
+# index for @> and @?, but can't serve the key existence operators, so idx_settings_data stays
+SETTINGS_GIN_PATH_OPS = os.getenv("SETTINGS_GIN_PATH_OPS", "false").lower() == "true"
+
+
+# Parses a jsonpath filter on its own before a listing runs, so only its errors are reported as
+# invalid filters. Every other filter value is checked by compile_filters
+JSONPATH_CHECK_QUERY = "SELECT %s::jsonpath"
+
+
+class InvalidFilterError(ValueError):
+    ## Raised when a filter value is malformed
+    pass
+
+
+def _key_list(name: str, keys: Any) -> List[str]:
+    if not isinstance(keys, list) or not keys or not all(isinstance(key, str) for key in keys):
+        raise InvalidFilterError(f"Filter '{name}' must be a non-empty list of keys")
+    return keys
+
+
+def compile_filters(filters: Optional[Dict[str, Any]]) -> Tuple[str, list]:
+    ## Returns the WHERE conditions and parameters for the given filters, ("", []) without filters
+    ## contains may be given as a parsed JSON value or as JSON text
+    conditions = []
+    params: list = []
+    for name, value in (filters or {}).items():
+        if value is None:
+            continue
+        if name == "contains":
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError as e:
+                    raise InvalidFilterError(f"Filter 'contains' must be JSON: {e}") from e
+            conditions.append("data @> %s::jsonb")
+            params.append(json.dumps(value))
+        elif name == "has_key":
+            if not isinstance(value, str):
+                raise InvalidFilterError("Filter 'has_key' must be a key")
+            conditions.append("data ? %s")
+            params.append(value)
+        elif name == "has_any":
+            conditions.append("data ?| %s::text[]")
+            params.append(_key_list(name, value))
+        elif name == "has_all":
+            conditions.append("data ?& %s::text[]")
+            params.append(_key_list(name, value))
+        elif name == "jsonpath":
+            if not isinstance(value, str):
+                raise InvalidFilterError("Filter 'jsonpath' must be a JSONPath expression")
+            conditions.append("data @? %s::jsonpath")
+            params.append(value)
+        else:
+            raise InvalidFilterError(f"Unknown filter '{name}', expected one of {', '.join(FILTERS)}")
+    return " AND ".join(conditions), params
+
+
+def plan_rows(plan) -> Optional[int]:
+    ## Reads the planner's row estimate from EXPLAIN (FORMAT JSON) output
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    rows = plan[0]["Plan"]["Plan Rows"]
+    return int(rows) if rows is not None else None
@@ -0,0 +1,199 @@
+import json
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+from app.db.connection import get_db_connection
+from app.db.cache import settings_cache, cache_key, entry_key
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.snapshot import settings_snapshot
+from app.models.setting import Setting, SettingRevision
+
+## Revision history of settings, recorded by the settings_record_history trigger created by init_db.
+## Revisions are numbered per setting (within its namespace) from 1. Each one is a full snapshot or a merge patch against
+## the previous revision; settings_revision_data rebuilds the data at any revision in Postgres.
+
+# Record revisions, off by default: recording copies each created document and diffs each update inside
+# the writing transaction. When turned off existing history is kept but nothing new is recorded
+SETTINGS_HISTORY_ENABLED = os.getenv("SETTINGS_HISTORY_ENABLED", "false").lower() == "true"
+
+# Every n-th revision of a setting stores the full data, at most n - 1 patches are applied per read
+SETTINGS_HISTORY_SNAPSHOT_INTERVAL = int(os.getenv("SETTINGS_HISTORY_SNAPSHOT_INTERVAL", "20"))
+
+# Seconds of history kept by compaction ("python -m app.cli compact-history"), 0 keeps everything
+SETTINGS_HISTORY_RETENTION = float(os.getenv("SETTINGS_HISTORY_RETENTION", str(90 * 24 * 3600)))
+
+
+class RevisionNotRestorableError(ValueError):
+    ## Raised when restoring a revision that deleted the setting
+    pass
+
+
+def _utc(value: datetime) -> datetime:
+    ## Timestamps are stored without a time zone as UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def list_revisions(
+    setting_id: str,
+    limit: int = 50,
+    before: Optional[int] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> List[SettingRevision]:
+    ## Lists the revisions of a setting newest first, without their data
+    ## before pages back through older revisions
+    key = cache_key(setting_id)
+    if key is None:
+        return []
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT revision, op, recorded_at
+                FROM settings_revisions
+                WHERE namespace = %s AND setting_id = %s AND revision < %s
+                ORDER BY revision DESC
+                LIMIT %s
+                """,
+                (namespace, key, before if before is not None else 2 ** 31 - 1, limit)
+            )
+            return [SettingRevision(**row) for row in cur.fetchall()]
+
+
+def get_revision(setting_id: str, revision: int, namespace: str = DEFAULT_NAMESPACE) -> Optional[SettingRevision]:
+    ## Gets one revision of a setting with its data rebuilt, data is None for deletions
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT revision, op, recorded_at, settings_revision_data(namespace, setting_id, revision) AS data
+                FROM settings_revisions
+                WHERE namespace = %s AND setting_id = %s AND revision = %s
+                """,
+                (namespace, key, revision)
+            )
+            result = cur.fetchone()
+            return SettingRevision(**result) if result else None
+
+
+def get_setting_as_of(setting_id: str, as_of: datetime, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Gets a setting as it was at a point in time, None if it didn't exist then
+    ## created_at and updated_at are the times of the revisions that created and last changed it
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT
+                    r.setting_id AS id,
+                    r.namespace,
+                    settings_revision_data(r.namespace, r.setting_id, r.revision) AS data,
+                    (
+                        SELECT c.recorded_at FROM settings_revisions c
+                        WHERE c.namespace = r.namespace AND c.setting_id = r.setting_id
+                            AND c.revision <= r.revision AND c.op = 'create'
+                        ORDER BY c.revision DESC
+                        LIMIT 1
+                    ) AS created_at,
+                    r.recorded_at AS updated_at
+                FROM settings_revisions r
+                WHERE r.namespace = %s AND r.setting_id = %s AND r.recorded_at <= %s
+                ORDER BY r.revision DESC
+                LIMIT 1
+                """,
+                (namespace, key, _utc(as_of))
+            )
+            result = cur.fetchone()
+    if result is None or result["data"] is None:
+        return None
+    if result["created_at"] is None:
+        # History started after the setting was created
+        result["created_at"] = result["updated_at"]
+    return Setting(**result)
+
+
+def restore_revision(setting_id: str, revision: int, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Makes a revision's data the current data of the setting, re-creating it if it was deleted
+    ## The restore is recorded as a new revision. Returns None when the revision doesn't exist.
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT settings_revision_data(namespace, setting_id, revision) AS data
+                FROM settings_revisions
+                WHERE namespace = %s AND setting_id = %s AND revision = %s
+                """,
+                (namespace, key, revision)
+            )
+            target = cur.fetchone()
+            if target is None:
+                return None
+            if target["data"] is None:
+                raise RevisionNotRestorableError(f"Revision {revision} deleted the setting, restore an earlier one")
+            cur.execute(
+                """
+                INSERT INTO settings (namespace, id, data)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (namespace, id) DO UPDATE
+                SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
+                RETURNING id, namespace, data, created_at, updated_at
+                """,
+                (namespace, key, json.dumps(target["data"]))
+            )
+            result = cur.fetchone()
+
+    # Invalidate after commit so a concurrent read can't re-cache the old row
+    settings_snapshot.note_write(key, namespace)
+    settings_cache.invalidate(entry_key(namespace, key))
+    return Setting(**result)
+
+
+def compact_history(retention: float = SETTINGS_HISTORY_RETENTION) -> int:
+    ## Deletes revisions older than retention seconds, returns how many were deleted
+    ## The latest revision of every setting is kept, and the oldest kept revision of each setting
+    ## becomes a snapshot so the remaining history can still be rebuilt
+    if retention <= 0:
+        return 0
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMPORARY TABLE history_boundary ON COMMIT DROP AS
+                SELECT
+                    namespace,
+                    setting_id,
+                    COALESCE(
+                        min(revision) FILTER (WHERE recorded_at >= LOCALTIMESTAMP - make_interval(secs => %s)),
+                        max(revision)
+                    ) AS revision
+                FROM settings_revisions
+                GROUP BY namespace, setting_id
+                """,
+                (retention,)
+            )
+            cur.execute(
+                """
+                UPDATE settings_revisions r
+                SET snapshot = settings_revision_data(r.namespace, r.setting_id, r.revision), diff = NULL
+                FROM history_boundary b
+                WHERE r.namespace = b.namespace AND r.setting_id = b.setting_id AND r.revision = b.revision
+                    AND r.snapshot IS NULL AND r.op <> 'delete'
+                """
+            )
+            cur.execute(
+                """
+                DELETE FROM settings_revisions r
+                USING history_boundary b
+                WHERE r.namespace = b.namespace AND r.setting_id = b.setting_id AND r.revision < b.revision
+                """
+            )
+            return cur.rowcount
@@ -1,19 +1,9 @@
-from app.db.connection import get_db_connection
+from app.db.migrations import migrate, HEAD
 
 def init_db():
-    ## Initialization of db tables
-    with get_db_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    id UUID PRIMARY KEY,
-                    data JSONB NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                
-                CREATE INDEX IF NOT EXISTS idx_settings_data 
-                ON settings USING GIN (data);
-            """)
-    print("Database initialized successfully")
-
+    ## Brings the database schema to the latest migration (app.db.migrations)
+    applied = migrate()
+    if applied:
+        print(f"Database migrated to version {HEAD}: {', '.join(m.name for m in applied)}")
+    else:
+        print("Database schema is up to date")
@@ -0,0 +1,169 @@
+import os
+import re
+import time
+from functools import lru_cache
+from typing import Any, Optional
+from prometheus_client import Counter, Histogram
+from psycopg import AsyncCursor
+from psycopg2.extras import RealDictCursor
+from app.db.slow_queries import slow_query_log, explain, explain_async
+from app.db.prepared import STATEMENTS
+
+## Statement and connection pool metrics for both drivers. Connections are opened with the
+## instrumented cursor classes below, so every statement run through conn.cursor() is timed
+## without changes at the call sites. Statements are labelled by their SQL command only,
+## which keeps the number of series fixed. Slow statements are also passed to the slow query log.
+
+# Record Prometheus metrics, exposed at /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Latency buckets in seconds, from sub-millisecond index lookups to multi-second scans
+DB_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Commands used as label values, anything else is counted as "other"
+COMMANDS = frozenset((
+    "select", "insert", "update", "delete", "with", "copy", "create", "alter", "set", "listen", "prepare", "execute"
+))
+
+DB_STATEMENT_DURATION = Histogram(
+    "db_statement_duration_seconds", "Time to execute a statement",
+    ["driver", "command"], buckets=DB_LATENCY_BUCKETS
+)
+DB_STATEMENT_ROWS = Counter(
+    "db_statement_rows_total", "Rows returned or affected by statements", ["driver", "command"]
+)
+DB_STATEMENT_ERRORS = Counter(
+    "db_statement_errors_total", "Statements that raised an error", ["driver", "command"]
+)
+DB_POOL_ACQUIRE = Histogram(
+    "db_pool_acquire_seconds", "Time to check out a pooled connection, including waiting for a free one",
+    ["pool"], buckets=DB_LATENCY_BUCKETS
+)
+
+_COMMAND_PATTERN = re.compile(r"\s*([A-Za-z]+)(?:\s+(\w+))?")
+
+
+def statement_command(query: Any) -> str:
+    ## The SQL command of a statement, e.g. "select", without copying the query text
+    ## EXECUTE of a prepared statement from app.db.prepared is labelled with that statement's command
+    if isinstance(query, bytes):
+        query = query[:64].decode("ascii", "ignore")
+    elif not isinstance(query, str):
+        # Composed statements (psycopg.sql) aren't rendered just to label them
+        return "other"
+    match = _COMMAND_PATTERN.match(query)
+    command = match.group(1).lower() if match else "other"
+    if command == "execute" and match.group(2) in _PREPARED_COMMANDS:
+        return _PREPARED_COMMANDS[match.group(2)]
+    return command if command in COMMANDS else "other"
+
+
+_PREPARED_COMMANDS = {name: statement_command(sql) for name, sql in STATEMENTS.items()}
+
+
+@lru_cache(maxsize=None)
+def _statement_metrics(driver: str, command: str) -> tuple:
+    ## Labelled children are looked up once, labels() takes a lock on every call
+    return (
+        DB_STATEMENT_DURATION.labels(driver, command),
+        DB_STATEMENT_ROWS.labels(driver, command),
+        DB_STATEMENT_ERRORS.labels(driver, command),
+    )
+
+
+def record_statement(driver: str, query: Any, seconds: float, rowcount: Optional[int], failed: bool = False) -> str:
+    ## Records a statement's metrics, returns its command
+    command = statement_command(query)
+    if METRICS_ENABLED:
+        duration, rows, errors = _statement_metrics(driver, command)
+        duration.observe(seconds)
+        if rowcount is not None and rowcount > 0:
+            rows.inc(rowcount)
+        if failed:
+            errors.inc()
+    return command
+
+
+def record_acquire(pool: str, seconds: float):
+    if METRICS_ENABLED:
+        DB_POOL_ACQUIRE.labels(pool).observe(seconds)
+
+
+class InstrumentedCursor(RealDictCursor):
+    ## psycopg2 dict cursor that records every statement it executes
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, vars)
+            failed = False
+            return result
+        finally:
+            self._record(query, vars, time.perf_counter() - started, failed)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().executemany(query, vars_list)
+            failed = False
+            return result
+        finally:
+            self._record(query, None, time.perf_counter() - started, failed, explainable=False)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().copy_expert(sql, file, size)
+            failed = False
+            return result
+        finally:
+            self._record(sql, None, time.perf_counter() - started, failed, explainable=False)
+
+    def _record(self, query, params, seconds: float, failed: bool, explainable: bool = True):
+        command = record_statement("psycopg2", query, seconds, self.rowcount, failed)
+        if slow_query_log.is_slow(seconds):
+            plan = None
+            if explainable and not failed and slow_query_log.claim_explain(command, query):
+                plan = explain(self.connection, query, params)
+            slow_query_log.record("psycopg2", query, params, seconds, self.rowcount, failed, plan)
+
+
+class InstrumentedAsyncCursor(AsyncCursor):
+    ## psycopg async cursor that records every statement it executes
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().execute(query, params, **kwargs)
+            failed = False
+            return result
+        finally:
+            await self._record(query, params, time.perf_counter() - started, failed)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().executemany(query, params_seq, **kwargs)
+            failed = False
+            return result
+        finally:
+            await self._record(query, None, time.perf_counter() - started, failed, explainable=False)
+
+    async def _record(self, query, params, seconds: float, failed: bool, explainable: bool = True):
+        command = record_statement("psycopg", query, seconds, self.rowcount, failed)
+        if slow_query_log.is_slow(seconds):
+            plan = None
+            if explainable and not failed and slow_query_log.claim_explain(command, query):
+                plan = await explain_async(self.connection, query, params)
+            slow_query_log.record("psycopg", query, params, seconds, self.rowcount, failed, plan)
+
+
+# Cursor classes connections are opened with
+INSTRUMENTED = METRICS_ENABLED or slow_query_log.enabled
+SYNC_CURSOR_FACTORY = InstrumentedCursor if INSTRUMENTED else RealDictCursor
+ASYNC_CURSOR_FACTORY = InstrumentedAsyncCursor if INSTRUMENTED else AsyncCursor
@@ -0,0 +1,1131 @@
+import logging
+import os
+import time
+from typing import List, NamedTuple, Optional, Tuple, Union
+from psycopg2 import errors as pg_errors
+from app.db.connection import create_connection, get_db_connection
+from app.db.counting import COUNTER_SLOTS
+from app.db.filters import SETTINGS_GIN_PATH_OPS
+from app.db.history import SETTINGS_HISTORY_ENABLED, SETTINGS_HISTORY_SNAPSHOT_INTERVAL
+from app.db.namespaces import SETTINGS_PARTITIONS
+
+logger = logging.getLogger(__name__)
+
+## Versioned schema migrations.
+##
+## Applied migrations are recorded in schema_migrations. On startup every worker runs one query
+## that reads the schema version and compares the configuration-driven parts of the schema (the
+## optional jsonb_path_ops index and the history settings) with its environment. Only when
+## something differs does it take an advisory lock, so a single worker applies the pending
+## migrations while the others wait for it and then find nothing left to do.
+##
+## Migrations are only ever appended, an applied migration is never edited. Each one runs in its
+## own transaction together with its schema_migrations row, except for index builds on existing
+## tables: those use CREATE INDEX CONCURRENTLY, which can't run in a transaction and doesn't block
+## writes. Their steps are idempotent, so a build interrupted before its version was recorded is
+## simply run again. Databases created before schema_migrations existed are adopted the same way,
+## every statement of the first migrations tolerates the objects already being there.
+
+# Apply pending migrations from the startup hook. Set to false to run "python -m app.cli migrate"
+# before a rollout instead, workers then refuse to start on an outdated schema
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
+
+# Session advisory lock held while migrating, the same key for every worker and the CLI
+MIGRATION_LOCK_ID = 7_304_123_901
+
+# Seconds between attempts to take the migration lock. Waiting inside pg_advisory_lock() would keep
+# a transaction open, which CREATE INDEX CONCURRENTLY in the migrating session waits for: a deadlock
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+
+
+class ConcurrentIndex(NamedTuple):
+    ## An index built with CREATE INDEX CONCURRENTLY, outside of a transaction
+    name: str
+    definition: str
+    unique: bool = False
+
+
+class PartitionedIndex(NamedTuple):
+    ## An index of a partitioned table, built concurrently one partition at a time
+    name: str
+    table: str
+    definition: str
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    # SQL statements, or only ConcurrentIndex steps for a non-transactional migration
+    steps: Tuple[Union[str, ConcurrentIndex], ...]
+    params: Optional[dict] = None
+
+    @property
+    def transactional(self) -> bool:
+        return not any(isinstance(step, ConcurrentIndex) for step in self.steps)
+
+
+class SchemaState(NamedTuple):
+    ## What the startup check found, version 0 when nothing was migrated yet
+    version: int
+    config_current: bool
+
+
+class SchemaOutdatedError(RuntimeError):
+    ## Raised on startup when migrations are pending and DB_MIGRATE_ON_STARTUP is off
+    pass
+
+
+SETTINGS_TABLE = """
+    CREATE TABLE IF NOT EXISTS settings (
+        id UUID PRIMARY KEY,
+        data JSONB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Row counter for the "cached" count strategy, kept current by statement triggers.
+# Creating the triggers locks out writers, so seeding the count afterwards is exact.
+SETTINGS_ROW_COUNT = """
+    CREATE TABLE IF NOT EXISTS settings_row_count (
+        slot INTEGER PRIMARY KEY,
+        row_count BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION settings_row_count_insert() RETURNS trigger AS $$
+    BEGIN
+        UPDATE settings_row_count
+        SET row_count = row_count + (SELECT COUNT(*) FROM new_rows)
+        WHERE slot = pg_backend_pid() %% %(slots)s;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_row_count_delete() RETURNS trigger AS $$
+    BEGIN
+        UPDATE settings_row_count
+        SET row_count = row_count - (SELECT COUNT(*) FROM old_rows)
+        WHERE slot = pg_backend_pid() %% %(slots)s;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_row_count_truncate() RETURNS trigger AS $$
+    BEGIN
+        UPDATE settings_row_count SET row_count = 0;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER settings_row_count_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_insert();
+
+    CREATE OR REPLACE TRIGGER settings_row_count_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_delete();
+
+    CREATE OR REPLACE TRIGGER settings_row_count_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_truncate();
+
+    INSERT INTO settings_row_count (slot, row_count)
+    SELECT slot, CASE WHEN slot = 0 THEN (SELECT COUNT(*) FROM settings) ELSE 0 END
+    FROM generate_series(0, %(slots)s - 1) AS slot
+    ON CONFLICT (slot) DO NOTHING;
+"""
+
+# Publish updates and deletes so every worker can invalidate its settings cache
+SETTINGS_NOTIFY_CHANGE = """
+    CREATE OR REPLACE FUNCTION settings_notify_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify('settings_changes', json_build_object('op', TG_OP)::text);
+        ELSE
+            PERFORM pg_notify('settings_changes', json_build_object('op', TG_OP, 'id', OLD.id)::text);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER settings_notify_change
+    AFTER UPDATE OR DELETE ON settings
+    FOR EACH ROW EXECUTE FUNCTION settings_notify_change();
+
+    CREATE OR REPLACE TRIGGER settings_notify_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_notify_change();
+"""
+
+# Change log read by the change feed (app.db.feed), one row per written setting.
+# xid is the writing transaction, readers order by (xid, seq) to never skip a change.
+# Inserts aren't covered by settings_notify_change, they ring the feed once per statement.
+SETTINGS_CHANGES = """
+    CREATE TABLE IF NOT EXISTS settings_changes (
+        seq BIGSERIAL PRIMARY KEY,
+        xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+        setting_id UUID,
+        op TEXT NOT NULL,
+        changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_settings_changes_xid_seq
+    ON settings_changes (xid, seq);
+
+    -- Pruning deletes by age, the log is appended in time order so a BRIN index is enough
+    CREATE INDEX IF NOT EXISTS idx_settings_changes_changed_at
+    ON settings_changes USING BRIN (changed_at);
+
+    -- Newest pruned position, older positions can't be served anymore
+    CREATE TABLE IF NOT EXISTS settings_changes_pruned (
+        id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+        xid XID8 NOT NULL,
+        seq BIGINT NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION settings_log_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO settings_changes (setting_id, op) SELECT id, 'create' FROM new_rows;
+            PERFORM pg_notify('settings_changes', json_build_object('op', TG_OP)::text);
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO settings_changes (setting_id, op) SELECT id, 'update' FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO settings_changes (setting_id, op) SELECT id, 'delete' FROM old_rows;
+        ELSE
+            INSERT INTO settings_changes (setting_id, op) VALUES (NULL, 'truncate');
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER settings_log_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_update
+    AFTER UPDATE ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+"""
+
+# Functions that apply JSON Merge Patch (RFC 7396) and JSON Patch (RFC 6902)
+# operations server-side, failures raise so the whole patch is rolled back
+JSONB_PATCH_FUNCTIONS = """
+    CREATE OR REPLACE FUNCTION jsonb_merge_patch(target JSONB, patch JSONB) RETURNS JSONB AS $$
+    BEGIN
+        IF jsonb_typeof(patch) IS DISTINCT FROM 'object' THEN
+            RETURN patch;
+        END IF;
+        IF jsonb_typeof(target) IS DISTINCT FROM 'object' THEN
+            target := '{}'::JSONB;
+        END IF;
+        -- Only keys named in the patch are touched, null removes a key
+        RETURN (target - ARRAY(SELECT key FROM jsonb_each(patch) WHERE jsonb_typeof(value) = 'null'))
+            || COALESCE((
+                SELECT jsonb_object_agg(key, jsonb_merge_patch(target -> key, value))
+                FROM jsonb_each(patch)
+                WHERE jsonb_typeof(value) <> 'null'
+            ), '{}'::JSONB);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_add(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    DECLARE
+        depth INTEGER := cardinality(path);
+        parent JSONB;
+        last TEXT;
+    BEGIN
+        IF depth = 0 THEN
+            RETURN value;
+        END IF;
+        parent := target #> path[1:depth - 1];
+        last := path[depth];
+        IF jsonb_typeof(parent) = 'object' THEN
+            RETURN jsonb_set(target, path, value, true);
+        ELSIF jsonb_typeof(parent) = 'array' THEN
+            IF last = '-' THEN
+                last := jsonb_array_length(parent)::TEXT;
+            ELSIF last !~ '^(0|[1-9][0-9]*)$' OR last::BIGINT > jsonb_array_length(parent) THEN
+                RAISE EXCEPTION 'Array index /% is out of range', array_to_string(path, '/');
+            END IF;
+            IF last::INTEGER < jsonb_array_length(parent) THEN
+                RETURN jsonb_insert(target, path[1:depth - 1] || last, value);
+            ELSIF depth = 1 THEN
+                RETURN parent || jsonb_build_array(value);
+            END IF;
+            RETURN jsonb_set(target, path[1:depth - 1], parent || jsonb_build_array(value));
+        END IF;
+        RAISE EXCEPTION 'Path /% does not exist', array_to_string(path[1:depth - 1], '/');
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_remove(target JSONB, path TEXT[]) RETURNS JSONB AS $$
+    BEGIN
+        IF cardinality(path) = 0 OR target #> path IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(path, '/');
+        END IF;
+        RETURN target #- path;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_replace(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    BEGIN
+        IF cardinality(path) = 0 THEN
+            RETURN value;
+        END IF;
+        IF target #> path IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(path, '/');
+        END IF;
+        RETURN jsonb_set(target, path, value, false);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_move(target JSONB, from_path TEXT[], path TEXT[]) RETURNS JSONB AS $$
+    DECLARE
+        value JSONB := target #> from_path;
+    BEGIN
+        IF value IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(from_path, '/');
+        END IF;
+        IF cardinality(path) > cardinality(from_path)
+            AND path[1:cardinality(from_path)] = from_path THEN
+            RAISE EXCEPTION 'Cannot move /% into one of its children', array_to_string(from_path, '/');
+        END IF;
+        RETURN jsonb_patch_add(jsonb_patch_remove(target, from_path), path, value);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_copy(target JSONB, from_path TEXT[], path TEXT[]) RETURNS JSONB AS $$
+    DECLARE
+        value JSONB := target #> from_path;
+    BEGIN
+        IF value IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(from_path, '/');
+        END IF;
+        RETURN jsonb_patch_add(target, path, value);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_test(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    BEGIN
+        IF target #> path IS DISTINCT FROM value THEN
+            RAISE EXCEPTION 'Test failed at /%', array_to_string(path, '/');
+        END IF;
+        RETURN target;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+# Array indexes in JSON patch paths. #>, #- and jsonb_set read "-1" as the last element and accept
+# "01", RFC 6901 only allows 0 or an unpadded positive index. Every helper now resolves its paths
+# with jsonb_patch_lookup, which treats any other array token as a path that doesn't exist.
+JSONB_PATCH_ARRAY_INDEXES = """
+    CREATE OR REPLACE FUNCTION jsonb_patch_lookup(target JSONB, path TEXT[]) RETURNS JSONB AS $$
+    DECLARE
+        node JSONB := target;
+        token TEXT;
+    BEGIN
+        FOREACH token IN ARRAY path LOOP
+            IF jsonb_typeof(node) = 'array' AND token !~ '^(0|[1-9][0-9]*)$' THEN
+                RETURN NULL;
+            END IF;
+            node := node #> ARRAY[token];
+            IF node IS NULL THEN
+                RETURN NULL;
+            END IF;
+        END LOOP;
+        RETURN node;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_add(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    DECLARE
+        depth INTEGER := cardinality(path);
+        parent JSONB;
+        last TEXT;
+    BEGIN
+        IF depth = 0 THEN
+            RETURN value;
+        END IF;
+        parent := jsonb_patch_lookup(target, path[1:depth - 1]);
+        last := path[depth];
+        IF jsonb_typeof(parent) = 'object' THEN
+            RETURN jsonb_set(target, path, value, true);
+        ELSIF jsonb_typeof(parent) = 'array' THEN
+            IF last = '-' THEN
+                last := jsonb_array_length(parent)::TEXT;
+            ELSIF last !~ '^(0|[1-9][0-9]*)$' OR last::NUMERIC > jsonb_array_length(parent) THEN
+                RAISE EXCEPTION 'Array index /% is out of range', array_to_string(path, '/');
+            END IF;
+            IF last::INTEGER < jsonb_array_length(parent) THEN
+                RETURN jsonb_insert(target, path[1:depth - 1] || last, value);
+            ELSIF depth = 1 THEN
+                RETURN parent || jsonb_build_array(value);
+            END IF;
+            RETURN jsonb_set(target, path[1:depth - 1], parent || jsonb_build_array(value));
+        END IF;
+        RAISE EXCEPTION 'Path /% does not exist', array_to_string(path[1:depth - 1], '/');
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_remove(target JSONB, path TEXT[]) RETURNS JSONB AS $$
+    BEGIN
+        IF cardinality(path) = 0 OR jsonb_patch_lookup(target, path) IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(path, '/');
+        END IF;
+        RETURN target #- path;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_replace(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    BEGIN
+        IF cardinality(path) = 0 THEN
+            RETURN value;
+        END IF;
+        IF jsonb_patch_lookup(target, path) IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(path, '/');
+        END IF;
+        RETURN jsonb_set(target, path, value, false);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_move(target JSONB, from_path TEXT[], path TEXT[]) RETURNS JSONB AS $$
+    DECLARE
+        value JSONB := jsonb_patch_lookup(target, from_path);
+    BEGIN
+        IF value IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(from_path, '/');
+        END IF;
+        IF cardinality(path) > cardinality(from_path)
+            AND path[1:cardinality(from_path)] = from_path THEN
+            RAISE EXCEPTION 'Cannot move /% into one of its children', array_to_string(from_path, '/');
+        END IF;
+        RETURN jsonb_patch_add(jsonb_patch_remove(target, from_path), path, value);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_copy(target JSONB, from_path TEXT[], path TEXT[]) RETURNS JSONB AS $$
+    DECLARE
+        value JSONB := jsonb_patch_lookup(target, from_path);
+    BEGIN
+        IF value IS NULL THEN
+            RAISE EXCEPTION 'Path /% does not exist', array_to_string(from_path, '/');
+        END IF;
+        RETURN jsonb_patch_add(target, path, value);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION jsonb_patch_test(target JSONB, path TEXT[], value JSONB) RETURNS JSONB AS $$
+    BEGIN
+        IF jsonb_patch_lookup(target, path) IS DISTINCT FROM value THEN
+            RAISE EXCEPTION 'Test failed at /%', array_to_string(path, '/');
+        END IF;
+        RETURN target;
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+"""
+
+# Revision history. Each write to a setting records a revision holding either a full
+# snapshot or a merge patch (RFC 7396) against the previous revision. Every
+# snapshot_interval-th revision is a snapshot, so rebuilding one applies a bounded number of
+# patches. The first revision after history is (re-)enabled is a snapshot as well.
+SETTINGS_HISTORY = """
+    CREATE TABLE IF NOT EXISTS settings_history_config (
+        id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+        enabled BOOLEAN NOT NULL,
+        snapshot_interval INTEGER NOT NULL CHECK (snapshot_interval > 0),
+        enabled_since TIMESTAMP NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS settings_revisions (
+        setting_id UUID NOT NULL,
+        revision INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        snapshot JSONB,
+        diff JSONB,
+        recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (setting_id, revision)
+    );
+
+    -- The merge patch turning source into target, NULL when one can't express it
+    -- (merge patches use null to remove members, so new null values need a snapshot)
+    CREATE OR REPLACE FUNCTION jsonb_merge_diff(source JSONB, target JSONB) RETURNS JSONB AS $$
+    DECLARE
+        diff JSONB := '{}'::JSONB;
+        member_key TEXT;
+        member_value JSONB;
+        member_diff JSONB;
+    BEGIN
+        FOR member_key, member_value IN SELECT * FROM jsonb_each(target) LOOP
+            CONTINUE WHEN source -> member_key = member_value;
+            IF jsonb_typeof(member_value) = 'object' AND jsonb_typeof(source -> member_key) = 'object' THEN
+                member_diff := jsonb_merge_diff(source -> member_key, member_value);
+            ELSIF jsonb_typeof(member_value) = 'null'
+                OR (jsonb_typeof(member_value) IN ('object', 'array')
+                    AND jsonb_path_exists(member_value, 'strict $.** ? (@ == null)')) THEN
+                RETURN NULL;
+            ELSE
+                member_diff := member_value;
+            END IF;
+            IF member_diff IS NULL THEN
+                RETURN NULL;
+            END IF;
+            diff := diff || jsonb_build_object(member_key, member_diff);
+        END LOOP;
+        RETURN diff || COALESCE((
+            SELECT jsonb_object_agg(removed, 'null'::JSONB)
+            FROM jsonb_object_keys(source) AS removed
+            WHERE NOT target ? removed
+        ), '{}'::JSONB);
+    END;
+    $$ LANGUAGE plpgsql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION settings_record_history() RETURNS trigger AS $$
+    DECLARE
+        config settings_history_config%ROWTYPE;
+    BEGIN
+        SELECT * INTO config FROM settings_history_config;
+        IF NOT FOUND OR NOT config.enabled THEN
+            RETURN NULL;
+        END IF;
+
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO settings_revisions (setting_id, revision, op, snapshot)
+            SELECT n.id, COALESCE(last.revision, 0) + 1, 'create', n.data
+            FROM new_rows n
+            LEFT JOIN LATERAL (
+                SELECT max(revision) AS revision FROM settings_revisions WHERE setting_id = n.id
+            ) last ON true;
+        ELSIF TG_OP = 'UPDATE' THEN
+            -- Rewrites that don't change the data aren't recorded
+            INSERT INTO settings_revisions (setting_id, revision, op, snapshot, diff)
+            SELECT id, revision, 'update', CASE WHEN diff IS NULL THEN data END, diff
+            FROM (
+                SELECT n.id, n.data, COALESCE(last.revision, 0) + 1 AS revision,
+                    CASE
+                        WHEN last.revision IS NULL
+                            OR last.recorded_at < config.enabled_since
+                            OR (last.revision + 1) % config.snapshot_interval = 0 THEN NULL
+                        ELSE jsonb_merge_diff(o.data, n.data)
+                    END AS diff
+                FROM new_rows n
+                JOIN old_rows o ON o.id = n.id
+                LEFT JOIN LATERAL (
+                    SELECT revision, recorded_at FROM settings_revisions
+                    WHERE setting_id = n.id
+                    ORDER BY revision DESC
+                    LIMIT 1
+                ) last ON true
+                WHERE n.data IS DISTINCT FROM o.data
+            ) changed;
+        ELSE
+            INSERT INTO settings_revisions (setting_id, revision, op)
+            SELECT o.id, COALESCE(last.revision, 0) + 1, 'delete'
+            FROM old_rows o
+            LEFT JOIN LATERAL (
+                SELECT max(revision) AS revision FROM settings_revisions WHERE setting_id = o.id
+            ) last ON true;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER settings_history_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+
+    CREATE OR REPLACE TRIGGER settings_history_update
+    AFTER UPDATE ON settings
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+
+    CREATE OR REPLACE TRIGGER settings_history_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+
+    -- Data of a setting at a revision, NULL when it was deleted at that revision
+    CREATE OR REPLACE FUNCTION settings_revision_data(target_id UUID, target_revision INTEGER)
+    RETURNS JSONB AS $$
+    DECLARE
+        data JSONB;
+        step RECORD;
+    BEGIN
+        FOR step IN
+            SELECT op, snapshot, diff FROM settings_revisions
+            WHERE setting_id = target_id
+                AND revision <= target_revision
+                AND revision >= (
+                    SELECT COALESCE(max(revision), 0) FROM settings_revisions
+                    WHERE setting_id = target_id AND revision <= target_revision
+                        AND (snapshot IS NOT NULL OR op = 'delete')
+                )
+            ORDER BY revision
+        LOOP
+            IF step.op = 'delete' THEN
+                data := NULL;
+            ELSIF step.snapshot IS NOT NULL THEN
+                data := step.snapshot;
+            ELSE
+                data := jsonb_merge_patch(data, step.diff);
+            END IF;
+        END LOOP;
+        RETURN data;
+    END;
+    $$ LANGUAGE plpgsql STABLE;
+"""
+
+# Namespaces (app.db.namespaces). Every table keyed by setting ID gets the namespace of its rows,
+# existing rows belong to the default namespace. Adding a column with a constant default doesn't
+# rewrite the table. Log rows of truncates have no namespace, they apply to all of them.
+SETTINGS_NAMESPACE = """
+    ALTER TABLE settings ADD COLUMN IF NOT EXISTS namespace TEXT NOT NULL DEFAULT 'default';
+
+    ALTER TABLE settings_changes ADD COLUMN IF NOT EXISTS namespace TEXT DEFAULT 'default';
+    ALTER TABLE settings_changes ALTER COLUMN namespace DROP DEFAULT;
+
+    ALTER TABLE settings_row_count ADD COLUMN IF NOT EXISTS namespace TEXT NOT NULL DEFAULT 'default';
+    ALTER TABLE settings_row_count DROP CONSTRAINT IF EXISTS settings_row_count_pkey;
+    ALTER TABLE settings_row_count ADD PRIMARY KEY (namespace, slot);
+
+    ALTER TABLE settings_revisions ADD COLUMN IF NOT EXISTS namespace TEXT NOT NULL DEFAULT 'default';
+    ALTER TABLE settings_revisions DROP CONSTRAINT IF EXISTS settings_revisions_pkey;
+    ALTER TABLE settings_revisions ADD PRIMARY KEY (namespace, setting_id, revision);
+
+    -- Counter rows are created per namespace on its first insert
+    CREATE OR REPLACE FUNCTION settings_row_count_insert() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO settings_row_count AS c (namespace, slot, row_count)
+        SELECT namespace, pg_backend_pid() %% %(slots)s, COUNT(*) FROM new_rows GROUP BY namespace
+        ON CONFLICT (namespace, slot) DO UPDATE SET row_count = c.row_count + EXCLUDED.row_count;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_row_count_delete() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO settings_row_count AS c (namespace, slot, row_count)
+        SELECT namespace, pg_backend_pid() %% %(slots)s, -COUNT(*) FROM old_rows GROUP BY namespace
+        ON CONFLICT (namespace, slot) DO UPDATE SET row_count = c.row_count + EXCLUDED.row_count;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_notify_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            PERFORM pg_notify('settings_changes', json_build_object('op', TG_OP)::text);
+        ELSE
+            PERFORM pg_notify(
+                'settings_changes',
+                json_build_object('op', TG_OP, 'id', OLD.id, 'namespace', OLD.namespace)::text
+            );
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_log_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO settings_changes (namespace, setting_id, op) SELECT namespace, id, 'create' FROM new_rows;
+            PERFORM pg_notify('settings_changes', json_build_object('op', TG_OP, 'namespace', namespace)::text)
+            FROM (SELECT DISTINCT namespace FROM new_rows) AS written;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO settings_changes (namespace, setting_id, op) SELECT namespace, id, 'update' FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO settings_changes (namespace, setting_id, op) SELECT namespace, id, 'delete' FROM old_rows;
+        ELSE
+            INSERT INTO settings_changes (namespace, setting_id, op) VALUES (NULL, NULL, 'truncate');
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION settings_record_history() RETURNS trigger AS $$
+    DECLARE
+        config settings_history_config%%ROWTYPE;
+    BEGIN
+        SELECT * INTO config FROM settings_history_config;
+        IF NOT FOUND OR NOT config.enabled THEN
+            RETURN NULL;
+        END IF;
+
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO settings_revisions (namespace, setting_id, revision, op, snapshot)
+            SELECT n.namespace, n.id, COALESCE(last.revision, 0) + 1, 'create', n.data
+            FROM new_rows n
+            LEFT JOIN LATERAL (
+                SELECT max(revision) AS revision FROM settings_revisions
+                WHERE namespace = n.namespace AND setting_id = n.id
+            ) last ON true;
+        ELSIF TG_OP = 'UPDATE' THEN
+            -- Rewrites that don't change the data aren't recorded
+            INSERT INTO settings_revisions (namespace, setting_id, revision, op, snapshot, diff)
+            SELECT namespace, id, revision, 'update', CASE WHEN diff IS NULL THEN data END, diff
+            FROM (
+                SELECT n.namespace, n.id, n.data, COALESCE(last.revision, 0) + 1 AS revision,
+                    CASE
+                        WHEN last.revision IS NULL
+                            OR last.recorded_at < config.enabled_since
+                            OR (last.revision + 1) %% config.snapshot_interval = 0 THEN NULL
+                        ELSE jsonb_merge_diff(o.data, n.data)
+                    END AS diff
+                FROM new_rows n
+                JOIN old_rows o ON o.namespace = n.namespace AND o.id = n.id
+                LEFT JOIN LATERAL (
+                    SELECT revision, recorded_at FROM settings_revisions
+                    WHERE namespace = n.namespace AND setting_id = n.id
+                    ORDER BY revision DESC
+                    LIMIT 1
+                ) last ON true
+                WHERE n.data IS DISTINCT FROM o.data
+            ) changed;
+        ELSE
+            INSERT INTO settings_revisions (namespace, setting_id, revision, op)
+            SELECT o.namespace, o.id, COALESCE(last.revision, 0) + 1, 'delete'
+            FROM old_rows o
+            LEFT JOIN LATERAL (
+                SELECT max(revision) AS revision FROM settings_revisions
+                WHERE namespace = o.namespace AND setting_id = o.id
+            ) last ON true;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP FUNCTION IF EXISTS settings_revision_data(UUID, INTEGER);
+
+    -- Data of a setting at a revision, NULL when it was deleted at that revision
+    CREATE OR REPLACE FUNCTION settings_revision_data(target_namespace TEXT, target_id UUID, target_revision INTEGER)
+    RETURNS JSONB AS $$
+    DECLARE
+        data JSONB;
+        step RECORD;
+    BEGIN
+        FOR step IN
+            SELECT op, snapshot, diff FROM settings_revisions
+            WHERE namespace = target_namespace AND setting_id = target_id
+                AND revision <= target_revision
+                AND revision >= (
+                    SELECT COALESCE(max(revision), 0) FROM settings_revisions
+                    WHERE namespace = target_namespace AND setting_id = target_id
+                        AND revision <= target_revision
+                        AND (snapshot IS NOT NULL OR op = 'delete')
+                )
+            ORDER BY revision
+        LOOP
+            IF step.op = 'delete' THEN
+                data := NULL;
+            ELSIF step.snapshot IS NOT NULL THEN
+                data := step.snapshot;
+            ELSE
+                data := jsonb_merge_patch(data, step.diff);
+            END IF;
+        END LOOP;
+        RETURN data;
+    END;
+    $$ LANGUAGE plpgsql STABLE;
+"""
+
+# Hash partitioning of settings on the namespace. The existing table becomes the partition of the
+# default namespace without copying a row: its (namespace, id) unique index becomes its primary
+# key and its indexes are attached to the matching indexes of the new parent. The other partitions
+# start empty. Attaching checks every row belongs to the partition, a sequential scan made while
+# the table is locked. Statement triggers move to the parent, which sees the rows of every partition.
+PARTITION_SETTINGS = """
+    DO $$
+    DECLARE
+        partitions INTEGER := %(partitions)s;
+        default_remainder INTEGER;
+        path_ops BOOLEAN;
+        old_trigger TEXT;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = 'settings'::regclass) = 'p' THEN
+            RETURN;
+        END IF;
+        LOCK TABLE settings IN ACCESS EXCLUSIVE MODE;
+        path_ops := to_regclass('idx_settings_data_path') IS NOT NULL;
+
+        CREATE TABLE settings_partitioned (
+            id UUID NOT NULL,
+            data JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            namespace TEXT NOT NULL DEFAULT 'default',
+            PRIMARY KEY (namespace, id)
+        ) PARTITION BY HASH (namespace);
+
+        SELECT remainder INTO default_remainder
+        FROM generate_series(0, partitions - 1) AS remainder
+        WHERE satisfies_hash_partition('settings_partitioned'::regclass, partitions, remainder, 'default'::TEXT);
+
+        FOR old_trigger IN
+            SELECT tgname FROM pg_trigger WHERE tgrelid = 'settings'::regclass AND NOT tgisinternal
+        LOOP
+            EXECUTE format('DROP TRIGGER %%I ON settings', old_trigger);
+        END LOOP;
+
+        ALTER TABLE settings DROP CONSTRAINT settings_pkey;
+        EXECUTE format(
+            'ALTER TABLE settings ADD CONSTRAINT %%I PRIMARY KEY USING INDEX settings_namespace_id',
+            'settings_p' || default_remainder || '_pkey'
+        );
+        DROP INDEX IF EXISTS idx_settings_created_at_id;
+        EXECUTE format('ALTER INDEX idx_settings_data RENAME TO %%I', 'idx_settings_data_p' || default_remainder);
+        EXECUTE format(
+            'ALTER INDEX idx_settings_namespace_created_at_id RENAME TO %%I',
+            'idx_settings_namespace_created_at_id_p' || default_remainder
+        );
+        IF path_ops THEN
+            EXECUTE format('ALTER INDEX idx_settings_data_path RENAME TO %%I', 'idx_settings_data_path_p' || default_remainder);
+        END IF;
+        EXECUTE format('ALTER TABLE settings RENAME TO %%I', 'settings_p' || default_remainder);
+
+        ALTER TABLE settings_partitioned RENAME TO settings;
+        ALTER TABLE settings RENAME CONSTRAINT settings_partitioned_pkey TO settings_pkey;
+        CREATE INDEX idx_settings_data ON settings USING GIN (data);
+        CREATE INDEX idx_settings_namespace_created_at_id ON settings (namespace, created_at DESC, id DESC);
+        IF path_ops THEN
+            CREATE INDEX idx_settings_data_path ON settings USING GIN (data jsonb_path_ops);
+        END IF;
+
+        EXECUTE format(
+            'ALTER TABLE settings ATTACH PARTITION %%I FOR VALUES WITH (MODULUS %%s, REMAINDER %%s)',
+            'settings_p' || default_remainder, partitions, default_remainder
+        );
+        FOR remainder IN 0 .. partitions - 1 LOOP
+            CONTINUE WHEN remainder = default_remainder;
+            EXECUTE format(
+                'CREATE TABLE %%I PARTITION OF settings FOR VALUES WITH (MODULUS %%s, REMAINDER %%s)',
+                'settings_p' || remainder, partitions, remainder
+            );
+        END LOOP;
+    END;
+    $$;
+
+    CREATE OR REPLACE TRIGGER settings_row_count_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_insert();
+
+    CREATE OR REPLACE TRIGGER settings_row_count_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_delete();
+
+    CREATE OR REPLACE TRIGGER settings_row_count_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_row_count_truncate();
+
+    CREATE OR REPLACE TRIGGER settings_notify_change
+    AFTER UPDATE OR DELETE ON settings
+    FOR EACH ROW EXECUTE FUNCTION settings_notify_change();
+
+    CREATE OR REPLACE TRIGGER settings_notify_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_notify_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_update
+    AFTER UPDATE ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_log_truncate
+    AFTER TRUNCATE ON settings
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_log_change();
+
+    CREATE OR REPLACE TRIGGER settings_history_insert
+    AFTER INSERT ON settings
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+
+    CREATE OR REPLACE TRIGGER settings_history_update
+    AFTER UPDATE ON settings
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+
+    CREATE OR REPLACE TRIGGER settings_history_delete
+    AFTER DELETE ON settings
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION settings_record_history();
+"""
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(1, "create_settings", (SETTINGS_TABLE,)),
+    Migration(2, "settings_indexes", (
+        ConcurrentIndex("idx_settings_data", "ON settings USING GIN (data)"),
+        ConcurrentIndex("idx_settings_created_at_id", "ON settings (created_at DESC, id DESC)"),
+    )),
+    Migration(3, "settings_row_count", (SETTINGS_ROW_COUNT,), {"slots": COUNTER_SLOTS}),
+    Migration(4, "settings_notify_change", (SETTINGS_NOTIFY_CHANGE,)),
+    Migration(5, "settings_changes", (SETTINGS_CHANGES,)),
+    Migration(6, "jsonb_patch_functions", (JSONB_PATCH_FUNCTIONS,)),
+    Migration(7, "settings_history", (SETTINGS_HISTORY,)),
+    Migration(8, "settings_namespace", (SETTINGS_NAMESPACE,), {"slots": COUNTER_SLOTS}),
+    Migration(9, "settings_namespace_indexes", (
+        ConcurrentIndex("settings_namespace_id", "ON settings (namespace, id)", unique=True),
+        ConcurrentIndex(
+            "idx_settings_namespace_created_at_id", "ON settings (namespace, created_at DESC, id DESC)"
+        ),
+    )),
+    Migration(10, "partition_settings", (PARTITION_SETTINGS,), {"partitions": SETTINGS_PARTITIONS}),
+    Migration(11, "jsonb_patch_array_indexes", (JSONB_PATCH_ARRAY_INDEXES,)),
+)
+
+HEAD = MIGRATIONS[-1].version
+
+# Optional jsonb_path_ops index for containment and JSONPath filters (SETTINGS_GIN_PATH_OPS)
+PATH_OPS_INDEX = PartitionedIndex("idx_settings_data_path", "settings", "USING GIN (data jsonb_path_ops)")
+
+# Partitions of a table that have no index attached to a partitioned index yet
+UNINDEXED_PARTITIONS_QUERY = """
+    SELECT child.relname AS partition
+    FROM pg_inherits AS part
+    JOIN pg_class AS child ON child.oid = part.inhrelid
+    WHERE part.inhparent = to_regclass(%(table)s)
+        AND NOT EXISTS (
+            SELECT 1
+            FROM pg_inherits AS attached
+            JOIN pg_index AS ix ON ix.indexrelid = attached.inhrelid
+            WHERE attached.inhparent = to_regclass(%(index)s) AND ix.indrelid = child.oid
+        )
+    ORDER BY child.relname
+"""
+
+VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# Schema version and whether the configuration-driven parts match the environment, in one round trip.
+# Fails with UndefinedTable until the version table and the history config exist
+STATE_QUERY = """
+    SELECT
+        (SELECT COALESCE(max(version), 0) FROM schema_migrations) AS version,
+        EXISTS (
+            SELECT 1 FROM pg_index
+            WHERE indexrelid = to_regclass('idx_settings_data_path') AND indisvalid
+        ) = %(path_ops)s
+        AND EXISTS (
+            SELECT 1 FROM settings_history_config
+            WHERE enabled = %(history_enabled)s AND snapshot_interval = %(snapshot_interval)s
+        ) AS config_current
+"""
+
+# Apply the configured history settings, re-enabling history starts new snapshot chains
+HISTORY_CONFIG_UPSERT = """
+    INSERT INTO settings_history_config (id, enabled, snapshot_interval, enabled_since)
+    VALUES (true, %s, %s, CURRENT_TIMESTAMP)
+    ON CONFLICT (id) DO UPDATE
+    SET enabled = EXCLUDED.enabled,
+        snapshot_interval = EXCLUDED.snapshot_interval,
+        enabled_since = CASE
+            WHEN settings_history_config.enabled THEN settings_history_config.enabled_since
+            ELSE EXCLUDED.enabled_since
+        END
+"""
+
+
+def _read_state(cur) -> SchemaState:
+    params = {
+        "path_ops": SETTINGS_GIN_PATH_OPS,
+        "history_enabled": SETTINGS_HISTORY_ENABLED,
+        "snapshot_interval": SETTINGS_HISTORY_SNAPSHOT_INTERVAL,
+    }
+    cur.execute(STATE_QUERY, params)
+    row = cur.fetchone()
+    return SchemaState(row["version"], row["config_current"])
+
+
+def schema_state() -> SchemaState:
+    ## The fast startup check, a single read on a pooled connection
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                return _read_state(cur)
+    except pg_errors.UndefinedTable:
+        return SchemaState(0, False)
+
+
+def _locked_state(cur) -> SchemaState:
+    ## The state seen after taking the lock, another worker may have migrated in the meantime
+    cur.execute(VERSION_TABLE)
+    try:
+        return _read_state(cur)
+    except pg_errors.UndefinedTable:
+        cur.execute("SELECT COALESCE(max(version), 0) AS version FROM schema_migrations")
+        return SchemaState(cur.fetchone()["version"], False)
+
+
+def _create_index_concurrently(cur, index: ConcurrentIndex):
+    ## Builds an index without blocking writes, replacing an invalid leftover of a failed build
+    cur.execute(
+        "SELECT NOT indisvalid AS invalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (index.name,)
+    )
+    row = cur.fetchone()
+    if row is not None and row["invalid"]:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+    unique = "UNIQUE " if index.unique else ""
+    cur.execute(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {index.name} {index.definition}")
+
+
+def _create_partitioned_index(cur, index: PartitionedIndex):
+    ## Builds an index of a partitioned table without blocking writes
+    ## CONCURRENTLY isn't supported on a partitioned table, so the parent index is created empty
+    ## (and invalid) on the parent only, then each partition's index is built concurrently and
+    ## attached. The parent index becomes valid once every partition has one, an interrupted
+    ## build resumes with the partitions still missing theirs.
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {index.name} ON ONLY {index.table} {index.definition}")
+    cur.execute(UNINDEXED_PARTITIONS_QUERY, {"table": index.table, "index": index.name})
+    for partition in [row["partition"] for row in cur.fetchall()]:
+        child = f"{index.name}_{partition.removeprefix(index.table + '_')}"
+        _create_index_concurrently(cur, ConcurrentIndex(child, f"ON {partition} {index.definition}"))
+        cur.execute(f"ALTER INDEX {index.name} ATTACH PARTITION {child}")
+
+
+def _apply(conn, migration: Migration):
+    ## Runs a migration and records it, in one transaction unless it builds indexes concurrently
+    conn.autocommit = not migration.transactional
+    try:
+        with conn.cursor() as cur:
+            for step in migration.steps:
+                if isinstance(step, ConcurrentIndex):
+                    _create_index_concurrently(cur, step)
+                else:
+                    cur.execute(step, migration.params)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (migration.version, migration.name)
+            )
+        if migration.transactional:
+            conn.commit()
+    except Exception:
+        if migration.transactional:
+            conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+def _apply_config(cur):
+    ## Brings the configuration-driven parts of the schema in line with the environment
+    if SETTINGS_GIN_PATH_OPS:
+        _create_partitioned_index(cur, PATH_OPS_INDEX)
+    else:
+        # Indexes of partitioned tables can't be dropped concurrently, the drop takes a short lock
+        cur.execute(f"DROP INDEX IF EXISTS {PATH_OPS_INDEX.name}")
+    cur.execute(HISTORY_CONFIG_UPSERT, (SETTINGS_HISTORY_ENABLED, SETTINGS_HISTORY_SNAPSHOT_INTERVAL))
+
+
+def _lock(cur):
+    ## Takes the migration lock, polling so no transaction stays open while another session migrates
+    started = time.perf_counter()
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (MIGRATION_LOCK_ID,))
+        if cur.fetchone()["locked"]:
+            break
+        time.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+    waited = time.perf_counter() - started
+    if waited > 1:
+        logger.info("Waited %.1f s for the migration lock", waited)
+
+
+def _up_to_date(state: SchemaState, target: int) -> bool:
+    return state.version >= target and (state.config_current or target < HEAD)
+
+
+def migrate(target: Optional[int] = None) -> List[Migration]:
+    ## Applies pending migrations up to target (default: all), returns the ones this call applied
+    ## The configuration is applied too once the schema is at head
+    target = HEAD if target is None else target
+    if _up_to_date(schema_state(), target):
+        return []
+
+    applied = []
+    # A dedicated connection: concurrent index builds need autocommit and the lock is per session
+    conn = create_connection()
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            _lock(cur)
+        try:
+            with conn.cursor() as cur:
+                state = _locked_state(cur)
+            if _up_to_date(state, target):
+                return applied
+            for migration in MIGRATIONS:
+                if state.version < migration.version <= target:
+                    started = time.perf_counter()
+                    _apply(conn, migration)
+                    applied.append(migration)
+                    logger.info(
+                        "Applied migration %d %s in %.2f s",
+                        migration.version, migration.name, time.perf_counter() - started
+                    )
+            if target >= HEAD:
+                with conn.cursor() as cur:
+                    _apply_config(cur)
+        finally:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    finally:
+        conn.close()
+    return applied
+
+
+def check_schema():
+    ## Startup check when migrations run out of band, raises if the schema is behind this code
+    state = schema_state()
+    if state.version < HEAD:
+        raise SchemaOutdatedError(
+            f"Database schema is at version {state.version}, this release needs {HEAD}. "
+            "Run \"python -m app.cli migrate\" first"
+        )
+    if not state.config_current:
+        logger.warning(
+            "SETTINGS_GIN_PATH_OPS or the history settings differ from the database, "
+            "run \"python -m app.cli migrate\" to apply them"
+        )
+
+
+def migration_status() -> List[dict]:
+    ## Every known migration with the time it was applied, None while pending
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT version, applied_at FROM schema_migrations")
+                applied = {row["version"]: row["applied_at"] for row in cur.fetchall()}
+    except pg_errors.UndefinedTable:
+        applied = {}
+    return [
+        {"version": migration.version, "name": migration.name, "applied_at": applied.get(migration.version)}
+        for migration in MIGRATIONS
+    ]
@@ -0,0 +1,17 @@
+import os
+
+## Namespaces separate the settings of tenants or applications.
+##
+## The settings table is hash partitioned on the namespace (migration 10), so every read and write
+## of a namespace touches one partition: lookups, listings, counts and pagination are pruned to it,
+## and vacuum and index bloat of a busy namespace stay in its partition. Setting IDs are unique
+## within a namespace. Routes without a namespace (/api/settings) use DEFAULT_NAMESPACE.
+
+# Namespace of the routes without one and of the settings stored before namespaces existed
+DEFAULT_NAMESPACE = "default"
+
+# Letters, digits, ".", "_" and "-", starting with a letter or digit, at most 64 characters
+NAMESPACE_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$"
+
+# Hash partitions of the settings table, fixed when the table is partitioned by its migration
+SETTINGS_PARTITIONS = int(os.getenv("SETTINGS_PARTITIONS", "16"))
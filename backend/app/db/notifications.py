@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import select
+import threading
+from typing import Callable, List, Optional
+import psycopg2
+from app.db.connection import create_connection
+
+logger = logging.getLogger(__name__)
+
+# Channel the settings triggers publish to, payloads are JSON: {"op": "UPDATE", "id": "...", "namespace": "..."}
+SETTINGS_CHANNEL = "settings_changes"
+
+
+class ChangeListener:
+    ## Background thread holding a dedicated connection that LISTENs for settings changes
+    ## and dispatches each notification to subscribers.
+    ##
+    ## Notifications sent while the connection is down are lost, so subscribers are told
+    ## when the listener disconnects and when it (re)connects to resync their state.
+
+    def __init__(self, channel: str = SETTINGS_CHANNEL, reconnect_delay: float = 1.0):
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self._subscribers: List[Callable[[dict], None]] = []
+        self._connect_callbacks: List[Callable[[], None]] = []
+        self._disconnect_callbacks: List[Callable[[], None]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._wake_r, self._wake_w = os.pipe()
+
+    def subscribe(self, callback: Callable[[dict], None]):
+        self._subscribers.append(callback)
+
+    def on_connect(self, callback: Callable[[], None]):
+        self._connect_callbacks.append(callback)
+
+    def on_disconnect(self, callback: Callable[[], None]):
+        self._disconnect_callbacks.append(callback)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"listen-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        os.write(self._wake_w, b"x")
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # Drain wake-ups left over from a previous stop()
+        while select.select([self._wake_r], [], [], 0)[0]:
+            os.read(self._wake_r, 1024)
+
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = create_connection()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                self._set_connected(True)
+
+                while not self._stop.is_set():
+                    readable, _, _ = select.select([conn, self._wake_r], [], [], 5.0)
+                    if not readable:
+                        # Idle, make sure the connection is still alive
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                    elif conn not in readable:
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                logger.warning("Lost %s listener connection: %s", self.channel, e)
+            finally:
+                if self._stop.is_set():
+                    # Deliberate shutdown, subscribers keep their state
+                    self.connected = False
+                else:
+                    self._set_connected(False)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            self._stop.wait(self.reconnect_delay)
+
+    def _set_connected(self, connected: bool):
+        if self.connected == connected:
+            return
+        self.connected = connected
+        for callback in (self._connect_callbacks if connected else self._disconnect_callbacks):
+            try:
+                callback()
+            except Exception:
+                logger.exception("Change listener callback failed")
+
+    def _dispatch(self, payload: str):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning("Ignoring malformed %s payload: %s", self.channel, payload)
+            return
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Change subscriber failed")
+
+
+change_listener = ChangeListener()
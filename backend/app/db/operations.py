@@ -1,69 +1,269 @@
 import uuid
 import json
-from typing import Optional, Tuple, List
+from datetime import datetime
+from typing import NamedTuple, Optional, Tuple, List
 from app.db.connection import get_db_connection
-from app.models.setting import Setting
+from app.db.replicas import get_read_connection, is_replica_connection
+from app.db.prepared import prepared_statements
+from app.db.pagination import decode_cursor
+from app.db.cache import settings_cache, cache_key, entry_key
+from app.db.snapshot import SnapshotPage, settings_snapshot
+from app.db.patch import compile_merge_patch, compile_json_patch, PatchConflictError
+from app.db.counting import CACHED, CACHED_COUNT_QUERY, EXACT, ESTIMATED, NONE, count_query, resolve_count_strategy
+from app.db.feed import (
+    FEED_BATCH_SIZE, PRUNE_QUERY, SETTINGS_CHANGES_RETENTION, PositionExpiredError,
+    decode_position, encode_position, feed_query, next_position, read_feed
+)
+from app.db.filters import JSONPATH_CHECK_QUERY, compile_filters, plan_rows, InvalidFilterError
+from app.db.projection import NO_DATA, WHOLE_DOCUMENT, Projection, compile_projection
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.models.setting import Setting, BatchItemResult, SettingChange
+import psycopg2
 from psycopg2 import errors as pg_errors 
 
-def create_setting(data: dict) -> Setting:
+def create_setting(data: dict, namespace: str = DEFAULT_NAMESPACE) -> Setting:
     ## Creates a new setting and uploads to db
     setting_id = str(uuid.uuid4())
     
     with get_db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO settings (id, data)
-                VALUES (%s, %s)
-                RETURNING id, data, created_at, updated_at
-                """,
-                (setting_id, json.dumps(data))
-            )
+            prepared_statements.execute(cur, "settings_insert", (namespace, setting_id, json.dumps(data)))
             result = cur.fetchone()
-            return Setting(**result)
 
-def get_all_settings(page: int = 1, limit: int = 10) -> Tuple[List[Setting], int]:
-    ## Gets paginated list of settings
+    settings_snapshot.note_write(namespace=namespace)
+    return Setting(**result)
+
+def listing_conditions(namespace: str, filters: Optional[dict]) -> Tuple[str, list, bool]:
+    ## The WHERE conditions and parameters of a namespace's listing, and whether it is filtered
+    where, params = compile_filters(filters)
+    return " AND ".join(["namespace = %s"] + ([where] if where else [])), [namespace] + params, bool(where)
+
+def _check_filters(cur, filters: Optional[dict]):
+    ## Raises InvalidFilterError for a jsonpath filter Postgres can't parse, e.g. a syntax error or a bad regex
+    jsonpath = (filters or {}).get("jsonpath")
+    if jsonpath is None:
+        return
+    try:
+        cur.execute(JSONPATH_CHECK_QUERY, (jsonpath,))
+    except (pg_errors.SyntaxError, pg_errors.DataError) as e:
+        raise InvalidFilterError(str(e).strip()) from e
+
+def _fetch_total(cur, count_strategy: str, namespace: str, where: str, params: list) -> Optional[int]:
+    ## Gets the total number of settings matching the listing's conditions using the given count strategy
+    if count_strategy == NONE:
+        return None
+    if count_strategy == CACHED:
+        cur.execute(CACHED_COUNT_QUERY, (namespace,))
+        total = cur.fetchone()['count']
+        if total is not None:
+            return total
+        # No counter for the namespace yet, fall back to an exact count
+        count_strategy = EXACT
+    cur.execute(count_query(count_strategy, where), params)
+    row = cur.fetchone()
+    return plan_rows(row['QUERY PLAN']) if count_strategy == ESTIMATED else row['count']
+
+class RawSettingsPage(NamedTuple):
+    ## A page of settings rendered to JSON by Postgres
+    data: str                                   # JSON array of the settings
+    total: Optional[int]
+    rows: int
+    last_key: Optional[Tuple[datetime, str]]    # (created_at, id) of the last row, for the next cursor
+    version: str                                # digest of the rows' IDs and versions, for the ETag
+
+# Wraps page_query, the rows are aggregated into one JSON text value so they are never parsed in Python
+RAW_PAGE_QUERY = """
+    WITH page AS ({page})
+    SELECT
+        COALESCE(json_agg(json_build_object(
+            'id', id, 'namespace', namespace, {data}'created_at', created_at, 'updated_at', updated_at
+        ) ORDER BY created_at DESC, id DESC), '[]')::text AS data,
+        COUNT(*) AS rows,
+        COALESCE(md5(string_agg(id::text || ':' || updated_at::text, ',' ORDER BY created_at DESC, id DESC)), '') AS version,
+        (array_agg(created_at ORDER BY created_at, id))[1] AS last_created_at,
+        (array_agg(id::text ORDER BY created_at, id))[1] AS last_id
+    FROM page
+"""
+
+def page_query(
+    where: str,
+    filter_params: list,
+    after: Optional[Tuple[datetime, uuid.UUID]],
+    limit: int,
+    offset: int,
+    projection: Projection = WHOLE_DOCUMENT
+) -> Tuple[str, list]:
+    ## Builds the query for one page of a listing, newest first
+    ## With a cursor position the page seeks past it on the (namespace, created_at, id) index and ignores offset
+    ## The projection (see app.db.projection) selects the data, or leaves it out
+    conditions = [where] if where else []
+    params = projection.params + list(filter_params)
+    if after:
+        conditions.append("(created_at, id) < (%s, %s)")
+        params += [after[0], str(after[1])]
+        offset = 0
+    data = f"{projection.expression} AS data, " if projection.expression else ""
+    query = f"""
+        SELECT id, namespace, {data}created_at, updated_at
+        FROM settings
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s OFFSET %s
+    """
+    return query, params + [limit, offset]
+
+# The version of RAW_PAGE_QUERY alone, for a page_query built without the data
+PAGE_VERSION_QUERY = """
+    WITH page AS ({page})
+    SELECT
+        COALESCE(md5(string_agg(id::text || ':' || updated_at::text, ',' ORDER BY created_at DESC, id DESC)), '') AS version
+    FROM page
+"""
+
+class SettingsPageVersion(NamedTuple):
+    ## The total and version of a listing page, what its ETag is built from
+    total: Optional[int]
+    version: str
+
+def raw_page_query(query: str, projection: Projection = WHOLE_DOCUMENT) -> str:
+    ## Wraps a page_query built with the projection in RAW_PAGE_QUERY
+    return RAW_PAGE_QUERY.format(page=query, data="'data', data, " if projection.expression else "")
+
+def get_all_settings(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[Setting], Optional[int]]:
+    ## Gets paginated list of a namespace's settings, newest first
+    ## With a cursor the page is fetched by seeking past the cursor's row instead of using OFFSET
+    ## filters (see app.db.filters) restrict the listing and its total to matching settings
+    ## The total is None when count_strategy is "none"
     offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace) if not filtered else None
+    if snapshot_page is not None:
+        return [Setting.model_validate_json(row) for row in snapshot_page.rows], snapshot_page.total
     
-    with get_db_connection() as conn:
+    with get_read_connection() as conn:
         with conn.cursor() as cur:
+            _check_filters(cur, filters)
             # Get total count
-            cur.execute("SELECT COUNT(*) as count FROM settings")
-            total = cur.fetchone()['count']
-            
+            total = _fetch_total(cur, count_strategy, namespace, where, filter_params)
+        
             # Get paginated data
-            cur.execute(
-                """
-                SELECT id, data, created_at, updated_at
-                FROM settings
-                ORDER BY created_at DESC
-                LIMIT %s OFFSET %s
-                """,
-                (limit, offset)
-            )
+            cur.execute(*page_query(where, filter_params, after, limit, offset))
             results = cur.fetchall()
             settings = [Setting(**row) for row in results]
-            
+        
             return settings, total
 
-def get_setting_by_id(setting_id: str) -> Optional[Setting]:
-    ## Gets a specific setting using the ID
+def get_all_settings_json(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    fields: Optional[List[str]] = None,
+    include_data: bool = True,
+    namespace: str = DEFAULT_NAMESPACE
+) -> RawSettingsPage:
+    ## Same as get_all_settings, but the page is returned as JSON text built by Postgres
+    ## Skips parsing the data and building models, for handlers that write the JSON straight out
+    ## fields (JSON pointers) select parts of each setting's data, include_data=False leaves it out
+    offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    projection = compile_projection(fields, include_data)
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    # The snapshot holds whole documents, projections are always read from the database
+    snapshot_page = None
+    if not filtered and projection is WHOLE_DOCUMENT:
+        snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace)
+    if snapshot_page is not None:
+        return raw_snapshot_page(snapshot_page)
+    query, params = page_query(where, filter_params, after, limit, offset, projection)
+    
+    with get_read_connection() as conn:
+        with conn.cursor() as cur:
+            _check_filters(cur, filters)
+            total = _fetch_total(cur, count_strategy, namespace, where, filter_params)
+            cur.execute(raw_page_query(query, projection), params)
+            row = cur.fetchone()
+    
+    last_key = (row['last_created_at'], row['last_id']) if row['rows'] else None
+    return RawSettingsPage(row['data'], total, row['rows'], last_key, row['version'])
+
+def get_settings_page_version(
+    page: int = 1,
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    count_strategy: Optional[str] = None,
+    filters: Optional[dict] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> SettingsPageVersion:
+    ## The total and version get_all_settings_json would return for the page, without reading the data
+    ## Lets conditional requests be answered before the page is rendered
+    offset = (page - 1) * limit
+    after = decode_cursor(cursor) if cursor else None
+    where, filter_params, filtered = listing_conditions(namespace, filters)
+    count_strategy = resolve_count_strategy(count_strategy, filtered=filtered)
+    snapshot_page = settings_snapshot.page(limit, offset, after, count_strategy, namespace) if not filtered else None
+    if snapshot_page is not None:
+        return SettingsPageVersion(snapshot_page.total, snapshot_page.version)
+    query, params = page_query(where, filter_params, after, limit, offset, NO_DATA)
+
+    with get_read_connection() as conn:
+        with conn.cursor() as cur:
+            _check_filters(cur, filters)
+            total = _fetch_total(cur, count_strategy, namespace, where, filter_params)
+            cur.execute(PAGE_VERSION_QUERY.format(page=query), params)
+            row = cur.fetchone()
+    return SettingsPageVersion(total, row['version'])
+
+def raw_snapshot_page(page: SnapshotPage) -> RawSettingsPage:
+    ## A listing page read from the settings snapshot, the rows are already JSON text
+    return RawSettingsPage("[" + ", ".join(page.rows) + "]", page.total, len(page.rows), page.last_key, page.version)
+
+def _cache_setting(namespace: str, key: str, setting: Setting, token: int, replica: bool = False):
+    ## Adds a setting fetched from the db to the cache, sized by its serialized JSON
+    settings_cache.put(entry_key(namespace, key), setting, len(setting.model_dump_json()), token, replica)
+
+def _invalidate_cached(setting_id: str, namespace: str = DEFAULT_NAMESPACE):
+    ## Drops a setting from this worker's cache, other workers are notified by the settings trigger
+    key = cache_key(setting_id)
+    if key is not None:
+        settings_snapshot.note_write(key, namespace)
+        settings_cache.invalidate(entry_key(namespace, key))
+
+def get_setting_by_id(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+    ## Gets a specific setting using the ID, served from the cache when possible
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    cached = settings_cache.get(entry_key(namespace, key))
+    if cached is not None:
+        return cached
+    token = settings_cache.fill_token()
+    setting = settings_snapshot.get(key, namespace)
+    if setting is not None:
+        _cache_setting(namespace, key, setting, token)
+        return setting
+
     try:
-        with get_db_connection() as conn:
+        with get_read_connection() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT id, data, created_at, updated_at
-                    FROM settings
-                    WHERE id = %s
-                    """,
-                    (setting_id,)
-                )
+                prepared_statements.execute(cur, "settings_get", (namespace, key))
                 result = cur.fetchone()
             
                 if result:
-                    return Setting(**result)
+                    setting = Setting(**result)
+                    _cache_setting(namespace, key, setting, token, is_replica_connection(conn))
+                    return setting
                 return None
     except pg_errors.InvalidTextRepresentation:
         return None
@@ -71,42 +271,352 @@ def get_setting_by_id(setting_id: str) -> Optional[Setting]:
         raise 
 
 
-def update_setting(setting_id: str, data: dict) -> Optional[Setting]:
+def setting_fields_query(projection: Projection) -> str:
+    ## The query of get_setting_fields, its parameters are the projection's, the namespace and the ID
+    return f"""
+        SELECT id, namespace, {projection.expression} AS data, created_at, updated_at
+        FROM settings
+        WHERE namespace = %s AND id = %s
+    """
+
+def get_setting_fields(
+    setting_id: str, fields: List[str], namespace: str = DEFAULT_NAMESPACE
+) -> Optional[Setting]:
+    ## Gets a setting with only the given JSON pointers of its data, selected by Postgres
+    ## Always read from the database, the cache and the snapshot hold whole documents
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    projection = compile_projection(fields)
+
+    with get_read_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(setting_fields_query(projection), projection.params + [namespace, key])
+            result = cur.fetchone()
+            return Setting(**result) if result else None
+
+def get_setting_version(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[datetime]:
+    ## Gets only the updated_at of a setting, for cheap conditional request checks
+    ## Uses the cache when possible and never reads the data column
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+    cached = settings_cache.get(entry_key(namespace, key))
+    if cached is not None:
+        return cached.updated_at
+    version = settings_snapshot.get_version(key, namespace)
+    if version is not None:
+        return version
+
+    with get_read_connection() as conn:
+        with conn.cursor() as cur:
+            prepared_statements.execute(cur, "settings_version", (namespace, key))
+            result = cur.fetchone()
+            return result['updated_at'] if result else None
+
+def update_setting(setting_id: str, data: dict, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
     ## Updates an existing setting using the ID
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                prepared_statements.execute(cur, "settings_update", (json.dumps(data), namespace, setting_id))
+                result = cur.fetchone()
+    except pg_errors.InvalidTextRepresentation:
+        return None
+    except Exception as e:
+        raise
+
+    # Invalidate after commit so a concurrent read can't re-cache the old row
+    if result:
+        _invalidate_cached(setting_id, namespace)
+        return Setting(**result)
+    return None
+
+def patch_setting(
+    setting_id: str,
+    merge_patch: Optional[dict] = None,
+    json_patch: Optional[list] = None,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Optional[Setting]:
+    ## Applies a JSON merge patch or a list of JSON patch operations to a setting in one UPDATE
+    ## The document is modified inside Postgres, so only the patch is sent over the wire
+    if json_patch is not None:
+        expression, params = compile_json_patch(json_patch)
+    else:
+        expression, params = compile_merge_patch(merge_patch)
+    key = cache_key(setting_id)
+    if key is None:
+        return None
+
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    """
+                    f"""
                     UPDATE settings
-                    SET data = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                    RETURNING id, data, created_at, updated_at
+                    SET data = {expression}, updated_at = CURRENT_TIMESTAMP
+                    WHERE namespace = %s AND id = %s
+                    RETURNING id, namespace, data, created_at, updated_at
                     """,
-                    (json.dumps(data), setting_id)
+                    params + [namespace, key]
                 )
                 result = cur.fetchone()
-                
-                if result:
-                    return Setting(**result)
-                return None
+    except pg_errors.RaiseException as e:
+        raise PatchConflictError(e.diag.message_primary) from e
+
+    # Invalidate after commit so a concurrent read can't re-cache the old row
+    if result:
+        _invalidate_cached(key, namespace)
+        return Setting(**result)
+    return None
+
+def delete_setting(setting_id: str, namespace: str = DEFAULT_NAMESPACE) -> bool:
+    ## Deletes a setting using the ID
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                prepared_statements.execute(cur, "settings_delete", (namespace, setting_id))
     except pg_errors.InvalidTextRepresentation:
-        return None
+        # Invalid ID can't match any setting, still idempotent
+        return True
     except Exception as e:
         raise
 
-def delete_setting(setting_id: str) -> bool:
-    ## Deletes a setting using the ID
+    _invalidate_cached(setting_id, namespace)
+    # Always return True for idempotency
+    return True
+
+
+class _BatchAborted(Exception):
+    ## Raised inside an atomic batch to roll back its transaction
+    pass
+
+def _mark_not_applied(results: List[BatchItemResult]) -> List[BatchItemResult]:
+    ## Marks items that didn't fail themselves as not applied after an atomic batch rolled back
+    for result in results:
+        if result.status < 400:
+            result.status = 424
+            result.error = "Not applied, another item in the batch failed"
+            result.setting = None
+    return results
+
+def _try_batch_statement(cur, statement, items: list) -> Optional[psycopg2.Error]:
+    ## Runs the statement for the items in a savepoint, returns its error after rolling back to it
+    cur.execute("SAVEPOINT batch_statement")
+    try:
+        statement(items)
+        cur.execute("RELEASE SAVEPOINT batch_statement")
+        return None
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT batch_statement")
+        return e
+
+def _run_batch_statement(cur, atomic: bool, items: List[Tuple[BatchItemResult, object]], statement):
+    ## Runs one set-based statement for the (result, value) items that haven't failed yet
+    ## Best-effort batches isolate it in a savepoint. When it fails it is run again item by item,
+    ## so only the items Postgres rejects fail: 400 for values it refuses (e.g. a \u0000 in a
+    ## document), 500 for anything else
+    items = [item for item in items if item[0].status < 400]
+    if atomic:
+        statement(items)
+        return
+    if not items or _try_batch_statement(cur, statement, items) is None:
+        return
+    for item in items:
+        error = _try_batch_statement(cur, statement, [item])
+        if error is not None:
+            result = item[0]
+            result.status = 400 if isinstance(error, psycopg2.DataError) else 500
+            result.error = str(error).strip()
+            result.setting = None
+
+def apply_batch(
+    creates: List[dict],
+    updates: List[Tuple[str, dict]],
+    deletes: List[str],
+    atomic: bool = True,
+    return_settings: bool = True,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[bool, List[BatchItemResult]]:
+    ## Applies creates, updates and deletes in one transaction, with one multi-row statement per kind
+    ## Atomic batches roll back entirely if any item fails, best-effort batches keep the items that succeeded
+    ## Returns whether anything was committed and one result per item
+    columns = "id, namespace, data, created_at, updated_at" if return_settings else "id"
+    update_columns = "s.id, s.namespace, s.data, s.created_at, s.updated_at" if return_settings else "s.id"
+
+    create_results = [
+        BatchItemResult(op="create", index=i, status=201, id=str(uuid.uuid4()))
+        for i in range(len(creates))
+    ]
+
+    update_results = []
+    update_data = {}
+    for i, (setting_id, data) in enumerate(updates):
+        key = cache_key(setting_id)
+        result = BatchItemResult(op="update", index=i, status=200, id=key or setting_id)
+        if key is None:
+            result.status = 400
+            result.error = "Invalid setting ID"
+        elif key in update_data:
+            result.status = 400
+            result.error = "Setting is updated more than once in the batch"
+        else:
+            update_data[key] = data
+        update_results.append(result)
+
+    # Deletes are idempotent, an invalid ID matches nothing and still succeeds
+    delete_results = []
+    delete_ids = []
+    delete_keys = []
+    for i, setting_id in enumerate(deletes):
+        key = cache_key(setting_id)
+        delete_results.append(BatchItemResult(op="delete", index=i, status=204, id=key or setting_id))
+        delete_ids.append(key)
+        if key is not None:
+            delete_keys.append(key)
+
+    results = create_results + update_results + delete_results
+    if atomic and any(result.status >= 400 for result in results):
+        return False, _mark_not_applied(results)
+
+    def insert_rows(items):
+        cur.execute(
+            f"""
+            INSERT INTO settings (namespace, id, data)
+            SELECT %s, * FROM unnest(%s::uuid[], %s::jsonb[])
+            RETURNING {columns}
+            """,
+            (namespace, [result.id for result, _ in items], [json.dumps(data) for _, data in items])
+        )
+        if return_settings:
+            rows = {str(row['id']): row for row in cur.fetchall()}
+            for result, _ in items:
+                result.setting = Setting(**rows[result.id])
+
+    def update_rows(items):
+        cur.execute(
+            f"""
+            UPDATE settings AS s
+            SET data = v.data, updated_at = CURRENT_TIMESTAMP
+            FROM unnest(%s::uuid[], %s::jsonb[]) AS v(id, data)
+            WHERE s.namespace = %s AND s.id = v.id
+            RETURNING {update_columns}
+            """,
+            ([result.id for result, _ in items], [json.dumps(data) for _, data in items], namespace)
+        )
+        rows = {str(row['id']): row for row in cur.fetchall()}
+        for result, _ in items:
+            if result.id not in rows:
+                result.status = 404
+                result.error = "Setting not found"
+            elif return_settings:
+                result.setting = Setting(**rows[result.id])
+
+    def delete_rows(items):
+        cur.execute(
+            "DELETE FROM settings WHERE namespace = %s AND id = ANY(%s::uuid[])",
+            (namespace, [key for _, key in items])
+        )
+
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cur:
+                if create_results:
+                    _run_batch_statement(cur, atomic, list(zip(create_results, creates)), insert_rows)
+                if update_data:
+                    _run_batch_statement(
+                        cur, atomic, [(result, update_data.get(result.id)) for result in update_results], update_rows
+                    )
+                if delete_keys:
+                    _run_batch_statement(cur, atomic, list(zip(delete_results, delete_ids)), delete_rows)
+                if atomic and any(result.status >= 400 for result in results):
+                    raise _BatchAborted()
+    except _BatchAborted:
+        return False, _mark_not_applied(results)
+
+    # Invalidate after commit so a concurrent read can't re-cache old rows
+    if any(result.status < 400 for result in create_results):
+        settings_snapshot.note_write(namespace=namespace)
+    for key in list(update_data) + delete_keys:
+        settings_snapshot.note_write(key, namespace)
+        settings_cache.invalidate(entry_key(namespace, key))
+    return any(result.status < 400 for result in results), results
+
+def get_changes(
+    after: Optional[str] = None,
+    ids: Optional[List[str]] = None,
+    limit: int = FEED_BATCH_SIZE,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[SettingChange], str]:
+    ## Gets the settings changes after a feed position, oldest first, and the position to resume from
+    ## Without a position no changes are returned, only the position of the current end of the feed
+    ## ids restricts the changes to those settings
+    ## Raises PositionExpiredError when changes after the position have been pruned
+    position = decode_position(after) if after else None
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*feed_query(position, ids, limit, namespace))
+            horizon, rows = read_feed(cur.fetchall(), position)
+    if position is None:
+        return [], encode_position(horizon, 0)
+
+    changes = [
+        SettingChange(
+            position=encode_position(int(row['xid']), row['seq']),
+            op=row['op'],
+            id=row['setting_id'],
+            changed_at=row['changed_at']
+        )
+        for row in rows
+    ]
+    return changes, next_position(position, horizon, rows, limit)
+
+def sync_settings(
+    since: Optional[str] = None,
+    limit: int = FEED_BATCH_SIZE,
+    namespace: str = DEFAULT_NAMESPACE
+) -> Tuple[List[Setting], List[str], str, bool]:
+    ## Gets the settings created, updated or deleted after a watermark (a change feed position)
+    ## Returns the current state of the changed settings, the IDs of deleted ones, the next
+    ## watermark and whether more changes are waiting. Cost depends on the number of changes
+    ## read from the log, at most limit, not on the size of the table.
+    ## Without a watermark only the current one is returned, take it before a full listing.
+    position = decode_position(since) if since else None
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(*feed_query(position, None, limit, namespace))
+            horizon, rows = read_feed(cur.fetchall(), position)
+            if position is None:
+                return [], [], encode_position(horizon, 0), False
+            if any(row['op'] == 'truncate' for row in rows):
+                raise PositionExpiredError("All settings were deleted after this watermark, a full resync is needed")
+
+            # Latest state of every changed setting, settings that no longer exist are tombstones
+            ids = list(dict.fromkeys(str(row['setting_id']) for row in rows))
+            found = []
+            if ids:
                 cur.execute(
-                    "DELETE FROM settings WHERE id = %s",
-                    (setting_id,)
+                    """
+                    SELECT id, namespace, data, created_at, updated_at
+                    FROM settings
+                    WHERE namespace = %s AND id = ANY(%s::uuid[])
+                    ORDER BY updated_at, id
+                    """,
+                    (namespace, ids)
                 )
-                # Always return True for idempotency
-                return True
-    except pg_errors.InvalidTextRepresentation:
-        raise
-    except Exception as e:
-        raise
\ No newline at end of file
+                found = cur.fetchall()
+
+    settings = [Setting(**row) for row in found]
+    existing = {str(setting.id) for setting in settings}
+    deleted = [setting_id for setting_id in ids if setting_id not in existing]
+    return settings, deleted, next_position(position, horizon, rows, limit), len(rows) == limit
+
+def prune_changes(retention: float = SETTINGS_CHANGES_RETENTION) -> int:
+    ## Deletes change log rows older than retention seconds, returns how many were deleted
+    ## Feed positions and sync watermarks from before the newest deleted row are rejected afterwards
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(PRUNE_QUERY, (retention,))
+            return cur.fetchone()['pruned']
@@ -0,0 +1,27 @@
+import base64
+import json
+from datetime import datetime
+from typing import Tuple
+from uuid import UUID
+
+## Opaque keyset cursors for settings listings.
+## A cursor encodes the (created_at, id) of the last row on a page, the next page seeks
+## past it using the idx_settings_created_at_id index instead of scanning OFFSET rows.
+
+class InvalidCursorError(ValueError):
+    ## Raised when a cursor can't be decoded
+    pass
+
+def encode_cursor(created_at: datetime, setting_id: UUID) -> str:
+    ## Encodes the sort key of a row into an opaque URL-safe cursor
+    raw = json.dumps([created_at.isoformat(), str(setting_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    ## Decodes a cursor created by encode_cursor
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, setting_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), UUID(setting_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
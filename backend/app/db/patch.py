@@ -0,0 +1,74 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+## Compiles JSON Merge Patch (RFC 7396) and JSON Patch (RFC 6902) documents into a single
+## SQL expression over the data column, built from the jsonb_* functions created by init_db.
+
+JSON_PATCH_OPS = ("add", "remove", "replace", "move", "copy", "test")
+
+
+class InvalidPatchError(ValueError):
+    ## Raised when a patch document is malformed
+    pass
+
+
+class PatchConflictError(ValueError):
+    ## Raised when a valid patch can't be applied to the current document (missing path, failed test)
+    pass
+
+
+def parse_pointer(pointer: str) -> List[str]:
+    ## Splits a JSON pointer (RFC 6901) into path tokens, "" is the whole document
+    if not isinstance(pointer, str):
+        raise InvalidPatchError("JSON pointers must be strings")
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise InvalidPatchError(f"JSON pointer '{pointer}' must start with '/'")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def compile_merge_patch(patch: Dict[str, Any]) -> Tuple[str, list]:
+    ## Returns the SQL expression and parameters that merge the patch into data
+    if not isinstance(patch, dict):
+        raise InvalidPatchError("A merge patch for a setting must be a JSON object")
+    return "jsonb_merge_patch(data, %s::jsonb)", [json.dumps(patch)]
+
+
+def compile_json_patch(operations: List[Dict[str, Any]]) -> Tuple[str, list]:
+    ## Returns the SQL expression and parameters that apply the operations to data in order
+    ## Operations that could replace the document with a non-object are rejected up front
+    if not isinstance(operations, list):
+        raise InvalidPatchError("A JSON patch must be an array of operations")
+
+    expression = "data"
+    params: list = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get("op") not in JSON_PATCH_OPS:
+            raise InvalidPatchError(f"Operation {index} must have an op of {', '.join(JSON_PATCH_OPS)}")
+        op = operation["op"]
+        if "path" not in operation:
+            raise InvalidPatchError(f"Operation {index} is missing 'path'")
+        path = parse_pointer(operation["path"])
+
+        if op in ("add", "replace", "test"):
+            if "value" not in operation:
+                raise InvalidPatchError(f"Operation {index} is missing 'value'")
+            value = operation["value"]
+            if not path and op != "test" and not isinstance(value, dict):
+                raise InvalidPatchError(f"Operation {index} would replace the setting with a non-object")
+            expression = f"jsonb_patch_{op}({expression}, %s::text[], %s::jsonb)"
+            params += [path, json.dumps(value)]
+        elif op == "remove":
+            expression = f"jsonb_patch_remove({expression}, %s::text[])"
+            params += [path]
+        else:
+            if "from" not in operation:
+                raise InvalidPatchError(f"Operation {index} is missing 'from'")
+            from_path = parse_pointer(operation["from"])
+            if not path or not from_path:
+                raise InvalidPatchError(f"Operation {index} can't {op} the whole setting")
+            expression = f"jsonb_patch_{op}({expression}, %s::text[], %s::text[])"
+            params += [from_path, path]
+
+    return expression, params
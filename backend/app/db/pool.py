@@ -0,0 +1,220 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeoutError(PoolError):
+    ## Raised when no connection becomes available within the pool timeout
+    pass
+
+
+class ConnectionPool:
+    ## Thread-safe pool of psycopg2 connections
+    ##
+    ## Connections are checked out LIFO so the warmest connection is reused first.
+    ## On checkout, connections older than max_lifetime are recycled and connections
+    ## that have been idle longer than health_check_interval are pinged first.
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_lifetime: float = 1800.0,
+        health_check_interval: float = 5.0,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle: deque = deque()  # (conn, returned_at)
+        self._created_at: Dict[int, float] = {}  # id(conn) -> creation time
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+
+        self._requests = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._connections_created = 0
+        self._connections_recycled = 0
+        self._connections_failed_check = 0
+
+    def open(self):
+        ## Pre-opens min_size connections
+        for _ in range(self.min_size):
+            with self._cond:
+                if self._size >= self.min_size:
+                    break
+                self._size += 1
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout: Optional[float] = None):
+        ## Checks out a connection, waiting up to `timeout` seconds (the pool's timeout by default)
+        ## if the pool is exhausted
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        conn = None
+        returned_at = None
+
+        with self._cond:
+            self._requests += 1
+            while True:
+                if self._closed:
+                    raise PoolError("Connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        f"Timed out after {timeout}s waiting for a database connection"
+                    )
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self._waits += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+
+        try:
+            if conn is None:
+                return self._new_connection()
+            return self._validate(conn, returned_at)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard: bool = False):
+        ## Returns a connection to the pool, closing it if it is broken, expired or discarded
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed or self._expired(conn):
+                self._size -= 1
+                self._close_connection(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        ## Closes all idle connections; in-use connections are closed when returned
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close_connection(conn)
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self) -> Dict[str, Any]:
+        ## Snapshot of pool usage, used to size the pool against worker counts
+        with self._cond:
+            return {
+                "size": self._size,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "requests": self._requests,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "total_wait_ms": round(self._total_wait * 1000, 3),
+                "avg_wait_ms": round(self._total_wait * 1000 / self._requests, 3) if self._requests else 0.0,
+                "max_wait_ms": round(self._max_wait * 1000, 3),
+                "connections_created": self._connections_created,
+                "connections_recycled": self._connections_recycled,
+                "connections_failed_health_check": self._connections_failed_check,
+            }
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._cond:
+            self._created_at[id(conn)] = time.monotonic()
+            self._connections_created += 1
+        return conn
+
+    def _validate(self, conn, returned_at: float):
+        ## Replaces expired or unhealthy connections on checkout
+        if self._expired(conn):
+            with self._cond:
+                self._connections_recycled += 1
+            self._close_connection(conn)
+            return self._new_connection()
+
+        healthy = not conn.closed
+        if healthy and time.monotonic() - returned_at > self.health_check_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                healthy = False
+
+        if not healthy:
+            with self._cond:
+                self._connections_failed_check += 1
+            self._close_connection(conn)
+            return self._new_connection()
+        return conn
+
+    def _expired(self, conn) -> bool:
+        created_at = self._created_at.get(id(conn))
+        if created_at is None or self.max_lifetime <= 0:
+            return False
+        return time.monotonic() - created_at > self.max_lifetime
+
+    def _close_connection(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
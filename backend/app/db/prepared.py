@@ -0,0 +1,100 @@
+import logging
+import os
+import re
+import threading
+import weakref
+from typing import Dict, Sequence
+from psycopg2 import errors as pg_errors
+from psycopg2 import extensions
+
+logger = logging.getLogger(__name__)
+
+## Server-side prepared statements for the single-setting queries of app.db.operations.
+##
+## Each statement is PREPAREd the first time it runs on a pooled connection and then run with
+## EXECUTE, so Postgres skips parsing and planning it again. The names prepared on a connection
+## are tracked per connection object: a recycled connection is a new object and prepares again.
+##
+## Behind a pooler in transaction mode (PgBouncer) consecutive transactions may run on different
+## server connections, where the statement is missing or already exists. The first such error
+## turns prepared statements off for the worker and the statement is re-run as plain SQL. Set
+## DB_PREPARED_STATEMENTS=false to skip the failed attempt.
+
+# Run the single-setting queries as prepared statements (psycopg2) and let psycopg prepare
+# repeated queries (async driver), false sends every query as plain SQL
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() == "true"
+
+# Executions of the same query on a connection before the async driver prepares it
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+
+SETTING_COLUMNS = "id, namespace, data, created_at, updated_at"
+
+# Every statement names the namespace, Postgres prunes it to the namespace's partition
+STATEMENTS = {
+    "settings_insert": f"""
+        INSERT INTO settings (namespace, id, data) VALUES ($1, $2::uuid, $3::jsonb) RETURNING {SETTING_COLUMNS}
+    """,
+    "settings_get": f"SELECT {SETTING_COLUMNS} FROM settings WHERE namespace = $1 AND id = $2::uuid",
+    "settings_version": "SELECT updated_at FROM settings WHERE namespace = $1 AND id = $2::uuid",
+    "settings_update": f"""
+        UPDATE settings SET data = $1::jsonb, updated_at = CURRENT_TIMESTAMP
+        WHERE namespace = $2 AND id = $3::uuid RETURNING {SETTING_COLUMNS}
+    """,
+    "settings_delete": "DELETE FROM settings WHERE namespace = $1 AND id = $2::uuid",
+}
+
+# Parameters are numbered in the order they are passed
+_PLACEHOLDER = re.compile(r"\$\d+")
+
+
+class PreparedStatements:
+    ## Runs named statements prepared once per connection, or as plain SQL when turned off
+
+    def __init__(self, statements: Dict[str, str], enabled: bool = True):
+        self.statements = statements
+        self.plain = {name: _PLACEHOLDER.sub("%s", sql) for name, sql in statements.items()}
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._prepared: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()  # conn -> prepared names
+        self.prepares = 0
+        self.executions = 0
+        self.fallbacks = 0
+
+    def execute(self, cur, name: str, params: Sequence):
+        ## Runs a statement on the cursor, preparing it on the cursor's connection first if needed
+        conn = cur.connection
+        # Only as the first statement of a transaction, so a failure can be rolled back safely
+        if not self.enabled or conn.autocommit \
+                or conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            cur.execute(self.plain[name], params)
+            return
+        with self._lock:
+            prepared = self._prepared.setdefault(conn, set())
+        try:
+            if name not in prepared:
+                cur.execute(f"PREPARE {name} AS {self.statements[name]}")
+                prepared.add(name)
+                self.prepares += 1
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+            self.executions += 1
+        except (pg_errors.InvalidSqlStatementName, pg_errors.DuplicatePreparedStatement) as e:
+            # Prepared statements don't stay on the connection, e.g. behind a transaction mode pooler
+            conn.rollback()
+            self.enabled = False
+            self.fallbacks += 1
+            logger.warning("Prepared statements turned off, they don't persist on this connection: %s", str(e).strip())
+            cur.execute(self.plain[name], params)
+
+    def stats(self) -> dict:
+        with self._lock:
+            connections = len(self._prepared)
+        return {
+            "enabled": self.enabled,
+            "connections": connections,
+            "prepares": self.prepares,
+            "executions": self.executions,
+            "fallbacks": self.fallbacks,
+        }
+
+
+prepared_statements = PreparedStatements(STATEMENTS, DB_PREPARED_STATEMENTS)
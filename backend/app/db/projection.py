@@ -0,0 +1,55 @@
+from typing import List, NamedTuple, Optional
+from app.db.patch import InvalidPatchError, parse_pointer
+
+## Field projection for settings reads, evaluated by Postgres so only the selected parts of the data
+## are sent, parsed and serialized:
+##   whole document   data
+##   fields           jsonb_build_object(pointer, data #> path, ...), the value at each JSON pointer
+##                    (RFC 6901) keyed by the pointer as given, null when the path doesn't exist
+##   no data          the data column isn't selected at all, so it isn't read or detoasted
+## Selecting fields still detoasts each stored document once to evaluate the paths.
+
+# Most JSON pointers a single read may select, jsonb_build_object takes at most 100 arguments
+MAX_FIELDS = 50
+
+
+class InvalidFieldsError(ValueError):
+    ## Raised when the selected fields are malformed
+    pass
+
+
+class Projection(NamedTuple):
+    ## The data a read selects: an SQL expression and its parameters, no expression leaves data out
+    expression: Optional[str]
+    params: list
+
+
+WHOLE_DOCUMENT = Projection("data", [])
+NO_DATA = Projection(None, [])
+
+
+def compile_projection(fields: Optional[List[str]] = None, include_data: bool = True) -> Projection:
+    ## Returns the projection for the given JSON pointers, the whole document without any
+    if not include_data:
+        if fields:
+            raise InvalidFieldsError("Fields can't be selected when the data is left out")
+        return NO_DATA
+    if fields is None:
+        return WHOLE_DOCUMENT
+    if not fields:
+        raise InvalidFieldsError("Select at least one field")
+    # Repeated pointers would select the same key twice
+    fields = list(dict.fromkeys(fields))
+    if len(fields) > MAX_FIELDS:
+        raise InvalidFieldsError(f"At most {MAX_FIELDS} fields can be selected, got {len(fields)}")
+
+    arguments = []
+    params: list = []
+    for pointer in fields:
+        try:
+            path = parse_pointer(pointer)
+        except InvalidPatchError as e:
+            raise InvalidFieldsError(str(e)) from e
+        arguments.append("%s::text, data #> %s::text[]")
+        params += [pointer, path]
+    return Projection(f"jsonb_build_object({', '.join(arguments)})", params)
@@ -0,0 +1,302 @@
+import asyncio
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator, Generator, List, Optional, Tuple
+import psycopg
+import psycopg2
+from prometheus_client import Counter, Gauge
+from psycopg2.pool import PoolError
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from app.db.async_connection import get_async_db_connection, new_async_pool
+from app.db.connection import create_connection, get_db_connection, get_db_params, new_pool, pooled_connection
+from app.db.instrumentation import METRICS_ENABLED, record_acquire
+from app.db.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+## Read routing across streaming replicas of the primary.
+##
+## Single setting reads and listings (get_read_connection / get_async_read_connection) are spread
+## round-robin over the replicas, everything else uses the primary. A monitor thread measures each
+## replica's replay lag every DB_REPLICA_LAG_CHECK_INTERVAL; replicas that are unreachable, lag
+## more than DB_REPLICA_MAX_LAG or haven't been measured recently are skipped, and reads go to the
+## primary when none is left. A reader that can't get a replica connection within
+## DB_REPLICA_ACQUIRE_TIMEOUT reads from the primary as well.
+##
+## Lag is 0 while a replica has replayed all WAL it received, otherwise the age of the last
+## replayed transaction. WAL still in flight from the primary isn't seen, so the bound is
+## approximate. A server that isn't in recovery (e.g. a promoted replica) has no lag.
+
+# Comma-separated postgresql:// URLs of read replicas, reads stay on the primary when empty
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# Seconds of replay lag above which a replica is skipped
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+
+# Seconds between lag measurements, a replica not measured for two intervals is skipped
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "1"))
+
+# Seconds to wait for a replica connection before reading from the primary instead
+DB_REPLICA_ACQUIRE_TIMEOUT = float(os.getenv("DB_REPLICA_ACQUIRE_TIMEOUT", "1"))
+
+# Seconds after a client's write during which its reads go to the primary (read-your-writes)
+DB_READ_YOUR_WRITES_WINDOW = float(os.getenv("DB_READ_YOUR_WRITES_WINDOW", str(DB_REPLICA_MAX_LAG)))
+
+# How far behind the primary a replica read can be: the lag limit plus the age of the measurement
+REPLICA_STALENESS = DB_REPLICA_MAX_LAG + 2 * DB_REPLICA_LAG_CHECK_INTERVAL
+
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8
+    END AS lag
+"""
+
+PRIMARY = "primary"
+
+DB_READ_ROUTING = Counter(
+    "db_read_routing_total", "Reads routed to a replica or to the primary, by the reason for the choice",
+    ["target", "reason"]
+)
+DB_REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds", "Replay lag of each replica when last measured", ["replica"], multiprocess_mode="max"
+)
+DB_REPLICA_AVAILABLE = Gauge(
+    "db_replica_available", "1 while a replica can take reads (reachable and within the lag limit)",
+    ["replica"], multiprocess_mode="min"
+)
+
+# Set for requests whose reads must see the client's own recent writes
+primary_reads: ContextVar[bool] = ContextVar("primary_reads", default=False)
+
+_replica_connections: "weakref.WeakSet" = weakref.WeakSet()
+
+
+def is_replica_connection(conn) -> bool:
+    ## Whether a connection from get_read_connection reads from a replica, whose data may lag
+    return conn in _replica_connections
+
+
+class Replica:
+    ## One read replica with its lazily opened connection pools and its last measured lag
+
+    def __init__(self, url: str):
+        params = get_db_params(url)
+        self.name = f"{params['host']}:{params['port']}/{params['dbname']}"
+        # Fail over to the primary quickly when a replica doesn't answer
+        self.params = {**params, "connect_timeout": max(1, math.ceil(DB_REPLICA_ACQUIRE_TIMEOUT))}
+        self.lag: Optional[float] = None
+        self.checked_at = float("-inf")
+        self.error: Optional[str] = None
+        self._pool: Optional[ConnectionPool] = None
+        self._pool_lock = threading.Lock()
+        self._async_pool: Optional[AsyncConnectionPool] = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._monitor_conn = None
+
+    def usable(self, max_lag: float, max_age: float, now: float) -> bool:
+        return self.lag is not None and self.lag <= max_lag and now - self.checked_at <= max_age
+
+    def pool(self) -> ConnectionPool:
+        with self._pool_lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = new_pool(lambda: create_connection(self.params))
+                self._pool.open()
+            return self._pool
+
+    async def async_pool(self) -> AsyncConnectionPool:
+        ## A pool is bound to the loop that opened it, so a new loop gets a new pool
+        loop = asyncio.get_running_loop()
+        if self._async_pool is None or self._async_pool.closed or self._async_loop is not loop:
+            self._async_pool = new_async_pool(self.params)
+            self._async_loop = loop
+            await self._async_pool.open(wait=False)
+        return self._async_pool
+
+    def measure(self):
+        ## Reads the replay lag on the monitor's own connection, reconnecting after a failure
+        try:
+            if self._monitor_conn is None or self._monitor_conn.closed:
+                self._monitor_conn = psycopg2.connect(**self.params)
+                self._monitor_conn.autocommit = True
+            with self._monitor_conn.cursor() as cur:
+                cur.execute(LAG_QUERY)
+                lag = cur.fetchone()[0]
+            # No transaction replayed yet while WAL is pending, the lag is unknown
+            self.lag = max(0.0, lag) if lag is not None else math.inf
+            self.error = None
+        except psycopg2.Error as e:
+            self.mark_failed(e)
+            if self._monitor_conn is not None:
+                self._monitor_conn.close()
+                self._monitor_conn = None
+        self.checked_at = time.monotonic()
+
+    def mark_failed(self, error: Exception):
+        self.lag = None
+        self.error = str(error).strip()
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+        if self._monitor_conn is not None:
+            self._monitor_conn.close()
+            self._monitor_conn = None
+
+    async def close_async(self):
+        if self._async_pool is not None and self._async_loop is asyncio.get_running_loop():
+            await self._async_pool.close()
+        self._async_pool = None
+        self._async_loop = None
+
+
+class ReplicaRouter:
+    ## Picks the replica for each read and runs the thread measuring replica lag
+
+    def __init__(self, urls: List[str], max_lag: float, check_interval: float):
+        self.replicas = [Replica(url) for url in urls]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._turn = itertools.count()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def choose(self) -> Tuple[Optional[Replica], str]:
+        ## The replica for the next read, or None for the primary, with the reason for the choice
+        if primary_reads.get():
+            return None, "read_your_writes"
+        now = time.monotonic()
+        usable = [replica for replica in self.replicas if replica.usable(self.max_lag, 2 * self.check_interval, now)]
+        if usable:
+            return usable[next(self._turn) % len(usable)], "replica"
+        if any(replica.lag is not None for replica in self.replicas):
+            return None, "lagging"
+        return None, "unavailable"
+
+    def record(self, replica: Optional[Replica], reason: str):
+        if METRICS_ENABLED:
+            DB_READ_ROUTING.labels(replica.name if replica else PRIMARY, reason).inc()
+
+    def check_lag(self):
+        ## Measures every replica once
+        for replica in self.replicas:
+            replica.measure()
+            if METRICS_ENABLED:
+                if replica.lag is not None and math.isfinite(replica.lag):
+                    DB_REPLICA_LAG.labels(replica.name).set(replica.lag)
+                DB_REPLICA_AVAILABLE.labels(replica.name).set(
+                    1 if replica.lag is not None and replica.lag <= self.max_lag else 0
+                )
+
+    def start(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="replica-lag-monitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for replica in self.replicas:
+            replica.close()
+
+    async def close_async(self):
+        for replica in self.replicas:
+            await replica.close_async()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check_lag()
+            except Exception:
+                logger.exception("Measuring replica lag failed")
+            self._stop.wait(self.check_interval)
+
+    def stats(self) -> List[dict]:
+        now = time.monotonic()
+        return [
+            {
+                "replica": replica.name,
+                "usable": replica.usable(self.max_lag, 2 * self.check_interval, now),
+                "lag_seconds": replica.lag if replica.lag is None or math.isfinite(replica.lag) else None,
+                "checked_seconds_ago": round(now - replica.checked_at, 3) if math.isfinite(replica.checked_at) else None,
+                "error": replica.error,
+            }
+            for replica in self.replicas
+        ]
+
+
+replica_router = ReplicaRouter(DATABASE_REPLICA_URLS, DB_REPLICA_MAX_LAG, DB_REPLICA_LAG_CHECK_INTERVAL)
+
+
+@contextmanager
+def get_read_connection() -> Generator:
+    ## Like get_db_connection, on a replica when one can serve the read
+    ## Only for reads that may lag behind the primary by up to REPLICA_STALENESS seconds
+    replica = None
+    if replica_router.enabled:
+        replica, reason = replica_router.choose()
+        if replica is not None:
+            try:
+                pool = replica.pool()
+                started = time.perf_counter()
+                conn = pool.getconn(timeout=DB_REPLICA_ACQUIRE_TIMEOUT)
+                record_acquire("replica", time.perf_counter() - started)
+            except (psycopg2.Error, PoolError) as e:
+                replica.mark_failed(e)
+                replica, reason = None, "unavailable"
+        replica_router.record(replica, reason)
+
+    if replica is None:
+        with get_db_connection() as conn:
+            yield conn
+        return
+    _replica_connections.add(conn)
+    with pooled_connection(pool, conn):
+        yield conn
+
+
+@asynccontextmanager
+async def get_async_read_connection() -> AsyncGenerator:
+    ## Like get_async_db_connection, on a replica when one can serve the read
+    replica = None
+    if replica_router.enabled:
+        replica, reason = replica_router.choose()
+        if replica is not None:
+            try:
+                pool = await replica.async_pool()
+                started = time.perf_counter()
+                conn = await pool.getconn(timeout=DB_REPLICA_ACQUIRE_TIMEOUT)
+                record_acquire("replica", time.perf_counter() - started)
+            except (psycopg.Error, PoolTimeout) as e:
+                replica.mark_failed(e)
+                replica, reason = None, "unavailable"
+        replica_router.record(replica, reason)
+
+    if replica is None:
+        async with get_async_db_connection() as conn:
+            yield conn
+        return
+    _replica_connections.add(conn)
+    try:
+        # Commits or rolls back, pooled connections aren't closed on exit
+        async with conn:
+            yield conn
+    finally:
+        await pool.putconn(conn)
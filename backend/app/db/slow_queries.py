@@ -0,0 +1,198 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, List, Optional
+import psycopg
+import psycopg2
+from psycopg.rows import tuple_row
+
+logger = logging.getLogger(__name__)
+
+## Slow statement log, fed by the instrumented cursors in app.db.instrumentation.
+##
+## Statements slower than the threshold are logged and kept in a bounded in-memory buffer for
+## /admin/slow-queries. For some slow reads the plan is captured with EXPLAIN (ANALYZE, BUFFERS),
+## which runs the query a second time on the same connection inside a savepoint, so a failing
+## EXPLAIN never affects the caller's transaction. Other statements are never re-run, since
+## ANALYZE would apply their writes again.
+
+# Seconds a statement must take to be logged, 0 disables the slow query log
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD", "0"))
+
+# Slow statements kept in memory by each worker, the oldest are dropped first
+SLOW_QUERY_BUFFER_SIZE = int(os.getenv("SLOW_QUERY_BUFFER_SIZE", "100"))
+
+# Minimum seconds between two EXPLAIN captures by a worker, 0 disables them.
+# Slow SELECTs in between are logged without a plan, which bounds the extra load.
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "60"))
+
+# Log parameter values, otherwise only their types are logged since they may hold user data
+SLOW_QUERY_LOG_PARAMS = os.getenv("SLOW_QUERY_LOG_PARAMS", "false").lower() == "true"
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS) "
+
+_WHITESPACE = re.compile(r"\s+")
+# Data-modifying statements a WITH query may contain
+_WRITES = re.compile(r"\b(insert|update|delete|merge)\b", re.IGNORECASE)
+
+
+def _read_only(command: str, query: Any) -> bool:
+    ## SELECTs, and WITH queries without data-modifying statements, can be safely run again
+    ## command is the statement's command as labelled by app.db.instrumentation, for EXECUTE of a
+    ## prepared statement that is the prepared statement's command
+    if command == "select":
+        return True
+    if command == "with":
+        text = query.decode("utf-8", "replace") if isinstance(query, bytes) else query
+        return isinstance(text, str) and _WRITES.search(text) is None
+    return False
+
+
+def _query_text(query: Any) -> str:
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return _WHITESPACE.sub(" ", str(query)).strip()
+
+
+def _loggable(value: Any, redact: bool) -> Any:
+    if redact:
+        return f"<{type(value).__name__}>"
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _log_params(params: Any, redact: bool) -> Any:
+    ## Parameters as JSON values, redacted parameters are replaced with their type names
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {name: _loggable(value, redact) for name, value in params.items()}
+    return [_loggable(value, redact) for value in params]
+
+
+class SlowQueryLog:
+    ## Thread-safe ring buffer of slow statements
+
+    def __init__(self, threshold: float, buffer_size: int, explain_interval: float, log_params: bool):
+        self.threshold = threshold
+        self.explain_interval = explain_interval
+        self.log_params = log_params
+        self._lock = threading.Lock()
+        self._entries: deque = deque(maxlen=buffer_size)
+        self._last_explain = float("-inf")
+        self.logged = 0
+        self.explained = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def is_slow(self, seconds: float) -> bool:
+        return 0 < self.threshold <= seconds
+
+    def claim_explain(self, command: str, query: Any) -> bool:
+        ## Whether to capture the plan of a slow statement, at most once per interval
+        if self.explain_interval <= 0 or not _read_only(command, query):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_explain < self.explain_interval:
+                return False
+            self._last_explain = now
+            return True
+
+    def record(self, driver: str, query: Any, params: Any, seconds: float, rows: Optional[int],
+               failed: bool, plan: Optional[str] = None):
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "driver": driver,
+            "query": _query_text(query),
+            "params": _log_params(params, redact=not self.log_params),
+            "duration_ms": round(seconds * 1000, 3),
+            "rows": rows if rows is not None and rows >= 0 else None,
+            "failed": failed,
+            "plan": plan,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            self.logged += 1
+            if plan is not None:
+                self.explained += 1
+        logger.warning(
+            "Slow query (%.1f ms, %s rows%s): %s params=%s",
+            entry["duration_ms"], entry["rows"], ", failed" if failed else "", entry["query"], entry["params"]
+        )
+
+    def entries(self, limit: Optional[int] = None) -> List[dict]:
+        ## Slow statements newest first
+        with self._lock:
+            entries = list(self._entries)
+        entries.reverse()
+        return entries[:limit] if limit is not None else entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "threshold_ms": self.threshold * 1000,
+                "buffered": len(self._entries),
+                "buffer_size": self._entries.maxlen,
+                "logged": self.logged,
+                "explained": self.explained,
+            }
+
+
+slow_query_log = SlowQueryLog(
+    SLOW_QUERY_THRESHOLD, SLOW_QUERY_BUFFER_SIZE, SLOW_QUERY_EXPLAIN_INTERVAL, SLOW_QUERY_LOG_PARAMS
+)
+
+
+def _explain_statement(query: Any) -> Any:
+    if isinstance(query, bytes):
+        return EXPLAIN_PREFIX.encode() + query
+    return EXPLAIN_PREFIX + query
+
+
+def explain(conn, query: Any, params: Any) -> str:
+    ## Captures the plan of a psycopg2 statement on its connection
+    savepoint = not conn.autocommit
+    # A plain cursor, so the EXPLAIN itself isn't recorded
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        try:
+            if savepoint:
+                cur.execute("SAVEPOINT slow_query_explain")
+            cur.execute(_explain_statement(query), params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+            if savepoint:
+                cur.execute("RELEASE SAVEPOINT slow_query_explain")
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            return f"EXPLAIN failed: {str(e).strip()}"
+
+
+async def explain_async(conn, query: Any, params: Any) -> str:
+    ## Captures the plan of a psycopg statement on its connection
+    try:
+        if conn.autocommit:
+            return await _run_explain(conn, query, params)
+        async with conn.transaction():
+            return await _run_explain(conn, query, params)
+    except psycopg.Error as e:
+        return f"EXPLAIN failed: {str(e).strip()}"
+
+
+async def _run_explain(conn, query: Any, params: Any) -> str:
+    # A plain cursor, so the EXPLAIN itself isn't recorded
+    async with psycopg.AsyncCursor(conn, row_factory=tuple_row) as cur:
+        await cur.execute(_explain_statement(query), params)
+        return "\n".join(row[0] for row in await cur.fetchall())
@@ -0,0 +1,560 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Set, Tuple
+from uuid import UUID
+import psycopg2
+import psycopg2.extensions
+from prometheus_client import Counter
+from app.db.connection import get_db_connection
+from app.db.counting import NONE
+from app.db.instrumentation import METRICS_ENABLED
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.models.setting import Setting
+
+logger = logging.getLogger(__name__)
+
+## Memory-mapped snapshot of the settings of the default namespace, shared by every worker on a host.
+##
+## "python -m app.cli build-snapshot" dumps the namespace from one REPEATABLE READ transaction into a
+## file and atomically replaces the previous one. Workers map the file read-only, so its pages sit
+## once in the OS page cache however many workers read them, and serve single setting reads and
+## unfiltered listings from it without a query. Each worker re-checks the file every
+## SETTINGS_SNAPSHOT_CHECK_INTERVAL and maps a rebuilt one in place of the old.
+##
+## Reads never return data older than the database: the file records the transaction snapshot it
+## was built from, and a worker that maps it reads the IDs written since from the change log, then
+## keeps the set current from change notifications (and its own writes). Those settings are read
+## from the database until the next rebuild, as are settings created since, and listings once
+## anything has changed. While the change listener is disconnected nothing is served from the file.
+## Other namespaces are always read from the database.
+##
+## File layout, integers little-endian:
+##   header    magic, format, flags, length of the snapshot text, row count, index and listing offsets, build time
+##   snapshot  pg_current_snapshot() of the build transaction, as text
+##   records   per row: the length of "id:updated_at", that text and the row rendered to JSON by Postgres
+##   index     per row by ascending id: id, record offset and length, updated_at in microseconds
+##   listing   per row newest first (created_at DESC, id DESC): created_at in microseconds, index position
+
+# Snapshot file shared by the workers, reads go to the database when empty
+SETTINGS_SNAPSHOT_PATH = os.getenv("SETTINGS_SNAPSHOT_PATH", "")
+
+# Seconds between checks for a rebuilt snapshot file
+SETTINGS_SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SETTINGS_SNAPSHOT_CHECK_INTERVAL", "1"))
+
+# Rows fetched per round trip while building
+SNAPSHOT_BATCH_SIZE = 5000
+
+MAGIC = b"SETSNAP1"
+FORMAT = 2
+# Some rows have no timestamps, they can't be placed in a listing
+FLAG_NO_LISTINGS = 1
+
+HEADER = struct.Struct("<8sHHIQQQd")
+INDEX_ENTRY = struct.Struct("<16sQIq")
+LISTING_ENTRY = struct.Struct("<qI")
+RECORD_PREFIX = struct.Struct("<H")
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# Rows in listing order, with the same JSON and version text as operations.RAW_PAGE_QUERY
+BUILD_QUERY = """
+    SELECT
+        uuid_send(id) AS id,
+        (extract(epoch FROM created_at) * 1000000)::int8 AS created_us,
+        (extract(epoch FROM updated_at) * 1000000)::int8 AS updated_us,
+        id::text || ':' || updated_at::text AS version,
+        json_build_object(
+            'id', id, 'namespace', namespace, 'data', data, 'created_at', created_at, 'updated_at', updated_at
+        )::text AS json
+    FROM settings
+    WHERE namespace = %(namespace)s
+    ORDER BY created_at DESC, id DESC
+"""
+
+# Settings written by transactions the build snapshot doesn't see. pruned is true when log rows
+# the snapshot doesn't see may have been pruned already, then no row of the file can be trusted.
+# Always returns at least one row, change columns are null when there are no changes.
+CHANGED_SINCE_QUERY = """
+    SELECT
+        COALESCE(pruned.xid >= pg_snapshot_xmin(%(snapshot)s::pg_snapshot), false) AS pruned,
+        changes.setting_id::text AS setting_id,
+        changes.op
+    FROM (SELECT 1) AS one
+    LEFT JOIN settings_changes_pruned AS pruned ON true
+    LEFT JOIN LATERAL (
+        SELECT setting_id, op
+        FROM settings_changes
+        WHERE xid >= pg_snapshot_xmin(%(snapshot)s::pg_snapshot)
+            AND NOT pg_visible_in_snapshot(xid, %(snapshot)s::pg_snapshot)
+            AND (namespace = %(namespace)s OR namespace IS NULL)
+    ) AS changes ON true
+"""
+
+# Moves on every write to any namespace, the builder skips rebuilds while it stays put
+LAST_CHANGE_QUERY = "SELECT COALESCE(max(seq), 0) AS seq FROM settings_changes"
+
+GET = "get"
+LISTING = "listing"
+
+SNAPSHOT_READS = Counter(
+    "settings_snapshot_reads_total", "Reads answered from the settings snapshot file (hit) or passed to the database",
+    ["kind", "result"]
+)
+
+
+class SnapshotFormatError(ValueError):
+    ## Raised when a file isn't a settings snapshot of a known format
+    pass
+
+
+class SnapshotBuild(NamedTuple):
+    path: str
+    rows: int
+    bytes: int
+    seconds: float
+
+
+class SnapshotPage(NamedTuple):
+    ## A page of a listing read from the snapshot, see operations.RawSettingsPage
+    rows: List[str]                             # each setting as JSON text
+    total: Optional[int]
+    last_key: Optional[Tuple[datetime, str]]
+    version: str
+
+
+def _to_us(value: datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def _from_us(value: int) -> datetime:
+    return EPOCH + value * MICROSECOND
+
+
+def build_snapshot(path: str, batch_size: int = SNAPSHOT_BATCH_SIZE) -> SnapshotBuild:
+    ## Writes a snapshot of the default namespace next to path and renames it over path
+    ## Rows are streamed from a server-side cursor, only the index entries are kept in memory
+    started = time.perf_counter()
+    ids, offsets, lengths, updated, created = [], [], [], [], []
+    flags = 0
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as out:
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    # The first statement fixes the transaction's snapshot, the rows below all come from it
+                    cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                    cur.execute("SELECT pg_current_snapshot()::text AS snapshot")
+                    snapshot = cur.fetchone()["snapshot"].encode()
+                out.write(b"\0" * HEADER.size + snapshot)
+                offset = HEADER.size + len(snapshot)
+
+                with conn.cursor("settings_snapshot", cursor_factory=psycopg2.extensions.cursor) as cur:
+                    cur.itersize = batch_size
+                    cur.execute(BUILD_QUERY, {"namespace": DEFAULT_NAMESPACE})
+                    while True:
+                        rows = cur.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        for setting_id, created_us, updated_us, version, document in rows:
+                            if created_us is None or updated_us is None:
+                                # Left to the database, reads of it miss the index
+                                flags |= FLAG_NO_LISTINGS
+                                continue
+                            version = version.encode()
+                            record = RECORD_PREFIX.pack(len(version)) + version + document.encode()
+                            out.write(record)
+                            ids.append(bytes(setting_id))
+                            offsets.append(offset)
+                            lengths.append(len(record))
+                            updated.append(updated_us)
+                            created.append(created_us)
+                            offset += len(record)
+
+            order = sorted(range(len(ids)), key=ids.__getitem__)
+            position = [0] * len(ids)
+            index_offset = offset
+            for rank, row in enumerate(order):
+                position[row] = rank
+                out.write(INDEX_ENTRY.pack(ids[row], offsets[row], lengths[row], updated[row]))
+            listing_offset = index_offset + len(ids) * INDEX_ENTRY.size
+            for row in range(len(ids)):
+                out.write(LISTING_ENTRY.pack(created[row], position[row]))
+
+            out.seek(0)
+            out.write(HEADER.pack(
+                MAGIC, FORMAT, flags, len(snapshot), len(ids), index_offset, listing_offset, time.time()
+            ))
+            out.flush()
+            os.fsync(out.fileno())
+            size = listing_offset + len(ids) * LISTING_ENTRY.size
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return SnapshotBuild(path, len(ids), size, time.perf_counter() - started)
+
+
+def last_change() -> int:
+    ## Position of the newest change log row, 0 when the log is empty
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(LAST_CHANGE_QUERY)
+            return cur.fetchone()["seq"]
+
+
+def build_snapshot_periodically(path: str, interval: float, stop: Optional[threading.Event] = None):
+    ## Rebuilds the snapshot every interval seconds while settings change, until stop is set
+    stop = stop or threading.Event()
+    built = None
+    while not stop.is_set():
+        try:
+            seq = last_change()
+            if seq != built:
+                build = build_snapshot(path)
+                built = seq
+                logger.info("Built settings snapshot of %d rows in %.3fs", build.rows, build.seconds)
+        except (psycopg2.Error, OSError):
+            logger.exception("Building the settings snapshot failed")
+        stop.wait(interval)
+
+
+class SnapshotFile:
+    ## A mapped snapshot file, lookups read the mapping directly and copy out only what they return
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size < HEADER.size:
+                raise SnapshotFormatError(f"{path} is too short to be a settings snapshot")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        magic, version, self.flags, snapshot_length, self.count, self._index, self._listing, self.built_at = (
+            HEADER.unpack_from(self._map, 0)
+        )
+        if magic != MAGIC or version != FORMAT:
+            raise SnapshotFormatError(f"{path} is not a settings snapshot of format {FORMAT}")
+        self.snapshot = self._map[HEADER.size:HEADER.size + snapshot_length].decode()
+
+    @property
+    def listable(self) -> bool:
+        return not self.flags & FLAG_NO_LISTINGS
+
+    def _entry(self, position: int) -> Tuple[bytes, int, int, int]:
+        return INDEX_ENTRY.unpack_from(self._map, self._index + position * INDEX_ENTRY.size)
+
+    def find(self, setting_id: bytes) -> Optional[Tuple[bytes, int, int, int]]:
+        ## Binary search of the index, the (id, offset, length, updated_us) entry or None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self._index + middle * INDEX_ENTRY.size
+            found = self._map[start:start + 16]
+            if found < setting_id:
+                low = middle + 1
+            elif found > setting_id:
+                high = middle
+            else:
+                return self._entry(middle)
+        return None
+
+    def record(self, offset: int, length: int) -> Tuple[str, str]:
+        ## The version text and the JSON of a record
+        version_length, = RECORD_PREFIX.unpack_from(self._map, offset)
+        start = offset + RECORD_PREFIX.size
+        return (
+            self._map[start:start + version_length].decode(),
+            self._map[start + version_length:offset + length].decode()
+        )
+
+    def _listed(self, row: int) -> Tuple[int, bytes, int, int]:
+        ## (created_us, id, offset, length) of the row at a listing position
+        created_us, position = LISTING_ENTRY.unpack_from(self._map, self._listing + row * LISTING_ENTRY.size)
+        setting_id, offset, length, _ = self._entry(position)
+        return created_us, setting_id, offset, length
+
+    def seek(self, created_us: int, setting_id: bytes) -> int:
+        ## Listing position of the first row after the (created_at, id) key, newest first
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            row_created, row_id, _, _ = self._listed(middle)
+            if (row_created, row_id) < (created_us, setting_id):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def page(self, start: int, limit: int) -> Tuple[List[str], List[str], Optional[Tuple[datetime, str]]]:
+        ## JSON and version texts of the rows from a listing position, and the key of the last one
+        documents, versions = [], []
+        end = min(start + limit, self.count)
+        for row in range(start, end):
+            _, _, offset, length = self._listed(row)
+            version, document = self.record(offset, length)
+            documents.append(document)
+            versions.append(version)
+        if not documents:
+            return documents, versions, None
+        created_us, setting_id, _, _ = self._listed(end - 1)
+        return documents, versions, (_from_us(created_us), str(UUID(bytes=setting_id)))
+
+
+class _Changes:
+    ## What has been written since a snapshot file was built
+
+    def __init__(self, dirty: Optional[Set[str]] = None, everything: bool = False):
+        self.dirty = dirty if dirty is not None else set()     # IDs of updated, deleted or created settings
+        self.everything = everything                            # truncated, no row can be trusted
+        self.listing = bool(self.dirty) or everything           # any write, listings may differ
+
+    def note(self, key: Optional[str], op: Optional[str]):
+        if key is not None:
+            self.dirty.add(key)
+        elif op != "INSERT":
+            self.everything = True
+        self.listing = True
+
+    def merge(self, other: "_Changes"):
+        self.dirty |= other.dirty
+        self.everything = self.everything or other.everything
+        self.listing = self.listing or other.listing
+
+
+class SettingsSnapshot:
+    ## Serves reads from the current snapshot file and tracks which of its rows are out of date
+    ##
+    ## Follows change notifications like the settings cache: subscribe note_change, and call
+    ## resume / suspend when the listener connects / disconnects. A thread maps rebuilt files.
+
+    def __init__(self, path: str = "", check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._file: Optional[SnapshotFile] = None
+        self._lock = threading.Lock()
+        self._changes = _Changes()
+        # Changes noted while a file is being synced, added to its own once the sync is done
+        self._pending: Optional[_Changes] = None
+        self._listening = False
+        self._connects = 0
+        self._synced = False
+        self._resync = False
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.swaps = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and self._file is not None and self._synced and self._listening and not self._changes.everything
+
+    def note_change(self, event: dict):
+        ## Applies a change notification, also called after this worker's own writes commit
+        ## An update or delete carries the setting's ID, an insert only its op and a truncate neither
+        ## Writes to other namespaces don't touch the file's rows
+        if event.get("namespace", DEFAULT_NAMESPACE) != DEFAULT_NAMESPACE:
+            return
+        op = event.get("op")
+        setting_id = event.get("id")
+        key = None
+        if setting_id is not None:
+            try:
+                key = str(UUID(str(setting_id)))
+            except ValueError:
+                pass
+        with self._lock:
+            self._changes.note(key, op)
+            if self._pending is not None:
+                self._pending.note(key, op)
+
+    def note_write(self, key: Optional[str] = None, namespace: str = DEFAULT_NAMESPACE):
+        ## Applies this worker's own committed write ahead of its notification, a create when key is None
+        event = {"op": "UPDATE", "id": key} if key is not None else {"op": "INSERT"}
+        self.note_change({**event, "namespace": namespace})
+
+    def clear(self):
+        ## Stops serving the current file after writes to unknown settings, until a rebuilt one is mapped
+        self.note_change({"op": "TRUNCATE"})
+
+    def resume(self):
+        ## The listener is (re)connected, changes missed meanwhile are read from the change log
+        with self._lock:
+            self._listening = True
+            self._connects += 1
+            self._resync = True
+        self._wake.set()
+
+    def suspend(self):
+        ## The listener is disconnected, changes can't be followed
+        with self._lock:
+            self._listening = False
+
+    def refresh(self) -> bool:
+        ## Maps the file if it was rebuilt and resyncs after a reconnect, returns whether reads are served
+        if not self.enabled:
+            return False
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            with self._lock:
+                self._file = None
+            return False
+        identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        current = self._file
+        if current is not None and current.identity == identity and not self._resync:
+            return self.active
+        self._sync(SnapshotFile(self.path) if current is None or current.identity != identity else current)
+        return self.active
+
+    def _sync(self, snapshot: SnapshotFile):
+        ## Finds the settings written since the file was built, then serves the file
+        with self._lock:
+            self._resync = False
+            connects = self._connects
+            pending = self._pending = _Changes()
+        try:
+            changes = _changed_since(snapshot.snapshot)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+                self._resync = True
+            raise
+        with self._lock:
+            self._pending = None
+            changes.merge(pending)
+            self._changes = changes
+            if snapshot is not self._file:
+                self.swaps += 1
+            # The old mapping is unmapped once the last reader drops it
+            self._file = snapshot
+            # A disconnect during the query may have lost notifications, the reconnect resyncs
+            self._synced = self._listening and connects == self._connects
+
+    def get(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+        ## The setting from the file, None when it has to be read from the database
+        if namespace != DEFAULT_NAMESPACE:
+            return None
+        snapshot = self._file
+        if snapshot is None or not self.active or key in self._changes.dirty:
+            return self._count(GET, None)
+        entry = snapshot.find(UUID(key).bytes)
+        if entry is None:
+            return self._count(GET, None)
+        _, document = snapshot.record(entry[1], entry[2])
+        return self._count(GET, Setting.model_validate_json(document))
+
+    def get_version(self, key: str, namespace: str = DEFAULT_NAMESPACE) -> Optional[datetime]:
+        ## The updated_at of a setting from the file's index alone, None when the database has to answer
+        if namespace != DEFAULT_NAMESPACE:
+            return None
+        snapshot = self._file
+        if snapshot is None or not self.active or key in self._changes.dirty:
+            return self._count(GET, None)
+        entry = snapshot.find(UUID(key).bytes)
+        return self._count(GET, _from_us(entry[3]) if entry is not None else None)
+
+    def page(
+        self,
+        limit: int,
+        offset: int,
+        after: Optional[Tuple[datetime, UUID]],
+        count_strategy: str,
+        namespace: str = DEFAULT_NAMESPACE
+    ) -> Optional[SnapshotPage]:
+        ## A page of the unfiltered listing, None while the listing has changed since the build
+        if namespace != DEFAULT_NAMESPACE:
+            return None
+        snapshot = self._file
+        if snapshot is None or not self.active or self._changes.listing or not snapshot.listable:
+            return self._count(LISTING, None)
+        if after:
+            try:
+                start = snapshot.seek(_to_us(after[0]), after[1].bytes)
+            except TypeError:
+                # A timezone-aware cursor, compared the way Postgres does by the database
+                return self._count(LISTING, None)
+        else:
+            start = offset
+        documents, versions, last_key = snapshot.page(start, limit)
+        version = hashlib.md5(",".join(versions).encode()).hexdigest() if versions else ""
+        total = None if count_strategy == NONE else snapshot.count
+        return self._count(LISTING, SnapshotPage(documents, total, last_key, version))
+
+    def _count(self, kind: str, result):
+        if not self.enabled:
+            return result
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if METRICS_ENABLED:
+            SNAPSHOT_READS.labels(kind, "hit" if result is not None else "database").inc()
+        return result
+
+    def start(self):
+        if not self.enabled or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="settings-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except (psycopg2.Error, OSError, SnapshotFormatError):
+                logger.exception("Loading the settings snapshot failed")
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
+
+    def stats(self) -> dict:
+        snapshot = self._file
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "active": self.active,
+            "path": self.path or None,
+            "rows": snapshot.count if snapshot else None,
+            "age_seconds": round(time.time() - snapshot.built_at, 3) if snapshot else None,
+            "dirty": len(self._changes.dirty),
+            "listings_served": snapshot is not None and self.active and not self._changes.listing and snapshot.listable,
+            "swaps": self.swaps,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def _changed_since(snapshot: str) -> _Changes:
+    ## The writes of transactions the snapshot doesn't see
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(CHANGED_SINCE_QUERY, {"snapshot": snapshot, "namespace": DEFAULT_NAMESPACE})
+            rows = cur.fetchall()
+    return _Changes(
+        {row["setting_id"] for row in rows if row["setting_id"] is not None},
+        rows[0]["pruned"] or any(row["op"] == "truncate" for row in rows)
+    )
+
+
+settings_snapshot = SettingsSnapshot(SETTINGS_SNAPSHOT_PATH, SETTINGS_SNAPSHOT_CHECK_INTERVAL)
@@ -0,0 +1,190 @@
+import json
+import uuid
+from datetime import datetime
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional
+import psycopg2.errors
+import psycopg2.extensions
+from app.db.connection import get_db_connection
+from app.db.cache import settings_cache
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.snapshot import settings_snapshot
+
+## Bulk export and import of a namespace's settings as NDJSON, one setting per line:
+## {"id": "...", "namespace": "...", "data": {...}, "created_at": "...", "updated_at": "..."}
+## Imports always go to the namespace they are made in, the namespace of a line is ignored,
+## so an export of one namespace can be loaded into another.
+
+# Rows fetched per round trip from the server-side export cursor
+EXPORT_BATCH_SIZE = 2000
+
+
+class SettingsImportError(ValueError):
+    ## Raised when an import line can't be parsed
+    pass
+
+
+def export_settings(batch_size: int = EXPORT_BATCH_SIZE, namespace: str = DEFAULT_NAMESPACE) -> Iterator[bytes]:
+    ## Streams every setting of a namespace as NDJSON from a server-side cursor, memory use is bounded by batch_size
+    ## Rows are rendered to JSON by Postgres so they are never parsed in Python
+    with get_db_connection() as conn:
+        with conn.cursor("settings_export", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = batch_size
+            cur.execute(
+                """
+                SELECT json_build_object(
+                    'id', id, 'namespace', namespace, 'data', data, 'created_at', created_at, 'updated_at', updated_at
+                )::text
+                FROM settings
+                WHERE namespace = %s
+                """,
+                (namespace,)
+            )
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield b"".join(row[0].encode() + b"\n" for row in rows)
+
+
+# Characters COPY's text format gives a meaning to, escaped in every field
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_field(value) -> str:
+    ## Formats a value for COPY's text format
+    if value is None:
+        return "\\N"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def _timestamp(item: dict, field: str) -> Optional[str]:
+    ## Returns a line's timestamp in ISO format, None when it isn't given
+    value = item.get(field)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError(f"'{field}' must be an ISO 8601 timestamp")
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except ValueError:
+        raise ValueError(f"'{field}' must be an ISO 8601 timestamp, got {value!r}") from None
+
+
+class _NdjsonCopyReader:
+    ## File-like adaptor that converts NDJSON lines into COPY text rows as COPY reads them
+
+    def __init__(self, lines: Iterable[bytes]):
+        self._lines = iter(lines)
+        self._buffer = b""
+        self.line_number = 0
+        # psycopg2 replaces exceptions raised in read() with QueryCanceled, keep the original
+        self.error = None
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            row = self._next_row()
+            if row is None:
+                break
+            self._buffer += row
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
+
+    def _next_row(self):
+        for line in self._lines:
+            self.line_number += 1
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                if not isinstance(item, dict) or not isinstance(item.get("data"), dict):
+                    raise ValueError("expected an object with a 'data' object")
+                setting_id = str(uuid.UUID(str(item["id"]))) if item.get("id") else str(uuid.uuid4())
+                created_at, updated_at = _timestamp(item, "created_at"), _timestamp(item, "updated_at")
+            except ValueError as e:
+                self.error = SettingsImportError(f"Line {self.line_number}: {e}")
+                raise self.error from e
+            fields = [
+                str(self.line_number),
+                setting_id,
+                json.dumps(item["data"]),
+                created_at,
+                updated_at,
+            ]
+            return ("\t".join(_copy_field(field) for field in fields) + "\n").encode()
+        return None
+
+
+def import_settings(lines: Iterable[bytes], upsert: bool = False, namespace: str = DEFAULT_NAMESPACE) -> Dict[str, int]:
+    ## Loads NDJSON settings with COPY into a temporary table, then inserts them in one statement
+    ## Lines without an id get a new one, missing timestamps default to now
+    ## With upsert existing IDs are overwritten (the last line wins), otherwise an existing ID fails the import
+    reader = _NdjsonCopyReader(lines)
+    conflict = """
+        ON CONFLICT (namespace, id) DO UPDATE
+        SET data = EXCLUDED.data, created_at = EXCLUDED.created_at, updated_at = EXCLUDED.updated_at
+    """ if upsert else ""
+
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMPORARY TABLE settings_import (
+                    line BIGINT,
+                    id UUID,
+                    data JSONB,
+                    created_at TIMESTAMP,
+                    updated_at TIMESTAMP
+                ) ON COMMIT DROP
+                """
+            )
+            try:
+                cur.copy_expert(
+                    "COPY settings_import (line, id, data, created_at, updated_at) FROM STDIN",
+                    reader
+                )
+            except psycopg2.errors.QueryCanceled:
+                if reader.error:
+                    raise reader.error
+                raise
+            cur.execute(
+                f"""
+                WITH written AS (
+                    INSERT INTO settings (namespace, id, data, created_at, updated_at)
+                    SELECT DISTINCT ON (id)
+                        %s, id, data,
+                        COALESCE(created_at, CURRENT_TIMESTAMP),
+                        COALESCE(updated_at, CURRENT_TIMESTAMP)
+                    FROM settings_import
+                    ORDER BY id, line DESC
+                    {conflict}
+                    RETURNING namespace, id
+                ), existed AS (
+                    -- The outer query sees the table as it was before the insert, partitioned
+                    -- tables can't return xmax to tell inserted and updated rows apart
+                    SELECT w.id FROM written w
+                    WHERE EXISTS (SELECT 1 FROM settings s WHERE s.namespace = w.namespace AND s.id = w.id)
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM written) - (SELECT COUNT(*) FROM existed) AS inserted,
+                    (SELECT COUNT(*) FROM existed) AS updated
+                """,
+                (namespace,)
+            )
+            counts = cur.fetchone()
+
+    settings_snapshot.note_write(namespace=namespace)
+    if upsert:
+        if namespace == DEFAULT_NAMESPACE:
+            settings_snapshot.clear()
+        settings_cache.clear()
+    return {"lines": reader.line_number, "inserted": counts["inserted"], "updated": counts["updated"]}
+
+
+def import_settings_file(file: BinaryIO, upsert: bool = False, namespace: str = DEFAULT_NAMESPACE) -> Dict[str, int]:
+    ## Imports settings from an open binary NDJSON file
+    return import_settings(iter(file.readline, b""), upsert, namespace)
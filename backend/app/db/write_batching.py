@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, NamedTuple, Optional, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+from app.db.instrumentation import DB_LATENCY_BUCKETS, METRICS_ENABLED
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.models.setting import BatchItemResult, Setting
+
+logger = logging.getLogger(__name__)
+
+## Group commit of concurrent creates and updates within a worker.
+##
+## Each write is queued and its caller awaits a future. A background task collects the queued
+## writes until SETTINGS_WRITE_BATCH_MAX_ITEMS are waiting or the oldest has waited
+## SETTINGS_WRITE_BATCH_MAX_DELAY, then applies them all as one best-effort batch (one multi-row
+## statement per kind and a single commit, see operations.apply_batch). While a batch is being
+## written the next one fills up, so under load the number of commits follows the flush rate
+## rather than the request rate.
+##
+## Writes to different namespaces are flushed together but committed as one batch per namespace.
+## Updates of a setting missing from the table resolve to None as usual. When a batch statement
+## fails, e.g. because one document can't be stored, its writes are retried one by one so only
+## the caller whose write is at fault gets the error.
+
+# Queue creates and updates and commit them in batches, off by default since a single write
+# then waits up to SETTINGS_WRITE_BATCH_MAX_DELAY before it is sent
+SETTINGS_WRITE_BATCHING = os.getenv("SETTINGS_WRITE_BATCHING", "false").lower() == "true"
+
+# Seconds a queued write waits at most for others to join its batch
+SETTINGS_WRITE_BATCH_MAX_DELAY = float(os.getenv("SETTINGS_WRITE_BATCH_MAX_DELAY", "0.005"))
+
+# Writes per batch, a full batch is written right away
+SETTINGS_WRITE_BATCH_MAX_ITEMS = int(os.getenv("SETTINGS_WRITE_BATCH_MAX_ITEMS", "100"))
+
+WRITE_BATCH_SIZE = Histogram(
+    "settings_write_batch_size", "Writes committed together by the write batcher",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+WRITE_BATCH_WAIT = Histogram(
+    "settings_write_batch_wait_seconds", "Time writes spend queued before their batch is sent",
+    buckets=DB_LATENCY_BUCKETS
+)
+WRITE_QUEUE_DEPTH = Gauge(
+    "settings_write_queue_depth", "Writes queued for the write batcher", multiprocess_mode="livesum"
+)
+WRITE_BATCH_FALLBACKS = Counter(
+    "settings_write_batch_fallbacks_total", "Writes retried on their own after their batch failed"
+)
+
+CREATE = "create"
+UPDATE = "update"
+
+# Applies creates and (id, data) updates to a namespace as one best-effort batch, see operations.apply_batch
+ApplyBatch = Callable[[List[dict], List[Tuple[str, dict]], str], Awaitable[List[BatchItemResult]]]
+
+
+class _QueuedWrite(NamedTuple):
+    op: str
+    namespace: str
+    setting_id: Optional[str]
+    data: dict
+    future: asyncio.Future
+    queued_at: float
+
+
+class WriteBatcher:
+    ## Queues writes and commits them in batches from a background task on the event loop
+
+    def __init__(
+        self,
+        apply_batch: ApplyBatch,
+        create_one: Callable[[dict, str], Awaitable[Setting]],
+        update_one: Callable[[str, dict, str], Awaitable[Optional[Setting]]],
+        enabled: bool = True,
+        max_items: int = 100,
+        max_delay: float = 0.005,
+    ):
+        self.apply_batch = apply_batch
+        self.create_one = create_one
+        self.update_one = update_one
+        self.enabled = enabled
+        self.max_items = max(1, max_items)
+        self.max_delay = max_delay
+        self._queue: Deque[_QueuedWrite] = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._queued: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._closing = False
+        self.batches = 0
+        self.writes = 0
+        self.fallbacks = 0
+
+    async def create(self, data: dict, namespace: str = DEFAULT_NAMESPACE) -> Setting:
+        return await self._submit(CREATE, namespace, None, data)
+
+    async def update(self, setting_id: str, data: dict, namespace: str = DEFAULT_NAMESPACE) -> Optional[Setting]:
+        ## setting_id must be a valid UUID string, invalid IDs are answered by the caller
+        return await self._submit(UPDATE, namespace, setting_id, data)
+
+    async def _submit(self, op: str, namespace: str, setting_id: Optional[str], data: dict):
+        loop = asyncio.get_running_loop()
+        self._ensure_writer(loop)
+        future = loop.create_future()
+        self._queue.append(_QueuedWrite(op, namespace, setting_id, data, future, loop.time()))
+        if METRICS_ENABLED:
+            WRITE_QUEUE_DEPTH.inc()
+        self._queued.set()
+        if len(self._queue) >= self.max_items:
+            self._full.set()
+        return await future
+
+    def _ensure_writer(self, loop):
+        ## Starts the writer task on the running loop, again after close() or on a new loop
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._closing = False
+            self._queued = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                if self._closing:
+                    return
+                self._queued.clear()
+                await self._queued.wait()
+                continue
+            # Wait for more writes until the batch is full or its oldest write is due
+            remaining = self._queue[0].queued_at + self.max_delay - loop.time()
+            if remaining > 0 and len(self._queue) < self.max_items and not self._closing:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._take(loop.time())
+            try:
+                await self._write(batch)
+            except Exception as e:
+                logger.exception("Write batch failed")
+                for write in batch:
+                    _resolve(write.future, error=e)
+
+    def _take(self, now: float) -> List[_QueuedWrite]:
+        ## Takes the next batch off the queue, in order
+        ## A batch updates a setting at most once, a second update waits for the next batch so it applies last
+        batch = []
+        updated = set()
+        while self._queue and len(batch) < self.max_items:
+            write = self._queue[0]
+            if write.op == UPDATE:
+                if (write.namespace, write.setting_id) in updated:
+                    break
+                updated.add((write.namespace, write.setting_id))
+            batch.append(self._queue.popleft())
+        if METRICS_ENABLED:
+            WRITE_QUEUE_DEPTH.dec(len(batch))
+            WRITE_BATCH_SIZE.observe(len(batch))
+            for write in batch:
+                WRITE_BATCH_WAIT.observe(now - write.queued_at)
+        return batch
+
+    async def _write(self, batch: List[_QueuedWrite]):
+        self.batches += 1
+        self.writes += len(batch)
+        namespaces = {}
+        for write in batch:
+            namespaces.setdefault(write.namespace, []).append(write)
+        await asyncio.gather(*(self._write_namespace(namespace, writes) for namespace, writes in namespaces.items()))
+
+    async def _write_namespace(self, namespace: str, batch: List[_QueuedWrite]):
+        creates = [write for write in batch if write.op == CREATE]
+        updates = [write for write in batch if write.op == UPDATE]
+        try:
+            results = await self.apply_batch(
+                [write.data for write in creates],
+                [(write.setting_id, write.data) for write in updates],
+                namespace
+            )
+        except Exception:
+            logger.warning("Write batch of %d failed, retrying its writes one by one", len(batch), exc_info=True)
+            results = [None] * len(batch)
+
+        retry = []
+        # apply_batch returns the create results first, then the updates, each in order
+        for write, result in zip(creates + updates, results):
+            if result is not None and write.op == UPDATE and result.status == 404:
+                _resolve(write.future, None)
+            elif result is None or result.status >= 400:
+                ## Written again on its own so the caller gets the error the single write raises
+                retry.append(write)
+            else:
+                _resolve(write.future, result.setting)
+        if retry:
+            self.fallbacks += len(retry)
+            if METRICS_ENABLED:
+                WRITE_BATCH_FALLBACKS.inc(len(retry))
+            await asyncio.gather(*(self._write_one(write) for write in retry))
+
+    async def _write_one(self, write: _QueuedWrite):
+        try:
+            if write.op == CREATE:
+                setting = await self.create_one(write.data, write.namespace)
+            else:
+                setting = await self.update_one(write.setting_id, write.data, write.namespace)
+        except Exception as e:
+            _resolve(write.future, error=e)
+        else:
+            _resolve(write.future, setting)
+
+    async def close(self):
+        ## Writes what is still queued and stops the writer task, called on app shutdown
+        task = self._task
+        if task is None or task.done():
+            return
+        if task.get_loop() is not asyncio.get_running_loop():
+            # Left behind by an event loop that has stopped
+            self._task = None
+            return
+        self._closing = True
+        self._queued.set()
+        self._full.set()
+        await task
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "writes": self.writes,
+            "fallbacks": self.fallbacks,
+        }
+
+
+def _resolve(future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+    ## Callers that went away (cancelled requests) leave a done future behind
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
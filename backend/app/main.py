@@ -1,15 +1,54 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
-from app.api.settings import router as settings_router
+from app.api.settings import namespace_path, router as settings_router
 from app.db.init import init_db
+from app.db.migrations import DB_MIGRATE_ON_STARTUP, check_schema
+from app.db.connection import init_pool, close_pool, get_pool_stats, check_database
+from app.db.instrumentation import METRICS_ENABLED
+from app.db.slow_queries import slow_query_log
+from app.db.prepared import prepared_statements
+from app.metrics import MetricsMiddleware, render_metrics, mark_worker_stopped
+from app.read_your_writes import ReadYourWritesMiddleware
+from app.admission import (
+    ADMISSION_CONTROL,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_SHED_STATUS,
+    AdmissionMiddleware,
+    admission_controller
+)
+from app.db.replicas import replica_router, DB_READ_YOUR_WRITES_WINDOW
+from app.db.async_connection import (
+    DB_ASYNC_ENABLED,
+    init_async_pool,
+    close_async_pool,
+    get_async_pool_stats
+)
+from app.db.cache import settings_cache, invalidate_from_notification
+from app.db.snapshot import settings_snapshot
+from app.db.notifications import change_listener
+from app.db.feed import change_hub, wake_from_notification, SETTINGS_CHANGES_PRUNE_INTERVAL
+from app.db import async_operations
+import asyncio
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(
     title="Settings Management API",
     description="API for managing arbitrary JSON configuration data",
     version="1.0.0"
 )
 
+# Concurrency limits for the API, added first so shed requests still get CORS headers and are counted
+if ADMISSION_CONTROL:
+    app.add_middleware(
+        AdmissionMiddleware,
+        controller=admission_controller,
+        retry_after=ADMISSION_RETRY_AFTER,
+        shed_status=ADMISSION_SHED_STATUS
+    )
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -19,18 +58,139 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Include routers
+# Request latency, status and in-flight metrics, exposed with the database metrics at /metrics
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# Clients read from the primary for a while after their own writes, replicas may not have them yet
+if replica_router.enabled:
+    app.add_middleware(ReadYourWritesMiddleware, window=DB_READ_YOUR_WRITES_WINDOW)
+
+# Rows of the snapshot file written since it was built are read from the database. Subscribed ahead of
+# the cache, so a reader can't re-cache a row from the file once the cache has dropped it.
+change_listener.subscribe(settings_snapshot.note_change)
+change_listener.on_connect(settings_snapshot.resume)
+change_listener.on_disconnect(settings_snapshot.suspend)
+
+# Cross-worker cache invalidation, the cache is bypassed while the listener is disconnected
+change_listener.subscribe(invalidate_from_notification)
+change_listener.on_connect(settings_cache.resume)
+change_listener.on_disconnect(settings_cache.suspend)
+
+# Change feed readers are woken by notifications, and re-read after a reconnect in case one was lost
+change_listener.subscribe(wake_from_notification)
+change_listener.on_connect(change_hub.ring)
+
+# Include routers, the settings routes once for the default namespace and once per namespace
 app.include_router(settings_router, prefix="/api", tags=["settings"])
+app.include_router(
+    settings_router, prefix="/api/namespaces/{namespace}", tags=["settings"], dependencies=[Depends(namespace_path)]
+)
+
+async def prune_changes_periodically():
+    # Keeps the change log within SETTINGS_CHANGES_RETENTION, every worker prunes so one is always running
+    while True:
+        await asyncio.sleep(SETTINGS_CHANGES_PRUNE_INTERVAL)
+        try:
+            pruned = await async_operations.prune_changes()
+            if pruned:
+                logger.info("Pruned %d settings changes", pruned)
+        except Exception:
+            logger.exception("Pruning settings changes failed")
+
+_prune_task = None
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database on startup"""
-    init_db()
+    """Initialize connection pools and database on startup"""
+    global _prune_task
+    init_pool()
+    # Pending migrations are applied by one worker at a time, the others find the schema at head
+    if DB_MIGRATE_ON_STARTUP:
+        init_db()
+    else:
+        check_schema()
+    if DB_ASYNC_ENABLED:
+        await init_async_pool()
+    change_listener.start()
+    settings_snapshot.start()
+    replica_router.start()
+    if SETTINGS_CHANGES_PRUNE_INTERVAL > 0:
+        _prune_task = asyncio.create_task(prune_changes_periodically())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the change listener and close connection pools on shutdown"""
+    if _prune_task is not None:
+        _prune_task.cancel()
+    change_listener.stop()
+    settings_snapshot.stop()
+    # Queued writes are committed before the pools close
+    await async_operations.write_batcher.close()
+    replica_router.stop()
+    await replica_router.close_async()
+    await close_async_pool()
+    close_pool()
+    mark_worker_stopped()
 
 @app.get("/health")
-def health_check():
-    """Health check endpoint"""
-    return {"status": "ok"}
+def health_check(response: Response):
+    """Health check endpoint, 503 when the database can't be reached"""
+    try:
+        latency = check_database()
+    except Exception as e:
+        response.status_code = 503
+        return {"status": "unavailable", "database": {"reachable": False, "error": str(e).strip()}}
+    return {"status": "ok", "database": {"reachable": True, "latency_ms": round(latency * 1000, 3)}}
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Prometheus metrics"""
+    if not METRICS_ENABLED:
+        return Response(status_code=404)
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/health/pool")
+def pool_stats():
+    """Connection pool statistics"""
+    return {
+        "sync": get_pool_stats(),
+        "async": get_async_pool_stats(),
+        "prepared_statements": prepared_statements.stats(),
+        "write_batching": async_operations.write_batcher.stats(),
+        "replicas": replica_router.stats()
+    }
+
+@app.get("/health/cache")
+def cache_stats():
+    """Settings cache statistics"""
+    return settings_cache.stats()
+
+@app.get("/health/admission")
+def admission_stats():
+    """Slots in use, queued requests and shed counts of this worker's request budgets"""
+    return {"enabled": ADMISSION_CONTROL, **admission_controller.stats()}
+
+@app.get("/health/snapshot")
+def snapshot_stats():
+    """Settings snapshot file statistics for this worker"""
+    return settings_snapshot.stats()
+
+@app.get("/health/feed")
+def feed_stats():
+    """Change feed statistics for this worker"""
+    return {"listener_connected": change_listener.connected, **change_hub.stats()}
+
+@app.get("/admin/slow-queries")
+def slow_queries(limit: int = Query(50, ge=1, le=1000)):
+    """Slowest recent statements of this worker, newest first, with captured plans"""
+    return {**slow_query_log.stats(), "queries": slow_query_log.entries(limit)}
+
+@app.delete("/admin/slow-queries", status_code=204)
+def clear_slow_queries():
+    """Empties this worker's slow query buffer"""
+    slow_query_log.clear()
 
 @app.get("/")
 def root():
@@ -0,0 +1,99 @@
+import os
+import time
+from typing import Dict, List, Pattern, Tuple
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+## HTTP request metrics and the /metrics exposition.
+##
+## Each uvicorn worker keeps its own metrics. With several workers set PROMETHEUS_MULTIPROC_DIR
+## to an empty directory shared by them, /metrics then aggregates every worker's values.
+
+HTTP_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Requests handled", ["method", "route", "status"]
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time from receiving a request to sending the end of its response",
+    ["method", "route"], buckets=HTTP_LATENCY_BUCKETS
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled, including open streams",
+    ["method"], multiprocess_mode="livesum"
+)
+
+# Route label of requests that matched no route, so unknown paths don't create new series
+UNMATCHED_ROUTE = "unmatched"
+
+
+class MetricsMiddleware:
+    ## ASGI middleware recording every HTTP request
+    ## Requests are labelled with their route's path template (e.g. /api/settings/{uid}), found
+    ## through the endpoint the router stored in the scope, so matching isn't done twice.
+    ## An endpoint mounted more than once (the settings router is also served per namespace) is
+    ## told apart by matching the path against each of its routes.
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[object, List[Tuple[Pattern, str]]] = {}
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        routes = self._routes.get(endpoint)
+        if routes is None:
+            routes = [
+                (candidate.path_regex, candidate.path) for candidate in scope["app"].routes
+                if getattr(candidate, "endpoint", None) is endpoint
+            ]
+            self._routes[endpoint] = routes
+        if len(routes) == 1:
+            return routes[0][1]
+        for path_regex, path in routes:
+            if path_regex.match(scope["path"]):
+                return path
+        return UNMATCHED_ROUTE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = HTTP_REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            route = self._route(scope)
+            HTTP_REQUEST_DURATION.labels(method, route).observe(elapsed)
+            HTTP_REQUESTS.labels(method, route, str(status)).inc()
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    ## Metrics in the Prometheus text format and their content type
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_stopped():
+    ## Drops a stopped worker's live gauges from the multiprocess metrics
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
@@ -1,19 +1,23 @@
 from pydantic import BaseModel, Field
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Literal
 from datetime import datetime
 from uuid import UUID
+from app.db.namespaces import DEFAULT_NAMESPACE, NAMESPACE_PATTERN
 
 class SettingBase(BaseModel):
     data: Dict[str, Any] = Field(..., description="Arbitrary JSON configuration data")
 
 class SettingCreate(SettingBase):
-    pass
+    namespace: Optional[str] = Field(
+        None, pattern=NAMESPACE_PATTERN, description="Namespace to create the setting in, defaults to the route's"
+    )
 
 class SettingUpdate(SettingBase):
     pass
 
 class Setting(SettingBase):
     id: UUID
+    namespace: str = Field(DEFAULT_NAMESPACE, description="Namespace of the setting, its ID is unique within it")
     created_at: datetime
     updated_at: datetime
 
@@ -21,11 +25,65 @@ class Setting(SettingBase):
         from_attributes = True
 
 class PaginationInfo(BaseModel):
-    total: int
+    total: Optional[int]
     page: int
     limit: int
-    total_pages: int
+    total_pages: Optional[int]
+    count_strategy: Literal["exact", "estimated", "cached", "none"] = Field(
+        "exact", description="How total was computed, estimated totals are approximate"
+    )
+    next_cursor: Optional[str] = Field(None, description="Cursor for the next page, pass as ?cursor= to seek instead of paging by offset")
 
 class SettingListResponse(BaseModel):
     data: list[Setting]
-    pagination: PaginationInfo
\ No newline at end of file
+    pagination: PaginationInfo
+
+class JsonPatchOperation(BaseModel):
+    op: Literal["add", "remove", "replace", "move", "copy", "test"]
+    path: str = Field(..., description="JSON pointer into the setting's data")
+    value: Any = None
+    from_: Optional[str] = Field(None, alias="from", description="Source JSON pointer for move and copy")
+
+class SettingBatchUpdate(SettingBase):
+    id: str = Field(..., description="ID of the setting to replace")
+
+class SettingBatchRequest(BaseModel):
+    create: list[SettingCreate] = Field(default_factory=list, description="Settings to create")
+    update: list[SettingBatchUpdate] = Field(default_factory=list, description="Settings to replace by ID")
+    delete: list[str] = Field(default_factory=list, description="IDs of settings to delete")
+    atomic: bool = Field(True, description="All-or-nothing when true, best-effort when false")
+    return_settings: bool = Field(True, description="Include the written settings in the results")
+
+class BatchItemResult(BaseModel):
+    op: Literal["create", "update", "delete"]
+    index: int = Field(..., description="Position of the item in its create/update/delete list")
+    status: int = Field(..., description="HTTP status of the item, 424 when not applied because another item failed")
+    id: Optional[str] = None
+    setting: Optional[Setting] = None
+    error: Optional[str] = None
+
+class SettingBatchResponse(BaseModel):
+    committed: bool
+    results: list[BatchItemResult]
+
+class SettingChange(BaseModel):
+    position: str = Field(..., description="Feed position of the change, resume after it with ?after=")
+    op: Literal["create", "update", "delete", "truncate"]
+    id: Optional[UUID] = Field(None, description="ID of the changed setting, null for truncate")
+    changed_at: datetime
+
+class SettingChangesResponse(BaseModel):
+    changes: list[SettingChange]
+    position: str = Field(..., description="Position to pass as ?after= on the next request")
+
+class SettingSyncResponse(BaseModel):
+    settings: list[Setting] = Field(..., description="Current state of settings created or updated after the watermark")
+    deleted: list[UUID] = Field(..., description="IDs of settings deleted after the watermark")
+    watermark: str = Field(..., description="Watermark to pass as ?since= on the next sync")
+    has_more: bool = Field(..., description="More changes are waiting, sync again right away")
+
+class SettingRevision(BaseModel):
+    revision: int
+    op: Literal["create", "update", "delete"]
+    recorded_at: datetime
+    data: Optional[Dict[str, Any]] = Field(None, description="Data at this revision, null in listings and for deletions")
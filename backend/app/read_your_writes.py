@@ -0,0 +1,56 @@
+import math
+import time
+from starlette.requests import cookie_parser
+from app.db.replicas import primary_reads
+
+## Read-your-writes for clients reading from replicas.
+##
+## A successful write request gets a cookie holding the time until which the client's reads must
+## see it. Requests carrying an unexpired cookie read from the primary, everything they read
+## there includes the client's own writes. Clients that don't keep cookies read from replicas
+## right after writing and may briefly see older data.
+
+COOKIE_NAME = "settings_read_primary_until"
+
+WRITE_METHODS = frozenset(("POST", "PUT", "PATCH", "DELETE"))
+
+
+def _primary_until(scope) -> float:
+    for name, value in scope["headers"]:
+        if name == b"cookie":
+            try:
+                return float(cookie_parser(value.decode("latin-1")).get(COOKIE_NAME, 0))
+            except ValueError:
+                return 0
+    return 0
+
+
+class ReadYourWritesMiddleware:
+    ## ASGI middleware sending a client's reads to the primary for window seconds after its last write
+
+    def __init__(self, app, window: float):
+        self.app = app
+        self.window = window
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] in WRITE_METHODS:
+            async def send_with_cookie(message):
+                if message["type"] == "http.response.start" and message["status"] < 400:
+                    cookie = (
+                        f"{COOKIE_NAME}={time.time() + self.window:.3f}; Max-Age={math.ceil(self.window)}; "
+                        "Path=/; HttpOnly; SameSite=Lax"
+                    )
+                    message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+                await send(message)
+        else:
+            send_with_cookie = send
+
+        token = primary_reads.set(_primary_until(scope) > time.time())
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            primary_reads.reset(token)
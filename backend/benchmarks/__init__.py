@@ -0,0 +1 @@
+## Load tests and benchmarks for the settings API and data layer, run with "python -m benchmarks"
@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import sys
+from benchmarks.stats import build_report, write_report, load_report, compare_reports, format_comparison
+
+## Benchmark tools, run from the backend directory against a database that can be thrown away
+##   python -m benchmarks seed --rows 1000000 [--blob small|large] [--namespaces 1] [--truncate] [--skip-history]
+##   python -m benchmarks http [--url http://localhost:8000] [--concurrency 16] [--requests 500] [-o run.json]
+##   python -m benchmarks ops [--iterations 200] [--namespace default] [-o run.json]
+##   python -m benchmarks compare baseline.json run.json [--threshold 0.1]
+
+def _rows(value: str) -> int:
+    ## Accepts 10000, 10k and 10M
+    multiplier = {"k": 1000, "m": 1000000}.get(value[-1:].lower(), 1)
+    return int(value[:-1] if multiplier > 1 else value) * multiplier
+
+def _print_result(name: str, result: dict):
+    print(
+        f"{name:<32} {result['throughput']:>10.1f}/s  p50 {result['p50_ms']:>9.2f} ms  "
+        f"p95 {result['p95_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  errors {result['errors']}",
+        file=sys.stderr
+    )
+
+def seed_command(args):
+    ## Inserts generated settings
+    from benchmarks.seed import seed_settings
+
+    def progress(done, total):
+        print(f"Seeded {done}/{total}", file=sys.stderr)
+    seconds = seed_settings(args.rows, args.blob, args.truncate, args.skip_history, progress, args.namespaces)
+    print(f"Seeded {args.rows} {args.blob} settings into {args.namespaces} namespaces in {seconds:.1f}s")
+
+def http_command(args):
+    ## Load tests the API of a running server
+    from benchmarks.http_load import run_load
+    results = asyncio.run(run_load(
+        args.url, args.concurrency, args.requests, args.warmup, args.only, args.skip, progress=_print_result
+    ))
+    parameters = {"url": args.url, "concurrency": args.concurrency, "requests": args.requests, "warmup": args.warmup}
+    write_report(build_report("http", parameters, results), args.output)
+
+def ops_command(args):
+    ## Benchmarks the data layer functions
+    from benchmarks.ops import run_ops
+    results = run_ops(args.iterations, args.warmup, args.only, progress=_print_result, namespace=args.namespace)
+    parameters = {"iterations": args.iterations, "warmup": args.warmup, "namespace": args.namespace}
+    write_report(build_report("ops", parameters, results), args.output)
+
+def compare_command(args):
+    ## Compares a run against a baseline, exits with 1 when a metric regressed
+    rows = compare_reports(load_report(args.baseline), load_report(args.current), args.threshold)
+    print(format_comparison(rows))
+    if any(row["regressed"] for row in rows):
+        sys.exit(1)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Settings benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="Insert generated settings")
+    seed_parser.add_argument("--rows", type=_rows, default=_rows("10k"), help="Number of settings, e.g. 1k, 1M or 10M")
+    seed_parser.add_argument("--blob", choices=["small", "large"], default="small", help="Size of each setting's data")
+    seed_parser.add_argument(
+        "--namespaces", type=int, default=1, help="Spread the rows over the default namespace and tenant_1 .. tenant_<n - 1>"
+    )
+    seed_parser.add_argument("--truncate", action="store_true", help="Delete every setting first")
+    seed_parser.add_argument("--skip-history", action="store_true", help="Don't record revisions for the seeded settings")
+    seed_parser.set_defaults(func=seed_command)
+
+    http_parser = commands.add_parser("http", help="Load test every API endpoint of a running server")
+    http_parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the server")
+    http_parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    http_parser.add_argument("--requests", type=int, default=500, help="Timed requests per endpoint")
+    http_parser.add_argument("--warmup", type=int, default=20, help="Untimed requests per endpoint before timing")
+    http_parser.add_argument("--only", nargs="+", help="Only run scenarios whose names start with these")
+    http_parser.add_argument("--skip", nargs="+", help="Skip scenarios whose names start with these, e.g. export")
+    http_parser.add_argument("-o", "--output", help="JSON results file, defaults to stdout")
+    http_parser.set_defaults(func=http_command)
+
+    ops_parser = commands.add_parser("ops", help="Benchmark the app.db.operations functions")
+    ops_parser.add_argument("--iterations", type=int, default=200, help="Timed calls per function")
+    ops_parser.add_argument("--warmup", type=int, default=10, help="Untimed calls per function before timing")
+    ops_parser.add_argument("--only", nargs="+", help="Only run benchmarks whose names start with these")
+    ops_parser.add_argument("--namespace", default="default", help="Namespace of the settings to benchmark")
+    ops_parser.add_argument("-o", "--output", help="JSON results file, defaults to stdout")
+    ops_parser.set_defaults(func=ops_command)
+
+    compare_parser = commands.add_parser("compare", help="Compare results against a baseline")
+    compare_parser.add_argument("baseline", help="Baseline JSON results")
+    compare_parser.add_argument("current", help="JSON results to check")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="Fraction a metric may be worse than the baseline before it counts as a regression"
+    )
+    compare_parser.set_defaults(func=compare_command)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional
+import httpx
+from benchmarks.stats import summarize
+
+## Drives every endpoint of app/api/settings.py over HTTP at a fixed concurrency against a running
+## server, e.g. "uvicorn app.main:app --workers 4" on a seeded database. Each scenario sends its
+## requests from concurrency client tasks and records the latency of every response.
+
+# Lines per import request
+IMPORT_LINES = 100
+# Items per batch request, half creates and half updates
+BATCH_ITEMS = 100
+
+
+class LoadContext:
+    ## IDs and positions the scenarios build their requests from
+    def __init__(self, ids: List[str], disposable: List[str], position: str):
+        self.ids = ids
+        self.disposable = disposable
+        self.position = position
+        self.now = datetime.now(timezone.utc).isoformat()
+
+    def pick(self, i: int) -> str:
+        return self.ids[i % len(self.ids)]
+
+
+class Scenario(NamedTuple):
+    name: str
+    request: Callable[[LoadContext, int], dict]     # keyword arguments of httpx.AsyncClient.request
+    max_requests: Optional[int] = None               # cap for scenarios that are expensive per request
+    first_event: bool = False                        # time until the first server-sent event instead of the whole body
+
+
+def _import_body(i: int) -> bytes:
+    return b"".join(
+        json.dumps({"data": {"theme": "dark", "n": n, "import": i}}).encode() + b"\n"
+        for n in range(IMPORT_LINES)
+    )
+
+
+SCENARIOS = [
+    Scenario("create", lambda ctx, i: {"method": "POST", "url": "/api/settings", "json": {"data": {"theme": "dark", "n": i}}}),
+    Scenario("batch", lambda ctx, i: {"method": "POST", "url": "/api/settings:batch", "json": {
+        "create": [{"data": {"n": n}} for n in range(BATCH_ITEMS // 2)],
+        "update": [{"id": ctx.pick(i * BATCH_ITEMS + n), "data": {"theme": "light", "n": n}} for n in range(BATCH_ITEMS // 2)],
+        "return_settings": False,
+    }}),
+    Scenario("export", lambda ctx, i: {"method": "GET", "url": "/api/settings:export"}, max_requests=3),
+    Scenario("import", lambda ctx, i: {"method": "POST", "url": "/api/settings:import", "content": _import_body(i),
+                                       "headers": {"Content-Type": "application/x-ndjson"}}),
+    Scenario("changes", lambda ctx, i: {"method": "GET", "url": "/api/settings:changes",
+                                        "params": {"after": ctx.position, "wait": 0}}),
+    Scenario("stream", lambda ctx, i: {"method": "GET", "url": "/api/settings:stream",
+                                       "params": {"after": ctx.position}}, first_event=True),
+    Scenario("sync", lambda ctx, i: {"method": "GET", "url": "/api/settings:sync", "params": {"since": ctx.position}}),
+    Scenario("list", lambda ctx, i: {"method": "GET", "url": "/api/settings", "params": {"limit": 10}}),
+    Scenario("list.page_100_no_total", lambda ctx, i: {"method": "GET", "url": "/api/settings",
+                                                       "params": {"limit": 100, "include_total": "false"}}),
+    Scenario("list.deep_offset", lambda ctx, i: {"method": "GET", "url": "/api/settings",
+                                                 "params": {"limit": 100, "page": 100, "include_total": "false"}}),
+    Scenario("list.contains", lambda ctx, i: {"method": "GET", "url": "/api/settings",
+                                              "params": {"contains": '{"theme": "dark"}'}}),
+    Scenario("list.jsonpath", lambda ctx, i: {"method": "GET", "url": "/api/settings",
+                                              "params": {"jsonpath": "$.limits.max ? (@ > 90)"}}),
+    Scenario("get", lambda ctx, i: {"method": "GET", "url": f"/api/settings/{ctx.pick(i)}"}),
+    Scenario("get.as_of", lambda ctx, i: {"method": "GET", "url": f"/api/settings/{ctx.disposable[i % len(ctx.disposable)]}",
+                                          "params": {"as_of": ctx.now}}),
+    Scenario("revisions", lambda ctx, i: {"method": "GET", "url": f"/api/settings/{ctx.pick(i)}/revisions"}),
+    Scenario("revision", lambda ctx, i: {"method": "GET",
+                                         "url": f"/api/settings/{ctx.disposable[i % len(ctx.disposable)]}/revisions/1"}),
+    Scenario("restore", lambda ctx, i: {"method": "POST",
+                                        "url": f"/api/settings/{ctx.disposable[i % len(ctx.disposable)]}/revisions/1:restore"}),
+    Scenario("put", lambda ctx, i: {"method": "PUT", "url": f"/api/settings/{ctx.pick(i)}",
+                                    "json": {"data": {"theme": "dark", "n": i, "limits": {"max": i % 100}}}}),
+    Scenario("patch", lambda ctx, i: {"method": "PATCH", "url": f"/api/settings/{ctx.pick(i)}",
+                                      "json": {"enabled": i % 2 == 0},
+                                      "headers": {"Content-Type": "application/merge-patch+json"}}),
+    # Runs last, deletes the settings created for the run
+    Scenario("delete", lambda ctx, i: {"method": "DELETE", "url": f"/api/settings/{ctx.disposable.pop()}"}),
+]
+
+
+async def prepare_context(client: httpx.AsyncClient, id_count: int, disposable: int) -> LoadContext:
+    ## Collects existing IDs, takes the current feed position and creates settings to consume
+    response = await client.get("/api/settings:changes", params={"wait": 0})
+    response.raise_for_status()
+    position = response.json()["position"]
+
+    ids: List[str] = []
+    cursor = None
+    while len(ids) < id_count:
+        params = {"limit": 100, "include_total": "false"}
+        if cursor:
+            params["cursor"] = cursor
+        response = await client.get("/api/settings", params=params)
+        response.raise_for_status()
+        page = response.json()
+        ids += [setting["id"] for setting in page["data"]]
+        cursor = page["pagination"]["next_cursor"]
+        if not cursor:
+            break
+    if not ids:
+        raise RuntimeError("The settings table is empty, seed it first with 'python -m benchmarks seed'")
+
+    created: List[str] = []
+    for start in range(0, disposable, 1000):
+        response = await client.post("/api/settings:batch", json={
+            "create": [{"data": {"theme": "dark", "n": n, "disposable": True}} for n in range(min(1000, disposable - start))]
+        })
+        response.raise_for_status()
+        created += [result["id"] for result in response.json()["results"]]
+    return LoadContext(ids[:id_count], created, position)
+
+
+async def _send(client: httpx.AsyncClient, scenario: Scenario, ctx: LoadContext, i: int) -> int:
+    ## Sends one request and reads the response, returns the status code
+    async with client.stream(**scenario.request(ctx, i)) as response:
+        if scenario.first_event and response.status_code == 200:
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    break
+        else:
+            await response.aread()
+        return response.status_code
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, ctx: LoadContext,
+                       concurrency: int, requests: int, warmup: int = 0) -> dict:
+    ## Sends requests from concurrency tasks, after warmup untimed ones
+    if scenario.max_requests is not None:
+        requests, warmup = min(requests, scenario.max_requests), 0
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+    errors = 0
+
+    async def run(total: int, timed: bool):
+        nonlocal errors
+        counter = itertools.count()
+
+        async def worker():
+            nonlocal errors
+            while True:
+                i = next(counter)
+                if i >= total:
+                    return
+                started = time.perf_counter()
+                try:
+                    status = await _send(client, scenario, ctx, i)
+                except (httpx.HTTPError, IndexError):
+                    if timed:
+                        errors += 1
+                        statuses["error"] += 1
+                    continue
+                if timed:
+                    latencies.append(time.perf_counter() - started)
+                    statuses[str(status)] += 1
+                    if status >= 400:
+                        errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+
+    if warmup:
+        await run(warmup, timed=False)
+    started = time.perf_counter()
+    await run(requests, timed=True)
+    return summarize(latencies, time.perf_counter() - started, errors, statuses)
+
+
+async def run_load(base_url: str, concurrency: int = 16, requests: int = 500, warmup: int = 20,
+                   only: Optional[List[str]] = None, skip: Optional[List[str]] = None,
+                   timeout: float = 120, progress=None) -> Dict[str, dict]:
+    ## Runs the selected scenarios one after another, scenarios are selected by name prefix
+    def selected(name: str) -> bool:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            return False
+        return not (skip and any(name.startswith(prefix) for prefix in skip))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        ctx = await prepare_context(client, id_count=1000, disposable=requests + warmup)
+        results = {}
+        for scenario in SCENARIOS:
+            if not selected(scenario.name):
+                continue
+            results[scenario.name] = await run_scenario(client, scenario, ctx, concurrency, requests, warmup)
+            if progress is not None:
+                progress(scenario.name, results[scenario.name])
+    return results
@@ -0,0 +1,227 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Dict, List, NamedTuple, Optional, Tuple
+from app.db import operations
+from app.db.cache import settings_cache, entry_key
+from app.db.connection import get_db_connection
+from app.db.migrations import HISTORY_CONFIG_UPSERT
+from app.db.namespaces import DEFAULT_NAMESPACE
+from app.db.pagination import encode_cursor
+from app.db.snapshot import build_snapshot, settings_snapshot
+from benchmarks.stats import summarize
+
+## Microbenchmarks of the functions in app.db.operations, called directly without the API.
+## Every benchmark runs on the calling thread, one call at a time, against one namespace of the seeded table.
+
+
+class Benchmark(NamedTuple):
+    name: str
+    run: Callable[[int], object]                    # the timed call, given the iteration number
+    before: Optional[Callable[[int], object]] = None  # untimed preparation before each call
+    context: Optional[Callable[[], ContextManager]] = None  # entered around all the calls
+
+
+def sample_ids(count: int, namespace: str = DEFAULT_NAMESPACE) -> List[str]:
+    ## Random IDs of existing settings of a namespace
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT id::text AS id FROM settings WHERE namespace = %s ORDER BY random() LIMIT %s", (namespace, count)
+            )
+            return [row["id"] for row in cur.fetchall()]
+
+
+def _middle_of_listing(namespace: str) -> Tuple[int, Optional[str]]:
+    ## The offset and cursor of the row halfway through the namespace's newest-first listing
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) / 2 AS middle FROM settings WHERE namespace = %s", (namespace,))
+            middle = cur.fetchone()["middle"]
+            cur.execute(
+                """
+                SELECT created_at, id::text AS id FROM settings
+                WHERE namespace = %s
+                ORDER BY created_at DESC, id DESC OFFSET %s LIMIT 1
+                """,
+                (namespace, middle)
+            )
+            row = cur.fetchone()
+    return middle, encode_cursor(row["created_at"], row["id"]) if row else None
+
+
+@contextmanager
+def serving_snapshot():
+    ## Reads from a snapshot file of the seeded table, built on entry, the database is read again on exit
+    path = settings_snapshot.path
+    with tempfile.TemporaryDirectory() as directory:
+        settings_snapshot.path = os.path.join(directory, "settings.snapshot")
+        try:
+            build_snapshot(settings_snapshot.path)
+            settings_snapshot.resume()
+            if not settings_snapshot.refresh():
+                raise RuntimeError("The settings snapshot can't be served")
+            yield
+        finally:
+            settings_snapshot.suspend()
+            settings_snapshot.path = path
+
+
+@contextmanager
+def recording_history(enabled: bool):
+    ## Turns history recording on or off for the calls, the configured state is put back on exit
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT enabled, snapshot_interval FROM settings_history_config")
+            previous = cur.fetchone()
+            cur.execute(HISTORY_CONFIG_UPSERT, (enabled, previous["snapshot_interval"]))
+    try:
+        yield
+    finally:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(HISTORY_CONFIG_UPSERT, (previous["enabled"], previous["snapshot_interval"]))
+
+
+def build_benchmarks(iterations: int, namespace: str = DEFAULT_NAMESPACE) -> List[Benchmark]:
+    ## Creates the benchmarks, sampling IDs from the namespace in the seeded table
+    ## The snapshot only serves the default namespace, its benchmarks are left out for the others
+    ids = sample_ids(iterations, namespace)
+    if not ids:
+        raise RuntimeError(f"Namespace '{namespace}' is empty, seed it first with 'python -m benchmarks seed'")
+    ns = namespace
+
+    def pick(i: int) -> str:
+        return ids[i % len(ids)]
+
+    # The same rows paged to with OFFSET and with a cursor
+    middle, cursor = _middle_of_listing(ns)
+    deep_page = middle // 100 + 1
+    created: List[str] = []
+    position = operations.get_changes(namespace=ns)[1]
+
+    def create(i):
+        created.append(str(operations.create_setting({"theme": "dark", "n": i, "benchmark": True}, ns).id))
+
+    def delete(i):
+        operations.delete_setting(created.pop(), ns)
+
+    def uncached(i):
+        settings_cache.invalidate(entry_key(ns, pick(i)))
+
+    def apply_batch_100(i):
+        operations.apply_batch(
+            [{"benchmark": True, "n": n} for n in range(50)],
+            [(pick(i * 50 + n), {"theme": "light", "n": n, "limits": {"max": n}}) for n in range(50)],
+            [],
+            return_settings=False,
+            namespace=ns
+        )
+
+    benchmarks = [
+        Benchmark("create_setting", create),
+        Benchmark("get_all_settings", lambda i: operations.get_all_settings(1, 10, namespace=ns)),
+        Benchmark("get_all_settings.deep_offset", lambda i: operations.get_all_settings(deep_page, 100, namespace=ns)),
+        Benchmark("get_all_settings.cursor", lambda i: operations.get_all_settings(1, 100, cursor, namespace=ns)),
+        Benchmark("get_all_settings.estimated", lambda i: operations.get_all_settings(
+            1, 10, count_strategy="estimated", namespace=ns
+        )),
+        Benchmark("get_all_settings.cached", lambda i: operations.get_all_settings(
+            1, 10, count_strategy="cached", namespace=ns
+        )),
+        Benchmark("get_all_settings.contains", lambda i: operations.get_all_settings(
+            1, 10, filters={"contains": {"theme": "dark"}}, namespace=ns
+        )),
+        Benchmark("get_all_settings.jsonpath", lambda i: operations.get_all_settings(
+            1, 10, filters={"jsonpath": "$.limits.max ? (@ > 90)"}, namespace=ns
+        )),
+        Benchmark("get_all_settings_json", lambda i: operations.get_all_settings_json(1, 10, namespace=ns)),
+        Benchmark("get_all_settings_json.page_100", lambda i: operations.get_all_settings_json(
+            1, 100, count_strategy="none", namespace=ns
+        )),
+        # Only parts of the data, or none of it, selected by Postgres (compare with --blob large)
+        Benchmark("get_all_settings_json.page_100.fields", lambda i: operations.get_all_settings_json(
+            1, 100, count_strategy="none", fields=["/theme", "/limits/max"], namespace=ns
+        )),
+        Benchmark("get_all_settings_json.page_100.no_data", lambda i: operations.get_all_settings_json(
+            1, 100, count_strategy="none", include_data=False, namespace=ns
+        )),
+        # The same reads answered from the memory-mapped snapshot instead of the database
+        Benchmark("get_all_settings_json.snapshot", lambda i: operations.get_all_settings_json(1, 10), context=serving_snapshot),
+        Benchmark("get_all_settings_json.page_100.snapshot", lambda i: operations.get_all_settings_json(
+            1, 100, count_strategy="none"
+        ), context=serving_snapshot),
+        Benchmark("get_all_settings_json.cursor.snapshot", lambda i: operations.get_all_settings_json(
+            1, 100, cursor
+        ), context=serving_snapshot),
+        Benchmark("get_setting_by_id.cached", lambda i: operations.get_setting_by_id(pick(i % 10), ns)),
+        Benchmark("get_setting_by_id.uncached", lambda i: operations.get_setting_by_id(pick(i), ns), before=uncached),
+        Benchmark("get_setting_by_id.snapshot", lambda i: operations.get_setting_by_id(pick(i)), before=uncached,
+                  context=serving_snapshot),
+        Benchmark("get_setting_fields", lambda i: operations.get_setting_fields(pick(i), ["/theme", "/limits/max"], ns)),
+        Benchmark("get_setting_version", lambda i: operations.get_setting_version(pick(i), ns)),
+        Benchmark("get_setting_version.snapshot", lambda i: operations.get_setting_version(pick(i)), before=uncached,
+                  context=serving_snapshot),
+        Benchmark("update_setting", lambda i: operations.update_setting(
+            pick(i), {"theme": "dark", "n": i, "limits": {"max": i % 100}}, ns
+        )),
+        # The write overhead of recording revisions, the same writes with history off and on
+        Benchmark("update_setting.history_off", lambda i: operations.update_setting(
+            pick(i), {"theme": "dark", "n": i, "limits": {"max": i % 100}}, ns
+        ), context=lambda: recording_history(False)),
+        Benchmark("update_setting.history_on", lambda i: operations.update_setting(
+            pick(i), {"theme": "dark", "n": i, "limits": {"max": i % 100}}, ns
+        ), context=lambda: recording_history(True)),
+        Benchmark("patch_setting.merge", lambda i: operations.patch_setting(
+            pick(i), merge_patch={"enabled": i % 2 == 0}, namespace=ns
+        )),
+        Benchmark("patch_setting.json_patch", lambda i: operations.patch_setting(
+            pick(i), json_patch=[{"op": "add", "path": "/benchmark", "value": i}, {"op": "remove", "path": "/benchmark"}],
+            namespace=ns
+        )),
+        Benchmark("apply_batch.100", apply_batch_100),
+        Benchmark("apply_batch.100.history_off", apply_batch_100, context=lambda: recording_history(False)),
+        Benchmark("apply_batch.100.history_on", apply_batch_100, context=lambda: recording_history(True)),
+        Benchmark("get_changes", lambda i: operations.get_changes(position, namespace=ns)),
+        Benchmark("sync_settings", lambda i: operations.sync_settings(position, namespace=ns)),
+        Benchmark("prune_changes", lambda i: operations.prune_changes(365 * 24 * 3600)),
+        # Runs last, removing the settings create_setting added
+        Benchmark("delete_setting", delete, before=lambda i: None if created else create(i)),
+    ]
+    if namespace != DEFAULT_NAMESPACE:
+        benchmarks = [benchmark for benchmark in benchmarks if benchmark.context is not serving_snapshot]
+    return benchmarks
+
+
+def run_benchmark(benchmark: Benchmark, iterations: int, warmup: int = 0) -> dict:
+    ## Times iterations calls, after warmup untimed ones
+    latencies = []
+    errors = 0
+    with benchmark.context() if benchmark.context is not None else nullcontext():
+        for i in range(-warmup, iterations):
+            if benchmark.before is not None:
+                benchmark.before(i)
+            started = time.perf_counter()
+            try:
+                benchmark.run(i)
+            except Exception:
+                if i >= 0:
+                    errors += 1
+                continue
+            if i >= 0:
+                latencies.append(time.perf_counter() - started)
+    return summarize(latencies, sum(latencies), errors)
+
+
+def run_ops(iterations: int = 200, warmup: int = 10, only: Optional[List[str]] = None,
+            progress=None, namespace: str = DEFAULT_NAMESPACE) -> Dict[str, dict]:
+    ## Runs every benchmark, or those whose name starts with one of only
+    results = {}
+    for benchmark in build_benchmarks(iterations + warmup, namespace):
+        if only and not any(benchmark.name.startswith(prefix) for prefix in only):
+            continue
+        results[benchmark.name] = run_benchmark(benchmark, iterations, warmup)
+        if progress is not None:
+            progress(benchmark.name, results[benchmark.name])
+    return results
@@ -0,0 +1,98 @@
+import time
+from app.db.connection import get_db_connection
+
+## Fills the settings table with generated rows. The rows are built by Postgres from
+## generate_series, so seeding millions of rows doesn't send any data over the wire.
+## With several namespaces the rows are spread round robin over the default namespace and
+## tenant_1 .. tenant_<n - 1>.
+
+# Rows inserted per transaction, keeps each statement's trigger work and WAL bounded
+SEED_CHUNK_SIZE = 50000
+
+# Data of each seeded row, i is the row number. Every blob has the keys the filter benchmarks use.
+# small is about 150 bytes, large about 8 kB with nested objects and arrays.
+BLOBS = {
+    "small": """
+        jsonb_build_object(
+            'theme', CASE WHEN mod(i, 2) = 0 THEN 'dark' ELSE 'light' END,
+            'n', i,
+            'enabled', mod(i, 3) = 0,
+            'tags', jsonb_build_array('tag' || mod(i, 10), 'tag' || mod(i, 7)),
+            'limits', jsonb_build_object('max', mod(i, 100))
+        )
+    """,
+    "large": """
+        jsonb_build_object(
+            'theme', CASE WHEN mod(i, 2) = 0 THEN 'dark' ELSE 'light' END,
+            'n', i,
+            'enabled', mod(i, 3) = 0,
+            'tags', jsonb_build_array('tag' || mod(i, 10), 'tag' || mod(i, 7)),
+            'limits', jsonb_build_object('max', mod(i, 100)),
+            'sections', (
+                SELECT jsonb_object_agg(
+                    'section_' || s,
+                    jsonb_build_object(
+                        'title', repeat(md5((i * 40 + s)::text), 2),
+                        'order', s,
+                        'values', jsonb_build_array(s, s * 2, s * 3, md5(s::text))
+                    )
+                )
+                FROM generate_series(1, 40) AS s
+            )
+        )
+    """,
+}
+
+SEED_QUERY = """
+    INSERT INTO settings (namespace, id, data, created_at, updated_at)
+    SELECT
+        CASE WHEN mod(i, %(namespaces)s) = 0 THEN 'default' ELSE 'tenant_' || mod(i, %(namespaces)s) END,
+        gen_random_uuid(),
+        {blob},
+        LOCALTIMESTAMP - make_interval(secs => (%(total)s - i) / 1000.0),
+        LOCALTIMESTAMP - make_interval(secs => (%(total)s - i) / 1000.0)
+    FROM generate_series(%(start)s, %(end)s) AS i
+"""
+
+
+def seed_settings(rows: int, blob: str = "small", truncate: bool = False, skip_history: bool = False,
+                  progress=None, namespaces: int = 1) -> float:
+    ## Inserts rows generated settings, returns the seconds taken
+    ## truncate empties the table first. skip_history turns revision recording off while seeding,
+    ## saving the time and storage of a snapshot per row.
+    if blob not in BLOBS:
+        raise ValueError(f"Unknown blob size '{blob}', expected one of {', '.join(BLOBS)}")
+    if namespaces < 1:
+        raise ValueError("At least one namespace is needed")
+    started = time.perf_counter()
+    history_enabled = None
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            if truncate:
+                cur.execute("TRUNCATE settings")
+            if skip_history:
+                cur.execute("SELECT enabled FROM settings_history_config")
+                config = cur.fetchone()
+                history_enabled = config["enabled"] if config else None
+                cur.execute("UPDATE settings_history_config SET enabled = false")
+        conn.commit()
+
+        try:
+            query = SEED_QUERY.format(blob=BLOBS[blob])
+            for start in range(1, rows + 1, SEED_CHUNK_SIZE):
+                end = min(start + SEED_CHUNK_SIZE - 1, rows)
+                with conn.cursor() as cur:
+                    cur.execute(query, {"total": rows, "start": start, "end": end, "namespaces": namespaces})
+                conn.commit()
+                if progress is not None:
+                    progress(end, rows)
+        finally:
+            if history_enabled is not None:
+                with conn.cursor() as cur:
+                    cur.execute("UPDATE settings_history_config SET enabled = %s", (history_enabled,))
+                conn.commit()
+
+        with conn.cursor() as cur:
+            # Fresh statistics, so estimated counts and plans reflect the seeded table
+            cur.execute("ANALYZE settings")
+    return time.perf_counter() - started
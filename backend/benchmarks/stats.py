@@ -0,0 +1,115 @@
+import json
+import math
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+## Latency summaries, result files and baseline comparison shared by the benchmark runners
+
+# Metrics compared against a baseline and whether a higher value is better
+COMPARED_METRICS = {"throughput": True, "p50_ms": False, "p95_ms": False, "p99_ms": False}
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    ## Nearest-rank percentile of already sorted values
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(round(len(sorted_values) * fraction, 9)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0, statuses: Optional[Dict[str, int]] = None) -> dict:
+    ## Summarizes per-call latencies in seconds measured over elapsed wall clock seconds
+    values = sorted(latencies)
+    summary = {
+        "requests": len(values),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(len(values) / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+    if statuses is not None:
+        summary["statuses"] = dict(sorted(statuses.items()))
+    return summary
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(kind: str, parameters: dict, results: Dict[str, dict]) -> dict:
+    ## Wraps results with what is needed to tell runs apart
+    return {
+        "kind": kind,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "parameters": parameters,
+        "results": results,
+    }
+
+
+def write_report(report: dict, path: Optional[str]):
+    ## Writes the report as JSON to a file, or stdout without one
+    text = json.dumps(report, indent=2, default=str)
+    if path is None:
+        print(text)
+        return
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as out:
+        out.write(text + "\n")
+
+
+def load_report(path: str) -> dict:
+    with open(path) as source:
+        return json.load(source)
+
+
+def compare_reports(baseline: dict, current: dict, threshold: float = 0.10) -> List[dict]:
+    ## Compares every benchmark present in both reports
+    ## A metric regresses when it is worse than the baseline by more than threshold (a fraction)
+    rows = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            rows.append({
+                "benchmark": name,
+                "metric": metric,
+                "baseline": old,
+                "current": new,
+                "change": round(change, 4),
+                "regressed": worse > threshold,
+            })
+    return rows
+
+
+def format_comparison(rows: List[dict]) -> str:
+    lines = [f"{'benchmark':<32} {'metric':<11} {'baseline':>12} {'current':>12} {'change':>9}"]
+    for row in rows:
+        flag = "  REGRESSED" if row["regressed"] else ""
+        lines.append(
+            f"{row['benchmark']:<32} {row['metric']:<11} {row['baseline']:>12} {row['current']:>12} "
+            f"{row['change']:>+8.1%}{flag}"
+        )
+    return "\n".join(lines)
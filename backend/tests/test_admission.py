@@ -0,0 +1,118 @@
+import asyncio
+import httpx
+import pytest
+from fastapi import FastAPI
+from app.admission import (
+    QUEUE_FULL, QUEUE_TIMEOUT, AdmissionController, AdmissionMiddleware, ConcurrencyLimit, Shed, parse_route_limits
+)
+
+def _app(controller: AdmissionController, release: asyncio.Event) -> FastAPI:
+    # Reads and writes that hold their slot until release is set
+    app = FastAPI()
+
+    @app.get("/api/settings")
+    async def read():
+        await release.wait()
+        return {}
+
+    @app.post("/api/settings")
+    async def write():
+        await release.wait()
+        return {}
+
+    @app.get("/api/settings:changes")
+    async def changes():
+        return {}
+
+    app.add_middleware(AdmissionMiddleware, controller=controller, retry_after=2, shed_status=429)
+    return app
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+class TestAdmissionControl:
+    ## Test concurrency limits, queueing and load shedding
+
+    async def test_queue_and_shed(self):
+        ## Test waiters get freed slots in order and are shed once the queue is full or they time out
+        limit = ConcurrencyLimit("read", concurrency=1, queue_size=1, queue_timeout=0.05)
+        await limit.acquire()
+
+        waiter = asyncio.create_task(limit.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Shed) as shed:
+            await limit.acquire()
+        assert shed.value.reason == QUEUE_FULL
+
+        limit.release()
+        await waiter
+        assert limit.stats()["active"] == 1 and limit.queued == 0
+
+        with pytest.raises(Shed) as shed:
+            await limit.acquire()
+        assert shed.value.reason == QUEUE_TIMEOUT
+        limit.release()
+        assert limit.stats() == {
+            "concurrency": 1, "active": 0, "queued": 0, "queue_size": 1, "admitted": 2,
+            "shed": {QUEUE_FULL: 1, QUEUE_TIMEOUT: 1},
+        }
+
+    async def test_cancelled_waiter_leaves_queue(self):
+        ## Test a request that goes away while queued doesn't keep a slot or a queue place
+        limit = ConcurrencyLimit("write", concurrency=1, queue_size=1, queue_timeout=5)
+        await limit.acquire()
+        waiter = asyncio.create_task(limit.acquire())
+        await asyncio.sleep(0)
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        limit.release()
+
+        assert (limit.active, limit.queued) == (0, 0)
+
+    async def test_reads_and_writes_have_separate_budgets(self):
+        ## Test shed requests get the status and Retry-After while the other budget keeps admitting
+        controller = AdmissionController(
+            read_concurrency=1, read_queue=0, write_concurrency=1, write_queue=0, queue_timeout=1
+        )
+        release = asyncio.Event()
+        transport = httpx.ASGITransport(app=_app(controller, release))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            write = asyncio.create_task(client.post("/api/settings"))
+            while controller.budgets["write"].active == 0:
+                await asyncio.sleep(0.001)
+
+            shed = await client.post("/api/settings")
+            assert shed.status_code == 429
+            assert shed.headers["retry-after"] == "2"
+            assert "write" in shed.json()["detail"]
+
+            read = asyncio.create_task(client.get("/api/settings"))
+            while controller.budgets["read"].active == 0:
+                await asyncio.sleep(0.001)
+            assert (await client.get("/api/settings:changes")).status_code == 200
+
+            release.set()
+            assert (await write).status_code == 200
+            assert (await read).status_code == 200
+        assert controller.budgets["read"].active == controller.budgets["write"].active == 0
+
+@pytest.mark.unit
+class TestAdmissionRoutes:
+    ## Test which limits each request takes
+
+    def test_route_limits(self):
+        ## Test routes with their own limit take a slot of it before their budget's
+        controller = AdmissionController(10, 10, 10, 10, 1, parse_route_limits("post /api/settings:import=1"))
+
+        assert [limit.name for limit in controller.limits_for("POST", "/api/settings:import")] == [
+            "POST /api/settings:import", "write"
+        ]
+        assert [limit.name for limit in controller.limits_for("POST", "/api/namespaces/app/settings:import")] == [
+            "POST /api/settings:import", "write"
+        ]
+        assert [limit.name for limit in controller.limits_for("GET", "/api/settings/abc")] == ["read"]
+        assert controller.limits_for("GET", "/api/settings:stream") == []
+        assert controller.limits_for("GET", "/health") == []
+        with pytest.raises(ValueError):
+            parse_route_limits("/api/settings:import")
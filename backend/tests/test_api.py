@@ -1,4 +1,6 @@
+import uuid
 import pytest
+from app.db import async_operations
 
 @pytest.mark.integration
 class TestSettingsAPI:
@@ -8,7 +10,10 @@ class TestSettingsAPI:
         ## Test health endpoint
         response = client.get("/health")
         assert response.status_code == 200
-        assert response.json() == {"status": "ok"}
+        body = response.json()
+        assert body["status"] == "ok"
+        assert body["database"]["reachable"] is True
+        assert body["database"]["latency_ms"] >= 0
     
     def test_create_setting(self, client, sample_setting_data):
         ## Test POST, creating a setting
@@ -66,6 +71,98 @@ class TestSettingsAPI:
         assert data["pagination"]["page"] == 1
         assert data["pagination"]["limit"] == 5
     
+    def test_get_all_settings_cursor(self, client, sample_setting_data):
+        ## Test GET following next_cursor returns the following page
+        for _ in range(3):
+            client.post("/api/settings", json={"data": sample_setting_data})
+        
+        first = client.get("/api/settings?limit=2").json()
+        next_cursor = first["pagination"]["next_cursor"]
+        assert next_cursor is not None
+        
+        response = client.get(f"/api/settings?limit=2&cursor={next_cursor}")
+        assert response.status_code == 200
+        second_ids = {s["id"] for s in response.json()["data"]}
+        assert second_ids
+        assert not second_ids & {s["id"] for s in first["data"]}
+    
+    def test_get_all_settings_invalid_cursor(self, client):
+        ## Test GET with an invalid cursor
+        response = client.get("/api/settings?cursor=garbage")
+        
+        assert response.status_code == 400
+    
+    def test_get_all_settings_count_strategy(self, client):
+        ## Test GET with a count strategy
+        response = client.get("/api/settings?count=cached")
+        
+        assert response.status_code == 200
+        pagination = response.json()["pagination"]
+        assert pagination["count_strategy"] == "cached"
+        assert pagination["total"] >= 0
+    
+    def test_get_all_settings_without_total(self, client):
+        ## Test GET with include_total=false
+        response = client.get("/api/settings?include_total=false")
+        
+        assert response.status_code == 200
+        pagination = response.json()["pagination"]
+        assert pagination["total"] is None
+        assert pagination["total_pages"] is None
+        assert pagination["count_strategy"] == "none"
+    
+    def test_get_all_settings_filtered(self, client):
+        ## Test filtering the listing on data
+        marker = str(uuid.uuid4())
+        client.post("/api/settings", json={"data": {"marker": marker, "theme": "dark"}})
+        client.post("/api/settings", json={"data": {"marker": marker, "theme": "light"}})
+        
+        response = client.get(
+            "/api/settings",
+            params={"contains": f'{{"marker": "{marker}", "theme": "dark"}}', "count": "cached"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert [s["data"]["theme"] for s in data["data"]] == ["dark"]
+        assert data["pagination"]["total"] == 1
+        assert data["pagination"]["count_strategy"] == "exact"
+        
+        response = client.get("/api/settings", params={"jsonpath": f'$.marker ? (@ == "{marker}")', "has_any": ["theme", "x"]})
+        assert response.json()["pagination"]["total"] == 2
+        
+        assert client.get("/api/settings", params={"contains": "{"}).status_code == 400
+    
+    def test_get_setting_changes(self, client):
+        ## Test long-polling the change feed from a position
+        start = client.get("/api/settings:changes", params={"wait": 0}).json()["position"]
+        setting_id = client.post("/api/settings", json={"data": {"a": 1}}).json()["id"]
+        
+        response = client.get("/api/settings:changes", params={"after": start, "ids": [setting_id], "wait": 5})
+        
+        assert response.status_code == 200
+        body = response.json()
+        assert [(c["op"], c["id"]) for c in body["changes"]] == [("create", setting_id)]
+        empty = client.get("/api/settings:changes", params={"after": body["position"], "ids": [setting_id], "wait": 0})
+        assert empty.json()["changes"] == []
+        assert client.get("/api/settings:changes", params={"after": "x"}).status_code == 400
+        assert client.get("/api/settings:stream", params={"after": "x"}).status_code == 400
+    
+    def test_sync_settings(self, client):
+        ## Test delta sync from a watermark
+        watermark = client.get("/api/settings:sync").json()["watermark"]
+        kept = client.post("/api/settings", json={"data": {"a": 1}}).json()["id"]
+        gone = client.post("/api/settings", json={"data": {"b": 1}}).json()["id"]
+        client.delete(f"/api/settings/{gone}")
+        
+        response = client.get("/api/settings:sync", params={"since": watermark})
+        
+        assert response.status_code == 200
+        body = response.json()
+        assert [s["id"] for s in body["settings"]] == [kept]
+        assert body["deleted"] == [gone]
+        assert body["has_more"] is False
+        assert client.get("/api/settings:sync", params={"since": "1"}).status_code == 400
+    
     def test_get_setting_by_id(self, client, sample_setting_data):
         ## Test GET with UID, retrieving specific setting
         create_response = client.post(
@@ -88,6 +185,128 @@ class TestSettingsAPI:
         assert response.status_code == 404
         assert "not found" in response.json()["detail"].lower()
     
+    def test_get_setting_etag(self, client, sample_setting_data):
+        ## Test GET returns validators and 304 for a matching If-None-Match
+        setting_id = client.post("/api/settings", json={"data": sample_setting_data}).json()["id"]
+        
+        response = client.get(f"/api/settings/{setting_id}")
+        etag = response.headers["etag"]
+        assert response.headers["last-modified"]
+        
+        not_modified = client.get(f"/api/settings/{setting_id}", headers={"If-None-Match": etag})
+        assert not_modified.status_code == 304
+        assert not_modified.content == b""
+        assert not_modified.headers["etag"] == etag
+    
+    def test_get_setting_etag_changes_on_update(self, client, sample_setting_data):
+        ## Test a stale ETag returns the new representation
+        setting_id = client.post("/api/settings", json={"data": sample_setting_data}).json()["id"]
+        etag = client.get(f"/api/settings/{setting_id}").headers["etag"]
+        
+        client.put(f"/api/settings/{setting_id}", json={"data": {"changed": True}})
+        response = client.get(f"/api/settings/{setting_id}", headers={"If-None-Match": etag})
+        
+        assert response.status_code == 200
+        assert response.json()["data"] == {"changed": True}
+        assert response.headers["etag"] != etag
+    
+    def test_get_setting_if_modified_since(self, client, sample_setting_data):
+        ## Test If-Modified-Since with the Last-Modified date
+        setting_id = client.post("/api/settings", json={"data": sample_setting_data}).json()["id"]
+        last_modified = client.get(f"/api/settings/{setting_id}").headers["last-modified"]
+        
+        response = client.get(f"/api/settings/{setting_id}", headers={"If-Modified-Since": last_modified})
+        assert response.status_code == 304
+        
+        response = client.get(
+            f"/api/settings/{setting_id}",
+            headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"}
+        )
+        assert response.status_code == 200
+    
+    def test_get_setting_conditional_not_found(self, client):
+        ## Test conditional GET of a missing setting
+        response = client.get(
+            "/api/settings/00000000-0000-0000-0000-000000000000",
+            headers={"If-None-Match": '"abc"'}
+        )
+        assert response.status_code == 404
+    
+    def test_get_all_settings_etag(self, client, sample_setting_data, monkeypatch):
+        ## Test listing ETags change when a setting is added and a match is answered without rendering the page
+        client.post("/api/settings", json={"data": sample_setting_data})
+        etag = client.get("/api/settings").headers["etag"]
+        rendered = []
+        render = async_operations.get_all_settings_json
+
+        async def counting_render(*args, **kwargs):
+            rendered.append(args)
+            return await render(*args, **kwargs)
+        monkeypatch.setattr(async_operations, "get_all_settings_json", counting_render)
+        
+        assert client.get("/api/settings", headers={"If-None-Match": etag}).status_code == 304
+        assert rendered == []
+        
+        client.post("/api/settings", json={"data": sample_setting_data})
+        changed = client.get("/api/settings", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["etag"] != etag
+        assert client.get("/api/settings", headers={"If-None-Match": changed.headers["etag"]}).status_code == 304
+        assert changed.json()["pagination"]["total"] == client.get("/api/settings").json()["pagination"]["total"]
+    
+    def test_batch_settings(self, client, sample_setting_data):
+        ## Test POST batch with creates and deletes
+        setting_id = client.post("/api/settings", json={"data": sample_setting_data}).json()["id"]
+        
+        response = client.post("/api/settings:batch", json={
+            "create": [{"data": {"batch": 1}}, {"data": {"batch": 2}}],
+            "delete": [setting_id]
+        })
+        
+        assert response.status_code == 200
+        body = response.json()
+        assert body["committed"] is True
+        assert [r["status"] for r in body["results"]] == [201, 201, 204]
+        assert body["results"][0]["setting"]["data"] == {"batch": 1}
+        assert client.get(f"/api/settings/{setting_id}").status_code == 404
+    
+    def test_batch_settings_atomic_conflict(self, client):
+        ## Test a failed atomic batch returns 409 and applies nothing
+        response = client.post("/api/settings:batch", json={
+            "create": [{"data": {"batch": 1}}],
+            "update": [{"id": "00000000-0000-0000-0000-000000000000", "data": {}}]
+        })
+        
+        assert response.status_code == 409
+        body = response.json()
+        assert body["committed"] is False
+        assert client.get(f"/api/settings/{body['results'][0]['id']}").status_code == 404
+    
+    def test_export_and_import(self, client):
+        ## Test exporting as NDJSON and importing it back with upsert
+        setting_id = client.post("/api/settings", json={"data": {"export": 1}}).json()["id"]
+        
+        export = client.get("/api/settings:export")
+        assert export.status_code == 200
+        assert export.headers["content-type"].startswith("application/x-ndjson")
+        line = next(line for line in export.content.splitlines() if setting_id.encode() in line)
+        
+        conflict = client.post("/api/settings:import", content=line)
+        assert conflict.status_code == 409
+        
+        response = client.post("/api/settings:import?upsert=true", content=line)
+        assert response.status_code == 200
+        assert response.json()["updated"] == 1
+    
+    def test_import_invalid(self, client):
+        ## Test importing a malformed line
+        response = client.post("/api/settings:import", content=b"not json\n")
+        
+        assert response.status_code == 400
+        bad_timestamp = client.post("/api/settings:import", content=b'{"data": {}, "updated_at": "not a time"}\n')
+        assert bad_timestamp.status_code == 400
+        assert "Line 1" in bad_timestamp.json()["detail"]
+    
     def test_update_setting(self, client, sample_setting_data):
         ## Test PUT with UID, updating setting
         create_response = client.post(
@@ -116,6 +335,73 @@ class TestSettingsAPI:
         
         assert response.status_code == 404
     
+    def test_patch_setting(self, client):
+        ## Test PATCH with merge patch and JSON patch content types
+        setting_id = client.post("/api/settings", json={"data": {"a": 1, "b": {"c": 2}}}).json()["id"]
+        
+        response = client.patch(
+            f"/api/settings/{setting_id}",
+            content='{"a": null, "b": {"d": 3}}',
+            headers={"Content-Type": "application/merge-patch+json"}
+        )
+        assert response.status_code == 200
+        assert response.json()["data"] == {"b": {"c": 2, "d": 3}}
+        
+        response = client.patch(
+            f"/api/settings/{setting_id}",
+            content='[{"op": "move", "from": "/b/c", "path": "/c"}]',
+            headers={"Content-Type": "application/json-patch+json"}
+        )
+        assert response.status_code == 200
+        assert response.json()["data"] == {"b": {"d": 3}, "c": 2}
+    
+    def test_patch_setting_errors(self, client):
+        ## Test PATCH conflicts, invalid patches and missing settings
+        setting_id = client.post("/api/settings", json={"data": {"a": 1}}).json()["id"]
+        
+        conflict = client.patch(f"/api/settings/{setting_id}", json=[{"op": "test", "path": "/a", "value": 2}])
+        assert conflict.status_code == 409
+        
+        # Only 0 and unpadded positive numbers index arrays (RFC 6901), -1 isn't the last element
+        client.put(f"/api/settings/{setting_id}", json={"data": {"arr": [1, 2]}})
+        for operation in (
+            {"op": "remove", "path": "/arr/-1"},
+            {"op": "replace", "path": "/arr/-1", "value": 0},
+            {"op": "test", "path": "/arr/-1", "value": 2},
+        ):
+            assert client.patch(f"/api/settings/{setting_id}", json=[operation]).status_code == 409
+        assert client.get(f"/api/settings/{setting_id}").json()["data"] == {"arr": [1, 2]}
+        
+        invalid = client.patch(f"/api/settings/{setting_id}", json=[{"op": "add", "path": "a", "value": 2}])
+        assert invalid.status_code == 422
+        
+        missing = client.patch("/api/settings/00000000-0000-0000-0000-000000000000", json={"a": 2})
+        assert missing.status_code == 404
+    
+    def test_setting_revisions(self, client):
+        ## Test listing, fetching and restoring revisions
+        setting_id = client.post("/api/settings", json={"data": {"v": 1}}).json()["id"]
+        client.put(f"/api/settings/{setting_id}", json={"data": {"v": 2}})
+        
+        revisions = client.get(f"/api/settings/{setting_id}/revisions").json()
+        assert [(r["revision"], r["op"]) for r in revisions] == [(2, "update"), (1, "create")]
+        assert client.get(f"/api/settings/{setting_id}/revisions/1").json()["data"] == {"v": 1}
+        assert client.get(f"/api/settings/{setting_id}/revisions/9").status_code == 404
+        
+        restored = client.post(f"/api/settings/{setting_id}/revisions/1:restore")
+        assert restored.status_code == 200
+        assert client.get(f"/api/settings/{setting_id}").json()["data"] == {"v": 1}
+        
+        as_of = client.get(f"/api/settings/{setting_id}", params={"as_of": "2000-01-01T00:00:00Z"})
+        assert as_of.status_code == 404
+        assert client.get("/api/settings/00000000-0000-0000-0000-000000000000/revisions").status_code == 404
+
+        # Revisions are INTEGERs, larger numbers are rejected before reaching the database
+        too_large = 2**31
+        assert client.get(f"/api/settings/{setting_id}/revisions/{too_large}").status_code == 422
+        assert client.post(f"/api/settings/{setting_id}/revisions/{too_large}:restore").status_code == 422
+        assert client.get(f"/api/settings/{setting_id}/revisions", params={"before": too_large}).status_code == 422
+    
     def test_delete_setting(self, client, sample_setting_data):
         ## Test DELETE
         create_response = client.post(
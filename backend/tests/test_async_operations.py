@@ -0,0 +1,105 @@
+import pytest
+import pytest_asyncio
+from app.db import async_operations
+from app.db.async_connection import close_async_pool
+from app.db.replicas import replica_router
+from app.db.feed import change_hub
+from app.api.settings import change_stream
+import asyncio
+
+@pytest_asyncio.fixture
+async def async_db(test_db):
+    # Async pools and write batcher are bound to the test's event loop, close them afterwards
+    yield
+    await async_operations.write_batcher.close()
+    await replica_router.close_async()
+    await close_async_pool()
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+class TestAsyncDatabaseOperations:
+    ## Test async database operations
+
+    async def test_create_setting(self, async_db, sample_setting_data):
+        ## Test creating a setting
+        setting = await async_operations.create_setting(sample_setting_data)
+
+        assert setting.id is not None
+        assert setting.data == sample_setting_data
+        assert setting.created_at is not None
+
+    async def test_get_all_settings(self, async_db):
+        ## Test listing settings
+        await async_operations.create_setting({"test": "1"})
+        await async_operations.create_setting({"test": "2"})
+
+        settings, total = await async_operations.get_all_settings(page=1, limit=10)
+
+        assert len(settings) >= 2
+        assert total >= 2
+
+    async def test_get_setting_by_id(self, async_db):
+        ## Test retrieving a setting by UID
+        created = await async_operations.create_setting({"test": "data"})
+
+        found = await async_operations.get_setting_by_id(str(created.id))
+
+        assert found is not None
+        assert found.id == created.id
+        assert found.data == created.data
+
+    async def test_get_setting_by_id_invalid_uuid(self, async_db):
+        ## Test retrieving invalid UID
+        assert await async_operations.get_setting_by_id("invalid-uuid") is None
+
+    async def test_update_setting(self, async_db):
+        ## Test updating a setting
+        original = await async_operations.create_setting({"version": 1})
+
+        updated = await async_operations.update_setting(str(original.id), {"version": 2})
+
+        assert updated is not None
+        assert updated.data == {"version": 2}
+        assert updated.updated_at > original.updated_at
+
+    async def test_update_setting_not_found(self, async_db):
+        ## Test updating non-existent setting
+        result = await async_operations.update_setting(
+            "00000000-0000-0000-0000-000000000000", {"test": "data"}
+        )
+        assert result is None
+
+    async def test_delete_setting(self, async_db):
+        ## Test deleting a setting, twice and with an invalid UID
+        setting = await async_operations.create_setting({"delete": "me"})
+
+        assert await async_operations.delete_setting(str(setting.id)) is True
+        assert await async_operations.delete_setting(str(setting.id)) is True
+        assert await async_operations.delete_setting("invalid-uuid") is True
+        assert await async_operations.get_setting_by_id(str(setting.id)) is None
+
+    async def test_get_changes(self, async_db):
+        ## Test reading the change feed
+        _, start = await async_operations.get_changes()
+        created = await async_operations.create_setting({"test": "data"})
+        await async_operations.delete_setting(str(created.id))
+
+        changes, _ = await async_operations.get_changes(start, ids=[created.id])
+
+        assert [(c.op, c.id) for c in changes] == [("create", created.id), ("delete", created.id)]
+
+    async def test_change_stream(self, async_db):
+        ## Test the event stream delivers a change once the hub is rung
+        _, start = await async_operations.get_changes()
+        stream = change_stream(start, None)
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.1)
+
+        created = await async_operations.create_setting({"test": "stream"})
+        change_hub.ring()
+        event = await asyncio.wait_for(first, 5)
+        await stream.aclose()
+
+        assert event.startswith("id: ")
+        assert f'"id":"{created.id}"' in event
+        assert '"op":"create"' in event
@@ -0,0 +1,37 @@
+import pytest
+from benchmarks.stats import percentile, summarize, compare_reports
+
+@pytest.mark.unit
+class TestBenchmarkStats:
+    ## Test benchmark summaries and baseline comparison
+
+    def test_summarize(self):
+        ## Test nearest-rank percentiles and throughput
+        latencies = [i / 1000 for i in range(100, 0, -1)]
+
+        summary = summarize(latencies, elapsed=2.0, errors=1, statuses={"200": 99, "500": 1})
+
+        assert percentile([], 0.5) == 0.0
+        assert summary["requests"] == 100
+        assert summary["throughput"] == 50.0
+        assert (summary["p50_ms"], summary["p95_ms"], summary["p99_ms"], summary["max_ms"]) == (50.0, 95.0, 99.0, 100.0)
+        assert summary["statuses"] == {"200": 99, "500": 1}
+
+    def test_compare_reports(self):
+        ## Test regressions are flagged past the threshold in the worse direction only
+        baseline = {"results": {
+            "get": {"throughput": 100.0, "p50_ms": 10.0, "p95_ms": 20.0, "p99_ms": 30.0},
+            "removed": {"throughput": 1.0},
+        }}
+        current = {"results": {
+            "get": {"throughput": 80.0, "p50_ms": 5.0, "p95_ms": 21.0, "p99_ms": 40.0},
+            "added": {"throughput": 1.0},
+        }}
+
+        rows = {row["metric"]: row for row in compare_reports(baseline, current, threshold=0.1)}
+
+        assert set(rows) == {"throughput", "p50_ms", "p95_ms", "p99_ms"}
+        assert rows["throughput"]["regressed"] and rows["throughput"]["change"] == -0.2
+        assert not rows["p50_ms"]["regressed"]
+        assert not rows["p95_ms"]["regressed"]
+        assert rows["p99_ms"]["regressed"]
@@ -0,0 +1,142 @@
+import pytest
+import time
+import json
+from app.db.cache import SettingsCache, settings_cache, cache_key
+from app.db.connection import get_db_connection
+from app.db.notifications import ChangeListener
+from app.db.operations import get_setting_by_id, update_setting, delete_setting
+
+@pytest.mark.unit
+class TestSettingsCache:
+    ## Test the LRU/TTL cache
+
+    def test_hit_and_miss(self):
+        ## Test lookups are counted
+        cache = SettingsCache(max_entries=10, max_bytes=1000, ttl=60)
+        cache.resume()
+        cache.put("a", 1, 10, cache.fill_token())
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_evicts_least_recently_used(self):
+        ## Test the entry limit evicts the oldest untouched entry
+        cache = SettingsCache(max_entries=2, max_bytes=1000, ttl=60)
+        cache.resume()
+        cache.put("a", 1, 10, cache.fill_token())
+        cache.put("b", 2, 10, cache.fill_token())
+        cache.get("a")
+        cache.put("c", 3, 10, cache.fill_token())
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.stats()["evictions"] == 1
+
+    def test_byte_limit(self):
+        ## Test entries are evicted to stay under the byte limit
+        cache = SettingsCache(max_entries=10, max_bytes=100, ttl=60)
+        cache.resume()
+        cache.put("a", 1, 60, cache.fill_token())
+        cache.put("b", 2, 60, cache.fill_token())
+        cache.put("huge", 3, 500, cache.fill_token())
+
+        assert cache.get("a") is None
+        assert cache.get("huge") is None
+        assert cache.stats()["bytes"] == 60
+
+    def test_ttl_expiry(self):
+        ## Test expired entries are not served
+        cache = SettingsCache(max_entries=10, max_bytes=1000, ttl=0.01)
+        cache.resume()
+        cache.put("a", 1, 10, cache.fill_token())
+        time.sleep(0.02)
+
+        assert cache.get("a") is None
+        assert cache.stats()["expirations"] == 1
+
+    def test_fill_after_invalidation_is_dropped(self):
+        ## Test a value read before a concurrent write is not cached
+        cache = SettingsCache(max_entries=10, max_bytes=1000, ttl=60)
+        cache.resume()
+        token = cache.fill_token()
+        cache.invalidate("a")
+        cache.put("a", "stale", 10, token)
+
+        assert cache.get("a") is None
+
+    def test_suspended_cache_is_bypassed(self):
+        ## Test nothing is served while suspended
+        cache = SettingsCache(max_entries=10, max_bytes=1000, ttl=60)
+        cache.resume()
+        cache.put("a", 1, 10, cache.fill_token())
+        cache.suspend()
+
+        assert cache.get("a") is None
+        cache.resume()
+        assert cache.stats()["entries"] == 0
+
+
+@pytest.fixture
+def resumed_cache():
+    # The shared cache serves reads, as if the change listener were connected
+    settings_cache.resume()
+    return settings_cache
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("resumed_cache")
+class TestSettingsCacheInvalidation:
+    ## Test cache invalidation by writes and notifications
+
+    def test_get_populates_cache(self, create_test_setting):
+        ## Test a lookup is served from the cache the second time
+        setting = create_test_setting({"cached": True})
+        get_setting_by_id(str(setting.id))
+        hits = settings_cache.hits
+
+        assert get_setting_by_id(str(setting.id)).data == {"cached": True}
+        assert settings_cache.hits == hits + 1
+
+    def test_update_invalidates(self, create_test_setting):
+        ## Test an update is visible immediately
+        setting = create_test_setting({"version": 1})
+        get_setting_by_id(str(setting.id))
+        update_setting(str(setting.id), {"version": 2})
+
+        assert get_setting_by_id(str(setting.id)).data == {"version": 2}
+
+    def test_delete_invalidates(self, create_test_setting):
+        ## Test a delete is visible immediately
+        setting = create_test_setting()
+        get_setting_by_id(str(setting.id))
+        delete_setting(str(setting.id))
+
+        assert get_setting_by_id(str(setting.id)) is None
+
+    def test_notification_invalidates(self, create_test_setting):
+        ## Test a write from another process reaches the listener
+        setting = create_test_setting({"version": 1})
+        received = []
+        listener = ChangeListener()
+        listener.subscribe(received.append)
+        listener.start()
+        try:
+            deadline = time.monotonic() + 5
+            while not listener.connected and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            with get_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "UPDATE settings SET data = %s WHERE id = %s",
+                        (json.dumps({"version": 2}), str(setting.id))
+                    )
+
+            while not received and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            listener.stop()
+
+        assert received[0]["op"] == "UPDATE"
+        assert cache_key(received[0]["id"]) == str(setting.id)
@@ -0,0 +1,133 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from app.db.operations import update_setting, delete_setting, get_setting_by_id, patch_setting
+from app.db.history import (
+    list_revisions,
+    get_revision,
+    get_setting_as_of,
+    restore_revision,
+    compact_history,
+    RevisionNotRestorableError
+)
+
+@pytest.fixture
+def snapshot_interval(db_connection):
+    # Sets a small snapshot interval for the test, restoring the configured one afterwards
+    def _set(interval):
+        with db_connection.cursor() as cur:
+            cur.execute("SELECT snapshot_interval FROM settings_history_config")
+            previous.append(cur.fetchone()["snapshot_interval"])
+            cur.execute("UPDATE settings_history_config SET snapshot_interval = %s", (interval,))
+        db_connection.commit()
+
+    previous = []
+    yield _set
+    if previous:
+        with db_connection.cursor() as cur:
+            cur.execute("UPDATE settings_history_config SET snapshot_interval = %s", (previous[0],))
+        db_connection.commit()
+
+def _stored(db_connection, setting_id):
+    with db_connection.cursor() as cur:
+        cur.execute(
+            "SELECT revision, snapshot IS NOT NULL AS snapshot, diff FROM settings_revisions WHERE setting_id = %s ORDER BY revision",
+            (str(setting_id),)
+        )
+        rows = cur.fetchall()
+    db_connection.commit()
+    return rows
+
+@pytest.mark.unit
+class TestHistory:
+    ## Test settings revision history
+
+    def test_revisions_rebuild_every_version(self, create_test_setting, db_connection, snapshot_interval):
+        ## Test diffs and periodic snapshots rebuild the data of each revision
+        snapshot_interval(3)
+        versions = [
+            {"theme": {"color": "red", "size": 1}, "tags": ["a"]},
+            {"theme": {"color": "blue", "size": 1}, "tags": ["a"]},
+            {"theme": {"color": "blue"}, "tags": ["a", "b"], "new": 1},
+            {"theme": {"color": "blue"}, "tags": ["a", "b"], "new": None},
+            {"theme": "flat"},
+            {"theme": "flat", "more": {"nested": True}},
+        ]
+        setting = create_test_setting(versions[0])
+        for data in versions[1:]:
+            update_setting(str(setting.id), data)
+        # Rewriting the same data isn't a new revision
+        update_setting(str(setting.id), versions[-1])
+
+        for revision, data in enumerate(versions, start=1):
+            assert get_revision(str(setting.id), revision).data == data
+
+        stored = _stored(db_connection, setting.id)
+        assert len(stored) == len(versions)
+        # 1 is the create, 3 and 6 are periodic, 4 sets a null value which a merge patch can't express
+        assert [row["revision"] for row in stored if row["snapshot"]] == [1, 3, 4, 6]
+        assert stored[1]["diff"] == {"theme": {"color": "blue"}}
+        assert stored[4]["diff"] == {"theme": "flat", "tags": None, "new": None}
+
+    def test_list_revisions(self, create_test_setting):
+        ## Test listing revisions newest first with paging
+        setting = create_test_setting({"v": 1})
+        update_setting(str(setting.id), {"v": 2})
+        delete_setting(str(setting.id))
+
+        revisions = list_revisions(str(setting.id))
+
+        assert [(r.revision, r.op) for r in revisions] == [(3, "delete"), (2, "update"), (1, "create")]
+        assert all(r.data is None for r in revisions)
+        assert [r.revision for r in list_revisions(str(setting.id), limit=1, before=3)] == [2]
+        assert list_revisions("not-a-uuid") == []
+
+    def test_setting_as_of(self, create_test_setting, db_connection):
+        ## Test reading a setting at points in time
+        setting = create_test_setting({"v": 1})
+        with db_connection.cursor() as cur:
+            cur.execute(
+                "UPDATE settings_revisions SET recorded_at = recorded_at - interval '1 hour' WHERE setting_id = %s",
+                (str(setting.id),)
+            )
+        db_connection.commit()
+        update_setting(str(setting.id), {"v": 2})
+        now = datetime.now(timezone.utc)
+
+        assert get_setting_as_of(str(setting.id), now - timedelta(minutes=30)).data == {"v": 1}
+        assert get_setting_as_of(str(setting.id), now + timedelta(minutes=1)).data == {"v": 2}
+        assert get_setting_as_of(str(setting.id), now - timedelta(hours=2)) is None
+
+    def test_restore_revision(self, create_test_setting):
+        ## Test restoring an old revision, including after the setting was deleted
+        setting = create_test_setting({"v": 1})
+        patch_setting(str(setting.id), merge_patch={"v": 2})
+        delete_setting(str(setting.id))
+
+        with pytest.raises(RevisionNotRestorableError):
+            restore_revision(str(setting.id), 3)
+        restored = restore_revision(str(setting.id), 1)
+
+        assert restored.data == {"v": 1}
+        assert get_setting_by_id(str(setting.id)).data == {"v": 1}
+        assert list_revisions(str(setting.id), limit=1)[0].op == "create"
+        assert restore_revision(str(setting.id), 99) is None
+
+    def test_compact_history(self, create_test_setting, db_connection, snapshot_interval):
+        ## Test compaction drops old revisions and keeps the rest rebuildable
+        snapshot_interval(100)
+        setting = create_test_setting({"v": 1})
+        for version in range(2, 6):
+            update_setting(str(setting.id), {"v": version})
+        with db_connection.cursor() as cur:
+            cur.execute(
+                "UPDATE settings_revisions SET recorded_at = recorded_at - interval '2 days' WHERE setting_id = %s AND revision <= 3",
+                (str(setting.id),)
+            )
+        db_connection.commit()
+
+        assert compact_history(retention=24 * 3600) >= 3
+
+        assert [r.revision for r in list_revisions(str(setting.id))] == [5, 4]
+        assert get_revision(str(setting.id), 4).data == {"v": 4}
+        assert get_revision(str(setting.id), 5).data == {"v": 5}
+        assert compact_history(retention=0) == 0
@@ -0,0 +1,64 @@
+import pytest
+from prometheus_client import REGISTRY
+from app.db.instrumentation import METRICS_ENABLED, statement_command
+from app.db.operations import get_setting_version
+
+def _sample(name, labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+@pytest.mark.unit
+class TestMetrics:
+    ## Test request and statement metrics
+
+    def test_statement_command(self):
+        ## Test statements are labelled by their command only
+        assert statement_command("\n    SELECT id FROM settings") == "select"
+        assert statement_command(b"with pruned AS (DELETE ...)") == "with"
+        assert statement_command("VACUUM settings") == "other"
+        assert statement_command(None) == "other"
+        assert statement_command("EXECUTE settings_update (%s, %s)") == "update"
+        assert statement_command("EXECUTE unknown_statement") == "execute"
+
+    @pytest.mark.skipif(not METRICS_ENABLED, reason="metrics are disabled")
+    def test_statements_recorded(self, create_test_setting):
+        ## Test sync statements are timed and their rows counted
+        setting = create_test_setting()
+        labels = {"driver": "psycopg2", "command": "select"}
+        count = _sample("db_statement_duration_seconds_count", labels)
+        rows = _sample("db_statement_rows_total", labels)
+
+        get_setting_version(str(setting.id))
+
+        assert _sample("db_statement_duration_seconds_count", labels) >= count + 1
+        assert _sample("db_statement_rows_total", labels) >= rows + 1
+        assert _sample("db_pool_acquire_seconds_count", {"pool": "sync"}) > 0
+
+    @pytest.mark.skipif(not METRICS_ENABLED, reason="metrics are disabled")
+    def test_requests_recorded_by_route(self, client, create_test_setting):
+        ## Test requests are labelled with their route template and exposed at /metrics
+        setting = create_test_setting()
+        labels = {"method": "GET", "route": "/api/settings/{uid}", "status": "200"}
+        before = _sample("http_requests_total", labels)
+
+        client.get(f"/api/settings/{setting.id}")
+        client.get("/no/such/path")
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert _sample("http_requests_total", labels) == before + 1
+        assert _sample("http_requests_total", {"method": "GET", "route": "unmatched", "status": "404"}) >= 1
+        assert 'http_request_duration_seconds_bucket{le="0.005",method="GET",route="/api/settings/{uid}"}' in response.text
+        assert "db_statement_duration_seconds_count" in response.text
+
+    @pytest.mark.skipif(not METRICS_ENABLED, reason="metrics are disabled")
+    def test_namespaced_requests_recorded_by_their_route(self, client, create_test_setting):
+        ## Test requests to the namespaced mount of the settings router keep their own route label
+        setting = create_test_setting()
+        default = {"method": "GET", "route": "/api/settings/{uid}", "status": "404"}
+        namespaced = {"method": "GET", "route": "/api/namespaces/{namespace}/settings/{uid}", "status": "404"}
+        before = (_sample("http_requests_total", default), _sample("http_requests_total", namespaced))
+
+        client.get(f"/api/namespaces/acme/settings/{setting.id}")
+
+        assert _sample("http_requests_total", default) == before[0]
+        assert _sample("http_requests_total", namespaced) == before[1] + 1
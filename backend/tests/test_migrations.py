@@ -0,0 +1,72 @@
+import threading
+import pytest
+from app.db.connection import get_db_connection
+from app.db.history import SETTINGS_HISTORY_SNAPSHOT_INTERVAL
+from app.db.migrations import (
+    HEAD,
+    MIGRATIONS,
+    SchemaOutdatedError,
+    check_schema,
+    migrate,
+    schema_state,
+)
+
+def _forget_last_migration():
+    # The last migration only creates missing objects and replaces functions, so it can run again
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM schema_migrations WHERE version = %s", (HEAD,))
+
+@pytest.mark.unit
+class TestMigrations:
+    ## Test versioned schema migrations
+
+    def test_versions_are_sequential(self):
+        ## Test migrations are numbered 1..HEAD without gaps
+        assert [migration.version for migration in MIGRATIONS] == list(range(1, HEAD + 1))
+        assert len({migration.name for migration in MIGRATIONS}) == len(MIGRATIONS)
+
+    def test_at_head_is_a_no_op(self, test_db):
+        ## Test a migrated database passes the startup check and nothing is applied
+        assert schema_state() == (HEAD, True)
+        assert migrate() == []
+        check_schema()
+
+    def test_pending_migration_applied_once(self, test_db):
+        ## Test concurrent runs apply a pending migration exactly once
+        _forget_last_migration()
+        with pytest.raises(SchemaOutdatedError):
+            check_schema()
+
+        results = []
+        def run():
+            results.append(migrate())
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(len(applied) for applied in results) == [0, 0, 0, 1]
+        assert schema_state() == (HEAD, True)
+
+    def test_config_applied(self, test_db):
+        ## Test configuration drift is detected and applied without a migration
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("UPDATE settings_history_config SET snapshot_interval = snapshot_interval + 1")
+        assert schema_state() == (HEAD, False)
+
+        assert migrate() == []
+        assert schema_state() == (HEAD, True)
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT snapshot_interval FROM settings_history_config")
+                assert cur.fetchone()["snapshot_interval"] == SETTINGS_HISTORY_SNAPSHOT_INTERVAL
+
+    def test_migration_target(self, test_db):
+        ## Test migrating to an older target leaves later migrations pending
+        _forget_last_migration()
+        assert migrate(HEAD - 1) == []
+        assert schema_state().version == HEAD - 1
+        assert [migration.version for migration in migrate()] == [HEAD]
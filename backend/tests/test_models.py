@@ -44,4 +44,17 @@ class TestSettingModels:
         
         assert pagination.total == 100
         assert pagination.page == 2
-        assert pagination.total_pages == 10
\ No newline at end of file
+        assert pagination.total_pages == 10
+    
+    def test_pagination_info_without_total(self):
+        ## Test pagination model when the total was skipped
+        pagination = PaginationInfo(
+            total=None,
+            page=1,
+            limit=10,
+            total_pages=None,
+            count_strategy="none"
+        )
+        
+        assert pagination.total is None
+        assert pagination.next_cursor is None
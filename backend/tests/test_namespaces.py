@@ -0,0 +1,150 @@
+import json
+import re
+import uuid
+import pytest
+from app.db import operations
+from app.db.history import list_revisions, get_revision
+from app.db.transfer import export_settings, import_settings
+
+@pytest.fixture
+def namespaces():
+    # Fresh namespaces for the test, the test database is shared between tests
+    def _make(count=2):
+        return [f"test-{uuid.uuid4().hex[:12]}" for _ in range(count)]
+    return _make
+
+@pytest.mark.unit
+class TestNamespaces:
+    ## Test settings are kept apart by namespace
+
+    def test_namespaces_are_isolated(self, test_db, namespaces):
+        ## Test reads, writes, listings and counts only see their own namespace
+        first, second = namespaces()
+        setting = operations.create_setting({"theme": "dark"}, first)
+        operations.create_setting({"theme": "light"}, second)
+        operations.create_setting({"theme": "light"}, second)
+
+        assert setting.namespace == first
+        assert operations.get_setting_by_id(str(setting.id), first) == setting
+        assert operations.get_setting_by_id(str(setting.id), second) is None
+        assert operations.get_setting_by_id(str(setting.id)) is None
+        assert operations.update_setting(str(setting.id), {"v": 1}, second) is None
+        assert operations.patch_setting(str(setting.id), merge_patch={"v": 1}, namespace=second) is None
+
+        for strategy in ("exact", "cached"):
+            settings, total = operations.get_all_settings(1, 10, count_strategy=strategy, namespace=second)
+            assert total == 2
+            assert {item.namespace for item in settings} == {second}
+        page = operations.get_all_settings_json(1, 10, namespace=first)
+        assert [item["id"] for item in json.loads(page.data)] == [str(setting.id)]
+
+        operations.delete_setting(str(setting.id), second)
+        assert operations.get_setting_by_id(str(setting.id), first) is not None
+
+    def test_same_id_in_two_namespaces(self, test_db, namespaces):
+        ## Test an ID imported into two namespaces names two settings with their own history and cache entries
+        first, second = namespaces()
+        setting_id = str(uuid.uuid4())
+        line = json.dumps({"id": setting_id, "data": {"v": 0}}).encode()
+        import_settings([line], namespace=first)
+        import_settings([line], namespace=second)
+
+        assert operations.get_setting_by_id(setting_id, first).data == {"v": 0}
+        operations.update_setting(setting_id, {"v": 1}, first)
+
+        assert operations.get_setting_by_id(setting_id, first).data == {"v": 1}
+        assert operations.get_setting_by_id(setting_id, second).data == {"v": 0}
+        assert [revision.revision for revision in list_revisions(setting_id, namespace=first)] == [2, 1]
+        assert [revision.revision for revision in list_revisions(setting_id, namespace=second)] == [1]
+        assert get_revision(setting_id, 2, second) is None
+        exported = [json.loads(item) for item in b"".join(export_settings(namespace=second)).splitlines()]
+        assert [(item["id"], item["namespace"], item["data"]) for item in exported] == [(setting_id, second, {"v": 0})]
+
+    def test_changes_per_namespace(self, test_db, namespaces):
+        ## Test the change feed and sync of a namespace only report its own settings
+        first, second = namespaces()
+        _, position = operations.get_changes(namespace=first)
+        created = operations.create_setting({"v": 1}, first)
+        operations.create_setting({"v": 1}, second)
+
+        changes, _ = operations.get_changes(position, namespace=first)
+        settings, deleted, _, _ = operations.sync_settings(position, namespace=first)
+
+        assert [change.id for change in changes] == [created.id]
+        assert [setting.id for setting in settings] == [created.id] and deleted == []
+
+    def test_batch_in_namespace(self, test_db, namespaces):
+        ## Test a batch writes to its namespace and doesn't see settings of others
+        first, second = namespaces()
+        other = operations.create_setting({"v": 0}, second)
+
+        committed, results = operations.apply_batch(
+            [{"v": 1}], [(str(other.id), {"v": 2})], [], atomic=False, namespace=first
+        )
+
+        assert committed
+        assert results[0].setting.namespace == first
+        assert results[1].status == 404
+        assert operations.get_setting_by_id(str(other.id), second).data == {"v": 0}
+
+    def test_reads_are_pruned_to_one_partition(self, test_db, namespaces, db_connection):
+        ## Test lookups and listings of a namespace only scan its partition
+        first, = namespaces(1)
+        with db_connection.cursor() as cur:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = 'settings'::regclass")
+            assert cur.fetchone()["relkind"] == "p"
+            for query in (
+                "SELECT * FROM settings WHERE namespace = %s AND id = gen_random_uuid()",
+                "SELECT * FROM settings WHERE namespace = %s ORDER BY created_at DESC, id DESC LIMIT 10",
+                "SELECT COUNT(*) FROM settings WHERE namespace = %s",
+            ):
+                cur.execute("EXPLAIN (FORMAT JSON) " + query, (first,))
+                plan = json.dumps(cur.fetchone()["QUERY PLAN"])
+                assert len(set(re.findall(r'"Relation Name": "(settings[^"]*)"', plan))) == 1
+        db_connection.rollback()
+
+@pytest.mark.integration
+class TestNamespacesAPI:
+    ## Test the namespaced routes
+
+    def test_namespaced_routes(self, client, namespaces):
+        ## Test settings created under a namespace are served there and nowhere else
+        first, second = namespaces()
+        base = f"/api/namespaces/{first}/settings"
+
+        created = client.post(base, json={"data": {"theme": "dark"}})
+        assert created.status_code == 201
+        body = created.json()
+        assert body["namespace"] == first
+
+        assert client.get(f"{base}/{body['id']}").json()["data"] == {"theme": "dark"}
+        assert client.get(f"/api/settings/{body['id']}").status_code == 404
+        assert client.get(f"/api/namespaces/{second}/settings/{body['id']}").status_code == 404
+        assert client.put(f"{base}/{body['id']}", json={"data": {"theme": "light"}}).status_code == 200
+        assert client.get(base).json()["pagination"]["total"] == 1
+        assert client.get(f"{base}/{body['id']}/revisions").status_code == 200
+
+        response = client.post(f"{base}:batch", json={"create": [{"data": {"n": 1}}], "atomic": True})
+        assert response.status_code == 200
+        assert response.json()["results"][0]["setting"]["namespace"] == first
+
+        assert client.delete(f"{base}/{body['id']}").status_code == 204
+        assert client.get(f"{base}/{body['id']}").status_code == 404
+
+    def test_namespace_in_body(self, client, namespaces):
+        ## Test the default route honours a body namespace and namespaced routes reject a different one
+        first, second = namespaces()
+
+        created = client.post("/api/settings", json={"data": {}, "namespace": first})
+        assert created.json()["namespace"] == first
+        assert client.get(f"/api/namespaces/{first}/settings/{created.json()['id']}").status_code == 200
+
+        mismatch = client.post(f"/api/namespaces/{second}/settings", json={"data": {}, "namespace": first})
+        assert mismatch.status_code == 400
+        batch = client.post(f"/api/namespaces/{second}/settings:batch", json={"create": [{"data": {}, "namespace": first}]})
+        assert batch.status_code == 400
+
+    def test_invalid_namespace(self, client):
+        ## Test namespaces outside the allowed pattern are rejected
+        assert client.get("/api/namespaces/-bad/settings").status_code == 422
+        assert client.post("/api/settings", json={"data": {}, "namespace": "a/b"}).status_code == 422
@@ -1,11 +1,28 @@
+import json
+import uuid
+import psycopg2
 import pytest
 from app.db.operations import (
     create_setting,
     get_all_settings,
+    get_all_settings_json,
+    get_settings_page_version,
     get_setting_by_id,
     update_setting,
-    delete_setting
+    delete_setting,
+    patch_setting,
+    apply_batch,
+    get_changes,
+    sync_settings,
+    prune_changes
 )
+from app.db.pagination import encode_cursor, decode_cursor, InvalidCursorError
+from app.models.setting import Setting
+from app.db.connection import create_connection
+from app.db.counting import parse_count_strategy
+from app.db.feed import InvalidPositionError, PositionExpiredError
+from app.db.filters import InvalidFilterError
+from app.db.patch import parse_pointer, compile_json_patch, InvalidPatchError, PatchConflictError
 
 @pytest.mark.unit
 class TestDatabaseOperations:
@@ -51,6 +68,131 @@ class TestDatabaseOperations:
         page2, total = get_all_settings(page=2, limit=10)
         assert len(page2) >= 5
     
+    def test_get_all_settings_cursor(self, create_test_setting):
+        ## Test cursor pagination continues where the first page ended
+        for i in range(5):
+            create_test_setting({"index": i})
+        
+        page1, _ = get_all_settings(page=1, limit=3)
+        last = page1[-1]
+        page2, _ = get_all_settings(limit=3, cursor=encode_cursor(last.created_at, last.id))
+        
+        assert len(page2) >= 2
+        assert not {s.id for s in page1} & {s.id for s in page2}
+        assert (page2[0].created_at, str(page2[0].id)) < (last.created_at, str(last.id))
+    
+    def test_get_all_settings_invalid_cursor(self, db_connection):
+        ## Test an undecodable cursor is rejected
+        with pytest.raises(InvalidCursorError):
+            get_all_settings(limit=3, cursor="not-a-cursor")
+    
+    def test_cursor_round_trip(self, create_test_setting):
+        ## Test cursors decode to the encoded sort key
+        setting = create_test_setting()
+        
+        assert decode_cursor(encode_cursor(setting.created_at, setting.id)) == (setting.created_at, setting.id)
+    
+    def test_get_all_settings_count_strategies(self, create_test_setting, db_connection):
+        ## Test the cached counter matches an exact count and estimates are non-negative
+        create_test_setting()
+        
+        _, exact = get_all_settings(limit=1, count_strategy="exact")
+        _, cached = get_all_settings(limit=1, count_strategy="cached")
+        _, estimated = get_all_settings(limit=1, count_strategy="estimated")
+        
+        assert cached == exact
+        assert estimated >= 0
+    
+    def test_get_all_settings_cached_count_tracks_deletes(self, create_test_setting):
+        ## Test the cached counter follows inserts and deletes
+        _, before = get_all_settings(limit=1, count_strategy="cached")
+        setting = create_test_setting()
+        _, after_insert = get_all_settings(limit=1, count_strategy="cached")
+        delete_setting(str(setting.id))
+        _, after_delete = get_all_settings(limit=1, count_strategy="cached")
+        
+        assert after_insert == before + 1
+        assert after_delete == before
+    
+    def test_get_all_settings_without_total(self, create_test_setting):
+        ## Test skipping the total
+        create_test_setting()
+        
+        settings, total = get_all_settings(limit=1, count_strategy="none")
+        
+        assert len(settings) == 1
+        assert total is None
+    
+    def test_parse_count_strategy(self):
+        ## Test configured strategy names are case-insensitive and unknown ones are rejected
+        assert parse_count_strategy("Cached") == "cached"
+        with pytest.raises(ValueError, match="Unknown count strategy 'approximate'"):
+            parse_count_strategy("approximate")
+    
+    def test_get_all_settings_filters(self, create_test_setting):
+        ## Test each jsonb filter and that totals are restricted to matching settings
+        marker = str(uuid.uuid4())
+        dark = create_test_setting({"marker": marker, "theme": "dark", "limits": {"max": 20}})
+        light = create_test_setting({"marker": marker, "theme": "light", "beta": True})
+        
+        def ids(**filters):
+            settings, total = get_all_settings(limit=10, filters={"contains": {"marker": marker}, **filters})
+            assert total == len(settings)
+            return {s.id for s in settings}
+        
+        assert ids() == {dark.id, light.id}
+        assert ids(contains=f'{{"marker": "{marker}", "theme": "dark"}}') == {dark.id}
+        assert ids(has_key="beta") == {light.id}
+        assert ids(has_any=["beta", "limits"]) == {dark.id, light.id}
+        assert ids(has_all=["beta", "limits"]) == set()
+        assert ids(jsonpath="$.limits.max ? (@ > 10)") == {dark.id}
+    
+    def test_get_all_settings_json(self, create_test_setting):
+        ## Test the JSON rendered by Postgres matches the model listing
+        marker = str(uuid.uuid4())
+        for i in range(3):
+            create_test_setting({"marker": marker, "i": i, "nested": {"text": "tab\t\"quote\""}})
+        filters = {"contains": {"marker": marker}}
+        
+        settings, total = get_all_settings(limit=2, filters=filters)
+        result = get_all_settings_json(limit=2, filters=filters)
+        
+        assert result.total == total == 3
+        assert result.rows == 2
+        assert [Setting(**item) for item in json.loads(result.data)] == settings
+        assert result.last_key == (settings[-1].created_at, str(settings[-1].id))
+        assert get_all_settings_json(limit=2, filters=filters).version == result.version
+        assert get_settings_page_version(limit=2, filters=filters) == (result.total, result.version)
+        
+        empty = get_all_settings_json(filters={"contains": {"marker": str(uuid.uuid4())}})
+        assert (empty.data, empty.rows, empty.last_key) == ("[]", 0, None)
+    
+    def test_get_all_settings_filtered_counts(self, create_test_setting):
+        ## Test filtered totals with each strategy, cached falls back to an exact count
+        marker = str(uuid.uuid4())
+        create_test_setting({"marker": marker})
+        filters = {"contains": {"marker": marker}}
+        
+        _, cached = get_all_settings(limit=1, count_strategy="cached", filters=filters)
+        _, estimated = get_all_settings(limit=1, count_strategy="estimated", filters=filters)
+        
+        assert cached == 1
+        assert estimated >= 0
+    
+    def test_get_all_settings_invalid_filters(self, db_connection):
+        ## Test malformed filter values
+        with pytest.raises(InvalidFilterError):
+            get_all_settings(filters={"contains": "{not json"})
+        with pytest.raises(InvalidFilterError):
+            get_all_settings(filters={"has_any": []})
+        with pytest.raises(InvalidFilterError):
+            get_all_settings(filters={"jsonpath": "$.a ? ("})
+        with pytest.raises(InvalidFilterError):
+            get_all_settings_json(filters={"jsonpath": '$.a ? (@ like_regex "(")'})
+        # Errors that aren't caused by a filter aren't reported as invalid filters
+        with pytest.raises(psycopg2.errors.NumericValueOutOfRange):
+            get_all_settings(page=10**19, filters={"jsonpath": "$.a"})
+    
     def test_get_setting_by_id(self, create_test_setting):
         ## Test retreiving a setting by UID
         created = create_test_setting({"test": "data"})
@@ -84,6 +226,93 @@ class TestDatabaseOperations:
         assert updated.updated_at > original.updated_at
     
     
+    def test_patch_setting_merge_patch(self, create_test_setting):
+        ## Test merge patches merge nested objects and remove null members
+        setting = create_test_setting({"theme": {"color": "red", "size": 1}, "old": True, "tags": [1]})
+        
+        patched = patch_setting(str(setting.id), merge_patch={"theme": {"size": 2}, "old": None, "tags": [2]})
+        
+        assert patched.data == {"theme": {"color": "red", "size": 2}, "tags": [2]}
+        assert patched.updated_at >= setting.updated_at
+        assert get_setting_by_id(str(setting.id)).data == patched.data
+    
+    def test_patch_setting_json_patch(self, create_test_setting):
+        ## Test each JSON patch operation is applied in order
+        setting = create_test_setting({"a": {"b": 1}, "list": [1, 2], "gone": 0, "x~y": "z"})
+        
+        patched = patch_setting(str(setting.id), json_patch=[
+            {"op": "test", "path": "/a/b", "value": 1},
+            {"op": "add", "path": "/list/-", "value": 3},
+            {"op": "add", "path": "/list/0", "value": 0},
+            {"op": "remove", "path": "/gone"},
+            {"op": "replace", "path": "/a/b", "value": {"c": True}},
+            {"op": "copy", "from": "/a", "path": "/copied"},
+            {"op": "move", "from": "/x~0y", "path": "/moved"}
+        ])
+        
+        assert patched.data == {
+            "a": {"b": {"c": True}},
+            "list": [0, 1, 2, 3],
+            "copied": {"b": {"c": True}},
+            "moved": "z"
+        }
+    
+    def test_patch_setting_conflict(self, create_test_setting):
+        ## Test a failed test operation or a missing path leaves the setting unchanged
+        setting = create_test_setting({"version": 1})
+        
+        with pytest.raises(PatchConflictError):
+            patch_setting(str(setting.id), json_patch=[
+                {"op": "replace", "path": "/version", "value": 2},
+                {"op": "test", "path": "/version", "value": 1}
+            ])
+        with pytest.raises(PatchConflictError):
+            patch_setting(str(setting.id), json_patch=[{"op": "remove", "path": "/missing"}])
+        
+        assert get_setting_by_id(str(setting.id)).data == {"version": 1}
+    
+    def test_patch_setting_array_indexes(self, create_test_setting):
+        ## Test array tokens other than 0 or an unpadded positive index name no element
+        setting = create_test_setting({"arr": [1, 2, 3], "nested": [{"a": 1}]})
+        
+        for operation in (
+            {"op": "remove", "path": "/arr/-1"},
+            {"op": "remove", "path": "/arr/01"},
+            {"op": "replace", "path": "/arr/-1", "value": 0},
+            {"op": "test", "path": "/arr/-1", "value": 3},
+            {"op": "replace", "path": "/nested/-1/a", "value": 2},
+            {"op": "add", "path": "/nested/-1/b", "value": 2},
+            {"op": "move", "from": "/arr/-1", "path": "/moved"},
+            {"op": "copy", "from": "/arr/01", "path": "/copied"},
+        ):
+            with pytest.raises(PatchConflictError):
+                patch_setting(str(setting.id), json_patch=[operation])
+        
+        patched = patch_setting(str(setting.id), json_patch=[
+            {"op": "test", "path": "/arr/2", "value": 3},
+            {"op": "remove", "path": "/arr/0"},
+            {"op": "replace", "path": "/nested/0/a", "value": 2},
+        ])
+        assert patched.data == {"arr": [2, 3], "nested": [{"a": 2}]}
+    
+    def test_patch_setting_not_found(self, db_connection):
+        ## Test patching a missing or invalid ID
+        assert patch_setting("00000000-0000-0000-0000-000000000000", merge_patch={"a": 1}) is None
+        assert patch_setting("not-a-uuid", merge_patch={"a": 1}) is None
+    
+    def test_compile_json_patch_invalid(self):
+        ## Test malformed patches are rejected before reaching the database
+        assert parse_pointer("") == []
+        assert parse_pointer("/a~1b/~0c") == ["a/b", "~c"]
+        with pytest.raises(InvalidPatchError):
+            parse_pointer("a")
+        with pytest.raises(InvalidPatchError):
+            compile_json_patch([{"op": "add", "path": "/a"}])
+        with pytest.raises(InvalidPatchError):
+            compile_json_patch([{"op": "replace", "path": "", "value": [1]}])
+        with pytest.raises(InvalidPatchError):
+            compile_json_patch([{"op": "explode", "path": "/a"}])
+    
     def test_delete_setting(self, create_test_setting):
         ## Test delete setting
         setting = create_test_setting({"delete": "me"})
@@ -107,4 +336,145 @@ class TestDatabaseOperations:
     def test_delete_setting_invalid_uuid(self, db_connection):
         ## Test deleting invalid UID
         result = delete_setting("invalid-uuid")
-        assert result is True
\ No newline at end of file
+        assert result is True
+    
+    def test_apply_batch(self, create_test_setting):
+        ## Test creates, updates and deletes in one batch
+        existing = create_test_setting({"version": 1})
+        doomed = create_test_setting({"delete": "me"})
+        
+        committed, results = apply_batch(
+            creates=[{"new": 1}, {"new": 2}],
+            updates=[(str(existing.id), {"version": 2})],
+            deletes=[str(doomed.id)]
+        )
+        
+        assert committed is True
+        assert [r.status for r in results] == [201, 201, 200, 204]
+        assert get_setting_by_id(results[0].id).data == {"new": 1}
+        assert get_setting_by_id(str(existing.id)).data == {"version": 2}
+        assert get_setting_by_id(str(doomed.id)) is None
+    
+    def test_apply_batch_atomic_rolls_back(self, create_test_setting):
+        ## Test one missing setting rolls back the whole atomic batch
+        committed, results = apply_batch(
+            creates=[{"new": 1}],
+            updates=[("00000000-0000-0000-0000-000000000000", {"version": 2})],
+            deletes=[]
+        )
+        
+        assert committed is False
+        assert results[0].status == 424
+        assert results[1].status == 404
+        assert get_setting_by_id(results[0].id) is None
+    
+    def test_apply_batch_best_effort(self, create_test_setting):
+        ## Test best-effort batches keep the items that succeeded
+        committed, results = apply_batch(
+            creates=[{"new": 1}],
+            updates=[("not-a-uuid", {"version": 2}), ("00000000-0000-0000-0000-000000000000", {})],
+            deletes=[],
+            atomic=False,
+            return_settings=False
+        )
+        
+        assert committed is True
+        assert [r.status for r in results] == [201, 400, 404]
+        assert results[0].setting is None
+        assert get_setting_by_id(results[0].id).data == {"new": 1}
+    
+    def test_apply_batch_best_effort_isolates_items(self, create_test_setting):
+        ## Test a document Postgres rejects fails on its own, the rest of its statement is still written
+        setting = create_test_setting({"version": 1})
+        committed, results = apply_batch(
+            creates=[{"ok": 1}, {"bad": "\u0000"}, {"ok": 2}],
+            updates=[(str(setting.id), {"bad": "\u0000"}), (str(setting.id), {"version": 2})],
+            deletes=[],
+            atomic=False
+        )
+        
+        assert committed is True
+        assert [r.status for r in results] == [201, 400, 201, 400, 400]
+        assert [get_setting_by_id(results[i].id).data for i in (0, 2)] == [{"ok": 1}, {"ok": 2}]
+        assert results[0].setting.data == {"ok": 1}
+        assert results[1].error and get_setting_by_id(results[1].id) is None
+        
+        _, results = apply_batch(
+            creates=[{"ok": 3}],
+            updates=[(str(setting.id), {"bad": "\u0000"}), ("00000000-0000-0000-0000-000000000000", {})],
+            deletes=[],
+            atomic=False
+        )
+        assert [r.status for r in results] == [201, 400, 404]
+        assert get_setting_by_id(str(setting.id)).data == {"version": 1}
+    
+    def test_get_changes(self, create_test_setting):
+        ## Test the feed reports creates, updates and deletes in order and resumes from a position
+        _, start = get_changes()
+        setting = create_test_setting({"version": 1})
+        other = create_test_setting({"other": True})
+        update_setting(str(setting.id), {"version": 2})
+        delete_setting(str(setting.id))
+        
+        changes, position = get_changes(start, ids=[str(setting.id)])
+        
+        assert [(c.op, c.id) for c in changes] == [("create", setting.id), ("update", setting.id), ("delete", setting.id)]
+        assert get_changes(position, ids=[str(setting.id)])[0] == []
+        assert [c.id for c in get_changes(start)[0]] == [setting.id, other.id, setting.id, setting.id]
+        
+        first, after_first = get_changes(start, limit=1)
+        assert after_first == first[0].position
+        with pytest.raises(InvalidPositionError):
+            get_changes("not-a-position")
+    
+    def test_get_changes_waits_for_open_transactions(self, create_test_setting):
+        ## Test a change that commits late is never skipped by readers that saw later changes
+        _, start = get_changes()
+        conn = create_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO settings (id, data) VALUES (gen_random_uuid(), '{}') RETURNING id")
+                slow_id = cur.fetchone()["id"]
+            fast = create_test_setting({"fast": True})
+            
+            changes, position = get_changes(start)
+            assert changes == []
+            
+            conn.commit()
+        finally:
+            conn.close()
+        
+        changes, _ = get_changes(position)
+        assert [str(c.id) for c in changes] == [str(slow_id), str(fast.id)]
+    
+    def test_sync_settings(self, create_test_setting):
+        ## Test syncing returns the latest state of changed settings and tombstones for deletes
+        _, _, watermark, _ = sync_settings()
+        kept = create_test_setting({"version": 1})
+        gone = create_test_setting({"gone": True})
+        update_setting(str(kept.id), {"version": 2})
+        delete_setting(str(gone.id))
+        
+        settings, deleted, next_watermark, has_more = sync_settings(watermark)
+        
+        assert [(s.id, s.data) for s in settings] == [(kept.id, {"version": 2})]
+        assert deleted == [str(gone.id)]
+        assert has_more is False
+        assert sync_settings(next_watermark)[:2] == ([], [])
+        
+        first = sync_settings(watermark, limit=1)
+        assert first[0][0].id == kept.id and first[3] is True
+    
+    def test_prune_changes_expires_old_positions(self, create_test_setting):
+        ## Test positions older than the pruned log are rejected
+        _, old = get_changes()
+        create_test_setting()
+        _, current = get_changes()
+        
+        assert prune_changes(retention=0) >= 1
+        
+        with pytest.raises(PositionExpiredError):
+            get_changes(old)
+        with pytest.raises(PositionExpiredError):
+            sync_settings(old)
+        assert get_changes(current)[0] == []
@@ -0,0 +1,89 @@
+import pytest
+import time
+from app.db.connection import create_connection, get_db_connection, get_pool_stats
+from app.db.pool import ConnectionPool, PoolTimeoutError
+
+@pytest.mark.unit
+class TestConnectionPool:
+    ## Test connection pooling
+
+    def test_reuses_connections(self):
+        ## Test a returned connection is handed out again
+        pool = ConnectionPool(create_connection, min_size=1, max_size=2)
+        pool.open()
+        try:
+            conn = pool.getconn()
+            pool.putconn(conn)
+            assert pool.getconn() is conn
+            assert pool.stats()["connections_created"] == 1
+        finally:
+            pool.close()
+
+    def test_stats_track_usage(self):
+        ## Test in use and idle counts
+        pool = ConnectionPool(create_connection, min_size=2, max_size=3)
+        pool.open()
+        try:
+            conn = pool.getconn()
+            stats = pool.stats()
+            assert stats["in_use"] == 1
+            assert stats["idle"] == 1
+            assert stats["requests"] == 1
+
+            pool.putconn(conn)
+            stats = pool.stats()
+            assert stats["in_use"] == 0
+            assert stats["idle"] == 2
+        finally:
+            pool.close()
+
+    def test_timeout_when_exhausted(self):
+        ## Test checkout fails once max_size connections are in use
+        pool = ConnectionPool(create_connection, min_size=0, max_size=1, timeout=0.1)
+        try:
+            conn = pool.getconn()
+            with pytest.raises(PoolTimeoutError):
+                pool.getconn()
+            assert pool.stats()["timeouts"] == 1
+            pool.putconn(conn)
+        finally:
+            pool.close()
+
+    def test_recycles_expired_connections(self):
+        ## Test connections older than max_lifetime are replaced
+        pool = ConnectionPool(create_connection, min_size=1, max_size=1, max_lifetime=0.01)
+        pool.open()
+        try:
+            conn = pool.getconn()
+            pool.putconn(conn)
+            time.sleep(0.02)
+            new_conn = pool.getconn()
+            assert new_conn is not conn
+            assert conn.closed
+            pool.putconn(new_conn)
+        finally:
+            pool.close()
+
+    def test_replaces_broken_connections(self):
+        ## Test a connection closed while idle fails the health check and is replaced
+        pool = ConnectionPool(create_connection, min_size=1, max_size=1, health_check_interval=0)
+        pool.open()
+        try:
+            conn = pool.getconn()
+            pool.putconn(conn)
+            conn.close()
+
+            new_conn = pool.getconn()
+            assert not new_conn.closed
+            assert pool.stats()["connections_failed_health_check"] == 1
+            pool.putconn(new_conn)
+        finally:
+            pool.close()
+
+    def test_get_db_connection_uses_pool(self):
+        ## Test the shared pool is used by get_db_connection
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 AS one")
+                assert cur.fetchone()["one"] == 1
+            assert get_pool_stats()["in_use"] >= 1
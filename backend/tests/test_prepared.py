@@ -0,0 +1,65 @@
+import pytest
+from app.db.connection import create_connection
+from app.db.prepared import PreparedStatements, STATEMENTS
+
+@pytest.fixture
+def raw_connection(test_db):
+    # An unpooled connection, so prepared statements don't leak into the pool
+    conn = create_connection()
+    yield conn
+    conn.close()
+
+def _prepared_names(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT name FROM pg_prepared_statements")
+        names = {row["name"] for row in cur.fetchall()}
+    conn.rollback()
+    return names
+
+@pytest.mark.unit
+class TestPreparedStatements:
+    ## Test server-side prepared statements
+
+    def test_prepared_once_per_connection(self, raw_connection, create_test_setting):
+        ## Test a statement is prepared on first use and executed afterwards
+        setting = create_test_setting({"v": 1})
+        statements = PreparedStatements(STATEMENTS)
+
+        for _ in range(3):
+            with raw_connection.cursor() as cur:
+                statements.execute(cur, "settings_get", (setting.namespace, str(setting.id)))
+                assert cur.fetchone()["data"] == {"v": 1}
+            raw_connection.rollback()
+
+        assert "settings_get" in _prepared_names(raw_connection)
+        assert statements.stats() == {"enabled": True, "connections": 1, "prepares": 1, "executions": 3, "fallbacks": 0}
+
+    def test_plain_inside_transaction(self, raw_connection, create_test_setting):
+        ## Test statements after the start of a transaction run as plain SQL
+        setting = create_test_setting({"v": 1})
+        statements = PreparedStatements(STATEMENTS)
+
+        with raw_connection.cursor() as cur:
+            cur.execute("SELECT 1")
+            statements.execute(cur, "settings_version", (setting.namespace, str(setting.id)))
+            assert cur.fetchone()["updated_at"] == setting.updated_at
+        raw_connection.rollback()
+
+        assert statements.stats()["prepares"] == 0
+
+    def test_fallback_when_statement_disappears(self, raw_connection, create_test_setting):
+        ## Test losing prepared statements (e.g. behind PgBouncer) turns them off and still answers
+        setting = create_test_setting({"v": 1})
+        statements = PreparedStatements(STATEMENTS)
+        with raw_connection.cursor() as cur:
+            statements.execute(cur, "settings_get", (setting.namespace, str(setting.id)))
+            cur.execute("DEALLOCATE ALL")
+        raw_connection.commit()
+
+        with raw_connection.cursor() as cur:
+            statements.execute(cur, "settings_get", (setting.namespace, str(setting.id)))
+            assert cur.fetchone()["data"] == {"v": 1}
+        raw_connection.commit()
+
+        assert statements.stats()["enabled"] is False
+        assert statements.stats()["fallbacks"] == 1
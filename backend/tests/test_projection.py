@@ -0,0 +1,121 @@
+import json
+import uuid
+import pytest
+import pytest_asyncio
+from app.db import async_operations, operations
+from app.db.async_connection import close_async_pool
+from app.db.projection import MAX_FIELDS, NO_DATA, WHOLE_DOCUMENT, InvalidFieldsError, compile_projection
+from app.db.replicas import replica_router
+
+DOCUMENT = {"theme": "dark", "limits": {"max": 10, "min": 1}, "tags": ["a", "b"], "a/b": 1, "large": "x" * 10000}
+
+@pytest.fixture
+def namespace():
+    # A fresh namespace so listings only see the test's settings
+    return f"test-{uuid.uuid4().hex[:12]}"
+
+@pytest_asyncio.fixture
+async def async_db(test_db):
+    # Async pools and write batcher are bound to the test's event loop, close them afterwards
+    yield
+    await async_operations.write_batcher.close()
+    await replica_router.close_async()
+    await close_async_pool()
+
+@pytest.mark.unit
+class TestProjection:
+    ## Test field selection compiled to SQL and evaluated by Postgres
+
+    def test_compile_projection(self):
+        ## Test the whole document, no data, pointers and malformed selections
+        assert compile_projection() is WHOLE_DOCUMENT
+        assert compile_projection(include_data=False) is NO_DATA
+
+        projection = compile_projection(["/limits/max", "/a~1b", "/limits/max"])
+        assert projection.expression == "jsonb_build_object(%s::text, data #> %s::text[], %s::text, data #> %s::text[])"
+        assert projection.params == ["/limits/max", ["limits", "max"], "/a~1b", ["a/b"]]
+
+        for fields, include_data in [(["theme"], True), ([], True), (["/theme"], False), (["/x"] * 2 + [f"/{i}" for i in range(MAX_FIELDS)], True)]:
+            with pytest.raises(InvalidFieldsError):
+                compile_projection(fields, include_data)
+
+    def test_get_setting_fields(self, test_db, namespace):
+        ## Test only the selected paths are returned, keyed by pointer, with null for missing ones
+        setting = operations.create_setting(DOCUMENT, namespace)
+
+        selected = operations.get_setting_fields(str(setting.id), ["/theme", "/limits/max", "/tags/1", "/a~1b", "/missing"], namespace)
+
+        assert selected.data == {"/theme": "dark", "/limits/max": 10, "/tags/1": "b", "/a~1b": 1, "/missing": None}
+        assert (selected.id, selected.updated_at) == (setting.id, setting.updated_at)
+        assert operations.get_setting_fields(str(setting.id), ["/theme"]) is None
+        assert operations.get_setting_fields("not-a-uuid", ["/theme"], namespace) is None
+
+    def test_listing_fields_and_no_data(self, test_db, namespace):
+        ## Test listings with selected fields or without data keep the rows, order, cursor and version
+        for i in range(3):
+            operations.create_setting({**DOCUMENT, "n": i}, namespace)
+        whole = operations.get_all_settings_json(1, 2, namespace=namespace)
+
+        selected = operations.get_all_settings_json(1, 2, fields=["/n", "/limits"], namespace=namespace)
+        without = operations.get_all_settings_json(1, 2, filters={"has_key": "n"}, include_data=False, namespace=namespace)
+
+        assert [item["data"] for item in json.loads(selected.data)] == [
+            {"/n": 2, "/limits": {"max": 10, "min": 1}}, {"/n": 1, "/limits": {"max": 10, "min": 1}}
+        ]
+        items = json.loads(without.data)
+        assert all("data" not in item for item in items)
+        assert [item["id"] for item in items] == [item["id"] for item in json.loads(whole.data)]
+        for page in (selected, without):
+            assert (page.total, page.rows, page.last_key, page.version) == (3, 2, whole.last_key, whole.version)
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+class TestAsyncProjection:
+    ## Test field selection through the async operations
+
+    async def test_async_fields(self, async_db, namespace):
+        ## Test single reads and listings select the same fields as the sync operations
+        setting = await async_operations.create_setting(DOCUMENT, namespace)
+
+        selected = await async_operations.get_setting_fields(str(setting.id), ["/limits/min"], namespace)
+        page = await async_operations.get_all_settings_json(1, 10, fields=["/theme"], namespace=namespace)
+        without = await async_operations.get_all_settings_json(1, 10, include_data=False, namespace=namespace)
+
+        assert selected.data == {"/limits/min": 1}
+        assert [item["data"] for item in json.loads(page.data)] == [{"/theme": "dark"}]
+        assert "data" not in json.loads(without.data)[0]
+
+@pytest.mark.integration
+class TestProjectionAPI:
+    ## Test the fields and include_data query parameters
+
+    def test_setting_fields(self, client):
+        ## Test a selection has its own ETag and conditional requests on it
+        setting = client.post("/api/settings", json={"data": DOCUMENT}).json()
+        url = f"/api/settings/{setting['id']}"
+        whole = client.get(url)
+
+        selected = client.get(url, params={"fields": ["/theme", "/limits/max"]})
+
+        assert selected.status_code == 200
+        assert selected.json()["data"] == {"/theme": "dark", "/limits/max": 10}
+        assert selected.headers["etag"] != whole.headers["etag"]
+        revalidated = client.get(url, params={"fields": ["/theme", "/limits/max"]}, headers={"If-None-Match": selected.headers["etag"]})
+        assert revalidated.status_code == 304
+        assert client.get(url, params={"fields": "/theme"}, headers={"If-None-Match": whole.headers["etag"]}).status_code == 200
+        assert client.get(url, params={"fields": "theme"}).status_code == 400
+        assert client.get(url, params={"fields": "/theme", "as_of": "2024-01-01T00:00:00"}).status_code == 400
+
+    def test_listing_fields(self, client, namespace):
+        ## Test listings select fields or leave the data out
+        base = f"/api/namespaces/{namespace}/settings"
+        client.post(base, json={"data": DOCUMENT})
+
+        selected = client.get(base, params={"fields": "/tags"})
+        without = client.get(base, params={"include_data": "false"})
+
+        assert [item["data"] for item in selected.json()["data"]] == [{"/tags": ["a", "b"]}]
+        assert "data" not in without.json()["data"][0]
+        assert without.json()["pagination"]["total"] == 1
+        assert len({client.get(base).headers["etag"], selected.headers["etag"], without.headers["etag"]}) == 3
+        assert client.get(base, params={"fields": "/tags", "include_data": "false"}).status_code == 400
@@ -0,0 +1,68 @@
+import pytest
+from app.db.instrumentation import INSTRUMENTED
+from app.db.operations import get_all_settings, update_setting
+from app.db.slow_queries import SlowQueryLog, slow_query_log
+
+@pytest.fixture
+def log_everything(monkeypatch):
+    # Logs and explains every statement for the test
+    monkeypatch.setattr(slow_query_log, "threshold", 1e-9)
+    monkeypatch.setattr(slow_query_log, "explain_interval", 1e-9)
+    slow_query_log.clear()
+    yield slow_query_log
+    slow_query_log.clear()
+
+@pytest.mark.unit
+class TestSlowQueryLog:
+    ## Test the slow query log
+
+    def test_buffer_and_redaction(self):
+        ## Test the buffer keeps the newest entries and params are redacted unless enabled
+        log = SlowQueryLog(threshold=0.1, buffer_size=2, explain_interval=60, log_params=False)
+        for n in range(3):
+            log.record("psycopg2", f"SELECT  {n}\n FROM settings", ("secret", n), 0.2, 1, False)
+
+        entries = log.entries()
+
+        assert [entry["query"] for entry in entries] == ["SELECT 2 FROM settings", "SELECT 1 FROM settings"]
+        assert entries[0]["params"] == ["<str>", "<int>"]
+        assert log.stats()["logged"] == 3
+        assert not log.is_slow(0.05) and log.is_slow(0.1)
+        assert log.claim_explain("select", "SELECT 1") and not log.claim_explain("select", "SELECT 1")
+        log.explain_interval = 1e-9
+        assert log.claim_explain("with", "WITH page AS (SELECT updated_at FROM settings) SELECT * FROM page")
+        assert not log.claim_explain("with", "WITH pruned AS (DELETE FROM settings_changes) SELECT 1")
+        assert not log.claim_explain("update", "UPDATE settings SET data = '{}'")
+
+    @pytest.mark.skipif(not INSTRUMENTED, reason="statements aren't instrumented")
+    def test_slow_statements_explained(self, create_test_setting, log_everything):
+        ## Test slow SELECTs get a plan and writes are logged without re-running them
+        setting = create_test_setting({"theme": "dark"})
+
+        get_all_settings(1, 10, count_strategy="exact", filters={"contains": {"theme": "dark"}})
+        update_setting(str(setting.id), {"theme": "light"})
+
+        entries = log_everything.entries()
+        count = next(entry for entry in entries if entry["query"].startswith("SELECT COUNT(*)"))
+        page = next(entry for entry in entries if entry["query"].startswith("SELECT id, namespace, data"))
+        update = next(entry for entry in entries if "UPDATE settings" in entry["query"] or "settings_update" in entry["query"])
+        assert "actual time" in count["plan"] and "Buffers" in count["plan"]
+        assert count["params"] == ["<str>", "<str>"]
+        assert "Limit" in page["plan"]
+        assert update["plan"] is None
+        assert update["rows"] == 1
+
+    @pytest.mark.skipif(not INSTRUMENTED, reason="statements aren't instrumented")
+    def test_admin_endpoint(self, client, create_test_setting, log_everything):
+        ## Test slow statements from requests are listed by the admin endpoint
+        setting = create_test_setting()
+        client.get(f"/api/settings/{setting.id}")
+
+        response = client.get("/admin/slow-queries", params={"limit": 5})
+
+        assert response.status_code == 200
+        body = response.json()
+        assert 0 < len(body["queries"]) <= 5
+        assert any(entry["plan"] for entry in body["queries"])
+        assert client.delete("/admin/slow-queries").status_code == 204
+        assert client.get("/admin/slow-queries").json()["queries"] == []
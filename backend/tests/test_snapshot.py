@@ -0,0 +1,114 @@
+import json
+import pytest
+from app.db import operations
+from app.db.pagination import encode_cursor
+from app.db.snapshot import build_snapshot, settings_snapshot
+
+@pytest.fixture
+def snapshot(test_db, tmp_path, monkeypatch):
+    # Serves reads from a snapshot file built for the test, as if the change listener were connected
+    path = str(tmp_path / "settings.snapshot")
+    monkeypatch.setattr(settings_snapshot, "path", path)
+
+    def _build():
+        build_snapshot(path)
+        settings_snapshot.resume()
+        assert settings_snapshot.refresh()
+        return settings_snapshot
+    return _build
+
+def _database_page(*args, **kwargs):
+    # The same listing read from the database
+    path = settings_snapshot.path
+    settings_snapshot.path = ""
+    try:
+        return operations.get_all_settings_json(*args, **kwargs)
+    finally:
+        settings_snapshot.path = path
+
+@pytest.mark.unit
+class TestSettingsSnapshot:
+    ## Test reads served from the memory-mapped snapshot file
+
+    def test_reads_match_database(self, snapshot, create_test_setting):
+        ## Test single reads, versions and listing pages match the database, cursor and ETag included
+        setting = create_test_setting({"theme": "dark", "nested": {"list": [1, 2]}})
+        for i in range(4):
+            create_test_setting({"n": i})
+        snap = snapshot()
+        misses = snap.misses
+
+        assert operations.get_setting_by_id(str(setting.id)) == setting
+        assert operations.get_setting_version(str(setting.id)) == setting.updated_at
+        first = operations.get_all_settings_json(1, 3)
+        cursor = encode_cursor(*first.last_key)
+        following = operations.get_all_settings_json(1, 3, cursor)
+        offset = operations.get_all_settings_json(2, 2, count_strategy="none")
+        assert snap.misses == misses
+
+        for page, expected in [
+            (first, _database_page(1, 3)),
+            (following, _database_page(1, 3, cursor)),
+            (offset, _database_page(2, 2, count_strategy="none")),
+        ]:
+            assert json.loads(page.data) == json.loads(expected.data)
+            assert (page.total, page.rows, page.last_key, page.version) == (
+                expected.total, expected.rows, expected.last_key, expected.version
+            )
+
+    def test_writes_after_build_read_from_database(self, snapshot, create_test_setting, db_connection):
+        ## Test own writes, writes noted from the change log and creates all bypass the file
+        own = create_test_setting({"v": 1})
+        other = create_test_setting({"v": 1})
+        snap = snapshot()
+        assert snap.page(10, 0, None, "exact") is not None
+
+        updated = operations.update_setting(str(own.id), {"v": 2})
+        assert operations.get_setting_by_id(str(own.id)).data == {"v": 2}
+        assert operations.get_setting_version(str(own.id)) == updated.updated_at
+        assert snap.page(10, 0, None, "exact") is None
+
+        # Written by another worker while this one's notifications were lost, found on resync
+        with db_connection.cursor() as cur:
+            cur.execute("UPDATE settings SET data = '{\"v\": 3}' WHERE id = %s", (str(other.id),))
+        db_connection.commit()
+        snap.resume()
+        snap.refresh()
+        assert snap.get(str(other.id)) is None
+        assert operations.get_setting_by_id(str(other.id)).data == {"v": 3}
+
+        created = operations.create_setting({"v": 1})
+        assert snap.get(str(created.id)) is None
+        assert operations.get_setting_by_id(str(created.id)) == created
+
+    def test_rebuild_is_mapped(self, snapshot, create_test_setting):
+        ## Test a rebuilt file replaces the mapped one and clears the written settings
+        setting = create_test_setting({"v": 1})
+        snap = snapshot()
+        swaps = snap.swaps
+        operations.update_setting(str(setting.id), {"v": 2})
+        assert snap.stats()["dirty"] == 1
+
+        build_snapshot(snap.path)
+        snap.refresh()
+
+        assert snap.swaps == swaps + 1
+        assert snap.stats()["dirty"] == 0
+        assert snap.get(str(setting.id)).data == {"v": 2}
+        assert snap.page(10, 0, None, "exact") is not None
+
+    def test_not_served_while_disconnected(self, snapshot, create_test_setting):
+        ## Test nothing is read from the file while change notifications can't be received
+        setting = create_test_setting({"v": 1})
+        snap = snapshot()
+
+        snap.suspend()
+        assert snap.get(str(setting.id)) is None
+        assert snap.page(10, 0, None, "exact") is None
+
+        snap.resume()
+        snap.refresh()
+        assert snap.get(str(setting.id)) == setting
+
+        snap.note_change({"op": "TRUNCATE"})
+        assert not snap.active
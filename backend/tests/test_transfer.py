@@ -0,0 +1,67 @@
+import pytest
+import json
+from app.db.operations import get_setting_by_id
+from app.db.transfer import export_settings, import_settings, SettingsImportError
+
+@pytest.mark.unit
+class TestTransfer:
+    ## Test NDJSON export and COPY import
+
+    def test_export_includes_settings(self, create_test_setting):
+        ## Test a setting appears in the export
+        setting = create_test_setting({"export": "me"})
+
+        lines = b"".join(export_settings(batch_size=5)).splitlines()
+        exported = [json.loads(line) for line in lines]
+
+        match = [item for item in exported if item["id"] == str(setting.id)]
+        assert match[0]["data"] == {"export": "me"}
+        assert match[0]["created_at"]
+
+    def test_import_new_settings(self, db_connection):
+        ## Test importing lines with and without IDs
+        new_id = "11111111-1111-1111-1111-111111111111"
+        lines = [
+            json.dumps({"id": new_id, "data": {"path": "C:\\temp", "quote": '"x"'}}).encode() + b"\n",
+            b"\n",
+            json.dumps({"data": {"generated": True}}).encode() + b"\n",
+        ]
+        import_settings([json.dumps({"id": new_id, "data": {}}).encode()], upsert=True)
+
+        counts = import_settings(lines, upsert=True)
+
+        assert counts["lines"] == 3
+        assert counts["inserted"] == 1
+        assert counts["updated"] == 1
+        assert get_setting_by_id(new_id).data == {"path": "C:\\temp", "quote": '"x"'}
+
+    def test_import_round_trip(self, create_test_setting):
+        ## Test an export can be re-imported with upsert
+        setting = create_test_setting({"round": "trip"})
+        exported = [line for line in b"".join(export_settings()).splitlines()
+                    if str(setting.id).encode() in line]
+
+        counts = import_settings(exported, upsert=True)
+
+        assert counts["updated"] == 1
+        restored = get_setting_by_id(str(setting.id))
+        assert restored.data == {"round": "trip"}
+        assert restored.created_at == setting.created_at
+
+    def test_import_invalid_line(self, db_connection):
+        ## Test a malformed line fails the import
+        with pytest.raises(SettingsImportError):
+            import_settings([b'{"data": "not an object"}\n'])
+
+    def test_import_timestamps(self, db_connection):
+        ## Test timestamps must be ISO 8601 strings, the failing line is reported
+        new_id = "22222222-2222-2222-2222-222222222222"
+        line = {"id": new_id, "data": {"tab": "a\tb"}, "created_at": "2024-01-02T03:04:05", "updated_at": None}
+        import_settings([json.dumps(line).encode()], upsert=True)
+
+        restored = get_setting_by_id(new_id)
+        assert restored.data == {"tab": "a\tb"}
+        assert restored.created_at.isoformat() == "2024-01-02T03:04:05"
+        for created_at in ["yesterday", 1704164645, "2024-13-02T03:04:05", {}]:
+            with pytest.raises(SettingsImportError, match="Line 2: 'created_at'"):
+                import_settings([b"\n", json.dumps({"data": {}, "created_at": created_at}).encode()])
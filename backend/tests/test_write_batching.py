@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+import pytest
+import pytest_asyncio
+from psycopg2 import errors as pg_errors
+from starlette.concurrency import run_in_threadpool
+from app.db import async_operations, operations
+from app.db.write_batching import WriteBatcher
+
+async def _create_one(data, namespace):
+    return await run_in_threadpool(operations.create_setting, data, namespace)
+
+async def _update_one(setting_id, data, namespace):
+    return await run_in_threadpool(operations.update_setting, setting_id, data, namespace)
+
+@pytest_asyncio.fixture
+async def batcher(test_db):
+    # Writes run on the sync pool, so the batcher doesn't depend on the async pool's event loop
+    batcher = WriteBatcher(
+        async_operations._apply_write_batch, _create_one, _update_one, max_items=10, max_delay=5
+    )
+    yield batcher
+    await batcher.close()
+
+@pytest.mark.unit
+@pytest.mark.asyncio
+class TestWriteBatching:
+    ## Test group commit of concurrent writes
+
+    async def test_concurrent_writes_share_a_batch(self, batcher):
+        ## Test a full batch is written at once and every caller gets its own setting
+        existing = operations.create_setting({"v": 0})
+
+        results = await asyncio.gather(
+            *(batcher.create({"n": n}) for n in range(9)),
+            batcher.update(str(existing.id), {"v": 1})
+        )
+
+        assert [setting.data for setting in results[:9]] == [{"n": n} for n in range(9)]
+        assert len({setting.id for setting in results[:9]}) == 9
+        assert results[9].id == existing.id and results[9].data == {"v": 1}
+        assert batcher.stats() == {"enabled": True, "queued": 0, "batches": 1, "writes": 10, "fallbacks": 0}
+
+    async def test_missing_setting_and_repeated_updates(self, batcher):
+        ## Test a missing setting only fails its own update and repeated updates apply in order
+        batcher.max_delay = 0.01
+        existing = operations.create_setting({"v": 0})
+
+        missing, first, second = await asyncio.gather(
+            batcher.update(str(uuid.uuid4()), {"v": 1}),
+            batcher.update(str(existing.id), {"v": 1}),
+            batcher.update(str(existing.id), {"v": 2})
+        )
+
+        assert missing is None
+        assert first.data == {"v": 1} and second.data == {"v": 2}
+        assert operations.get_setting_by_id(str(existing.id)).data == {"v": 2}
+        assert batcher.stats()["batches"] == 2
+
+    async def test_failed_write_falls_back(self, batcher):
+        ## Test a write Postgres rejects fails alone, only it is retried on its own and the rest succeed
+        batcher.max_delay = 0.01
+
+        results = await asyncio.gather(
+            batcher.create({"ok": 1}),
+            batcher.create({"bad": "\u0000"}),
+            batcher.create({"ok": 2}),
+            return_exceptions=True
+        )
+
+        assert results[0].data == {"ok": 1} and results[2].data == {"ok": 2}
+        assert isinstance(results[1], pg_errors.UntranslatableCharacter)
+        assert batcher.stats()["fallbacks"] == 1
+
+    async def test_namespaces_are_batched_apart(self, batcher):
+        ## Test writes to different namespaces flushed together each land in their own namespace
+        first, second = (f"test-{uuid.uuid4().hex[:12]}" for _ in range(2))
+
+        results = await asyncio.gather(
+            *(batcher.create({"n": n}, first if n % 2 else second) for n in range(10))
+        )
+
+        assert [setting.namespace for setting in results] == [first if n % 2 else second for n in range(10)]
+        assert operations.get_all_settings(1, 10, namespace=first)[1] == 5
+        assert batcher.stats()["batches"] == 1